@@ -0,0 +1,85 @@
+# scripts/bench_context_build.py
+"""
+每轮构建对话上下文的开销：每轮完整重建压缩消息 (旧做法) vs 按插槽缓存、只处理新增记录 (context_window)。
+先在一个插槽里放入 --records 条带图片摘要的记录，然后每轮追加一条新消息并重新构建上下文，取平均耗时。
+最后一项使用正常的 32k token 预算，超出预算的部分由一个立即返回的假摘要模型折叠，不访问网关。
+handlers 依赖 NoneBot，这里以 none 驱动初始化 NoneBot，不会连接任何协议端。
+用法: python scripts/bench_context_build.py [--records 5000] [--turns 50]
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import time
+import types
+from pathlib import Path
+
+import nonebot
+
+# 以独立包的形式加载插件模块 (不走插件加载流程)；config 要求的环境变量缺失时填入占位值
+for _name in ("NEWAPI_URL", "NEWAPI_TOKEN", "QWEATHER_API_KEY", "GOOGLE_API_KEY", "GOOGLE_CSE_ID", "ACTIVE_CHAT_GROUP_IDS"):
+    os.environ.setdefault(_name, "http://127.0.0.1:9" if _name == "NEWAPI_URL" else "bench")
+nonebot.init(_env_file=None, driver="~none")
+_package = types.ModuleType("yimao_plugin")
+_package.__path__ = [str(Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin")]
+sys.modules["yimao_plugin"] = _package
+from yimao_plugin import config, context_window, data_store, handlers, llm_client  # noqa: E402
+
+SESSION_ID = "group_1_1"
+MODEL = config.DEFAULT_MODEL_NAME
+
+def fill_history(records: int):
+    history = data_store.get_active_history(SESSION_ID, "normal")
+    for i in range(records // 2):
+        history.append({"role": "user", "message_id": i, "content": [
+            {"type": "text", "text": f"问题 {i} " + "这张图里是什么？" * 20},
+            {"type": "image_url", "image_url": {"url": "blob:sha256:bench"}, "summary": "一只在窗台上晒太阳的橘猫。" * 5},
+        ]})
+        history.append({"role": "assistant", "message_id": 10 ** 6 + i, "response_to_id": i, "content": "喵~ 是一只橘猫。" * 60})
+    return history
+
+async def build_full(history) -> list:
+    """旧做法：每轮把整个插槽重新压缩一遍。"""
+    return await handlers.build_api_messages_with_compression(list(history), MODEL)
+
+async def build_cached(history) -> list:
+    slot = data_store.get_active_slot(SESSION_ID, "normal")
+    cache = data_store.get_context_cache(SESSION_ID, "normal")
+    start = await context_window.prepare_window(history, cache, slot, MODEL, "")
+    entries = list(itertools.islice(cache, start, None))
+    return await handlers.build_api_messages_with_compression([entry[context_window.ENTRY_RECORD] for entry in entries], MODEL, cache_entries=entries)
+
+async def fake_summary_route(route, messages, system_prompt_content, use_tools, priority=None, response_format=None) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": "更早的对话主要在讨论猫咪的照片。"}}]}
+
+async def measure(name: str, build, history, turns: int):
+    started_at = time.perf_counter()
+    for turn in range(turns):
+        history.append({"role": "user", "message_id": -turn - 1, "content": f"新消息 {turn}"})
+        await build(history)
+    print(f"{name:>24}: {(time.perf_counter() - started_at) * 1000 / turns:8.2f} ms/轮 (插槽 {len(history)} 条)")
+
+async def run(records: int, turns: int):
+    history = fill_history(records)
+    # 不限预算时两种做法发送的内容应当完全一致
+    config.CONTEXT_TOKEN_BUDGETS = {MODEL: 10 ** 9}
+    assert await build_full(history) == await build_cached(history), "缓存构建的结果与完整重建不一致"
+    await measure("完整重建 (整个插槽)", build_full, history, turns)
+    await measure("增量缓存 (整个插槽)", build_cached, history, turns)
+    config.CONTEXT_TOKEN_BUDGETS = {MODEL: 32000}
+    llm_client.call_model_route = fake_summary_route
+    await build_cached(history)  # 第一次折叠不计时
+    await measure("增量缓存 (32k 预算)", build_cached, history, turns)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(run(args.records, args.turns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# scripts/bench_gateway_client.py
+"""
+LLM 请求的客户端开销：每次调用新建 httpx.AsyncClient (旧做法) vs http_client 的共享连接池。
+在本机起一个支持 keep-alive 的桩网关，依次发送 --calls 次相同的对话请求，比较平均延迟。
+桩网关立即返回，因此测到的差别就是客户端构建和 TCP 建连的开销。
+用法: python scripts/bench_gateway_client.py [--calls 300]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+
+class _StubGateway(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"choices": [{"message": {"role": "assistant", "content": "喵~"}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_server = ThreadingHTTPServer(("127.0.0.1", 0), _StubGateway)
+threading.Thread(target=_server.serve_forever, daemon=True).start()
+BASE_URL = f"http://127.0.0.1:{_server.server_address[1]}"
+
+# 以独立包的形式加载插件模块，避免初始化 NoneBot；网关地址指向桩网关，其余必需的环境变量填入占位值
+os.environ["NEWAPI_URL"] = BASE_URL
+for _name in ("NEWAPI_TOKEN", "QWEATHER_API_KEY", "GOOGLE_API_KEY", "GOOGLE_CSE_ID", "ACTIVE_CHAT_GROUP_IDS"):
+    os.environ.setdefault(_name, "bench")
+_package = types.ModuleType("yimao_plugin")
+_package.__path__ = [str(Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin")]
+sys.modules["yimao_plugin"] = _package
+from yimao_plugin import config, http_client, llm_client  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+async def call_with_new_client() -> dict:
+    """旧做法：每次请求都新建并关闭一个客户端。"""
+    async with httpx.AsyncClient(timeout=180.0) as client:
+        response = await client.post(f"{config.DEFAULT_API_BASE_URL}/chat/completions", json={"model": config.DEFAULT_MODEL_NAME, "messages": MESSAGES})
+        return response.json()
+
+async def call_with_pooled_client() -> dict:
+    return await llm_client.call_gemini_api(MESSAGES, "", config.DEFAULT_MODEL_NAME, False)
+
+async def run(calls: int):
+    await http_client.startup()
+    try:
+        for name, call in (("每次新建 AsyncClient", call_with_new_client), ("共享连接池", call_with_pooled_client)):
+            await call()  # 预热，不计时
+            started_at = time.perf_counter()
+            for _ in range(calls): await call()
+            print(f"{name:>20}: {(time.perf_counter() - started_at) * 1000 / calls:6.2f} ms/次")
+    finally:
+        await http_client.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=300)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(run(args.calls))
+
+if __name__ == "__main__":
+    main()
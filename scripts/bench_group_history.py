@@ -0,0 +1,101 @@
+# scripts/bench_group_history.py
+"""
+群聊记录内存占用对比：旧的 dict 记录 vs group_history.GroupMessage。
+用法: python scripts/bench_group_history.py [--groups 1000] [--length 100]
+--length 默认与 config.GROUP_HISTORY_MAX_LENGTH 相同。
+"""
+import argparse
+import datetime
+import gc
+import importlib.util
+import random
+import time
+import tracemalloc
+from collections import deque
+from pathlib import Path
+
+# 直接按文件加载，避免导入插件包时初始化 NoneBot
+_MODULE_PATH = Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin" / "group_history.py"
+_spec = importlib.util.spec_from_file_location("group_history", _MODULE_PATH)
+group_history = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(group_history)
+
+USERS_PER_GROUP = 50
+WORDS = ["哈哈", "今天", "吃什么", "猫猫", "好耶", "这个", "真的假的", "草", "上班", "摸鱼", "来了", "啊这"]
+
+def _random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(2, 15)))
+
+def _random_content(rng: random.Random) -> list:
+    # 与 format_message_for_history 的输出结构一致：文本项列表，偶尔带一张已生成摘要的图片
+    content = [{"type": "text", "text": _random_text(rng)}]
+    if rng.random() < 0.1:
+        content.append({"type": "image", "summary": _random_text(rng) * 3})
+    return content
+
+def _member_names(rng: random.Random, group_index: int) -> list:
+    # 成员显示名来自 member_cache，同一成员的名字在各条记录间本来就是同一个对象
+    return [(str(100000 + group_index * USERS_PER_GROUP + i), f"群友{_random_text(rng)[:6]}") for i in range(USERS_PER_GROUP)]
+
+def build_dict_history(groups: int, length: int) -> dict:
+    rng = random.Random(42)
+    histories = {}
+    for g in range(groups):
+        members = _member_names(rng, g)
+        history = deque(maxlen=length)
+        for _ in range(length):
+            user_id, user_name = rng.choice(members)
+            history.append({
+                "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                # 记录员每条消息都会 str(event.user_id)，得到新的字符串对象
+                "user_id": str(int(user_id)), "user_name": user_name,
+                "content": _random_content(rng), "is_bot": False,
+            })
+        histories[str(g)] = history
+    return histories
+
+def build_compact_history(groups: int, length: int) -> dict:
+    rng = random.Random(42)
+    histories = {}
+    for g in range(groups):
+        members = _member_names(rng, g)
+        history = deque(maxlen=length)
+        for _ in range(length):
+            user_id, user_name = rng.choice(members)
+            history.append(group_history.GroupMessage(str(int(user_id)), user_name, _random_content(rng)))
+        histories[str(g)] = history
+    return histories
+
+def measure(builder, groups: int, length: int):
+    gc.collect()
+    tracemalloc.start()
+    histories = builder(groups, length)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started_at = time.perf_counter()
+    for history in histories.values():
+        # 两种布局都按提示词格式完整渲染一遍，比较格式化开销
+        if builder is build_dict_history:
+            for msg in history:
+                f"[{msg['timestamp']}] [用户ID:{msg['user_id']} (昵称:{msg['user_name']})]: {group_history.render_content(msg['content']).strip()}"
+        else:
+            group_history.render_history(history)
+    return current, time.perf_counter() - started_at
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--length", type=int, default=100)
+    args = parser.parse_args()
+    total = args.groups * args.length
+    print(f"{args.groups} 个群 × {args.length} 条消息 = {total} 条记录")
+    results = {}
+    for name, builder in (("dict", build_dict_history), ("GroupMessage", build_compact_history)):
+        size, render_seconds = measure(builder, args.groups, args.length)
+        results[name] = size
+        print(f"{name:>12}: {size / 1024 / 1024:8.1f} MB ({size / total:6.0f} B/条)，全部渲染耗时 {render_seconds:.2f} 秒")
+    print(f"节省 {(1 - results['GroupMessage'] / results['dict']) * 100:.0f}% 内存")
+
+if __name__ == "__main__":
+    main()
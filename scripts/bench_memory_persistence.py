@@ -0,0 +1,66 @@
+# scripts/bench_memory_persistence.py
+"""
+每轮对话的记忆落盘开销与历史总量的关系：增量写入 SQLite (persist_session) vs 整个 JSON 文件重写 (旧做法)。
+每个会话写入 --records 条记录，逐步增加会话数，在每个规模下测量一个会话追加一轮 (2 条记录) 后落盘的平均耗时。
+数据写在临时目录里，不会碰到 data/ 下的真实记忆。
+用法: python scripts/bench_memory_persistence.py [--sessions 1,200,2000] [--records 100] [--turns 200]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+# 以独立包的形式加载插件模块，避免初始化 NoneBot；config 要求的环境变量缺失时填入占位值
+for _name in ("NEWAPI_URL", "NEWAPI_TOKEN", "QWEATHER_API_KEY", "GOOGLE_API_KEY", "GOOGLE_CSE_ID", "ACTIVE_CHAT_GROUP_IDS"):
+    os.environ.setdefault(_name, "http://127.0.0.1:9" if _name == "NEWAPI_URL" else "bench")
+_package = types.ModuleType("yimao_plugin")
+_package.__path__ = [str(Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin")]
+sys.modules["yimao_plugin"] = _package
+from yimao_plugin import config, data_store  # noqa: E402
+
+def _append_turn(session_id: str, turn: int):
+    history = data_store.get_active_history(session_id, "normal")
+    history.append({"role": "user", "content": "今天天气怎么样？" * 10, "message_id": turn * 2})
+    history.append({"role": "assistant", "content": "喵~ 今天是晴天哦。" * 40, "message_id": turn * 2 + 1, "response_to_id": turn * 2})
+
+def _grow_to(sessions: int, records: int):
+    while len(data_store._user_memory_data) < sessions:
+        session_id = f"group_1_{len(data_store._user_memory_data)}"
+        for turn in range(records // 2): _append_turn(session_id, turn)
+        data_store.persist_session(session_id)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="1,200,2000", help="逐步增长到的会话数，逗号分隔")
+    parser.add_argument("--records", type=int, default=100, help="每个会话的记录数")
+    parser.add_argument("--turns", type=int, default=200, help="每个规模下测量的轮数")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.MEMORY_DB_PATH = str(Path(tmp_dir) / "memory.db")
+        config.MEMORY_FILE_PATH = str(Path(tmp_dir) / "memory.json")
+        data_store.open_memory_store()
+        try:
+            print(f"{'会话数':>8} {'记录数':>10} {'增量落盘/轮':>12} {'JSON 重写/轮':>14}")
+            for sessions in (int(s) for s in args.sessions.split(",")):
+                _grow_to(sessions, args.records)
+                started_at = time.perf_counter()
+                for turn in range(args.turns):
+                    _append_turn("group_1_0", args.records + turn)
+                    data_store.persist_session("group_1_0")
+                incremental = (time.perf_counter() - started_at) / args.turns
+                started_at = time.perf_counter()
+                data_store.save_memory_to_file()
+                full_rewrite = time.perf_counter() - started_at
+                total_records = sum(len(history) for *_, history in data_store.iter_all_histories())
+                print(f"{sessions:>8} {total_records:>10} {incremental * 1000:>10.2f} ms {full_rewrite * 1000:>11.1f} ms")
+        finally:
+            data_store.close_memory_store()
+
+if __name__ == "__main__":
+    main()
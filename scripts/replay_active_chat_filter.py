@@ -0,0 +1,61 @@
+# scripts/replay_active_chat_filter.py
+"""
+用记录下来的主动聊天决策 (config.ACTIVE_CHAT_DECISION_LOG_PATH) 离线回放预筛选，调整阈值和权重。
+对每个候选阈值统计：会跳过多少次决策调用，以及其中有多少次模型本来决定发言 (即会被误杀的发言)。
+注意：日志只包含通过了当时预筛选的消息；想评估更低的阈值，先把 ACTIVE_CHAT_PREFILTER_THRESHOLD 设为 0 运行一段时间收集数据。
+用法: python scripts/replay_active_chat_filter.py data/yimao_active_chat_decisions.jsonl \\
+        [--weights mention=1,question=0.6,topic_shift=0.4,reply_rate=0.5] [--keywords 一猫,猫猫] [--thresholds 0.2,0.3,0.5]
+"""
+import argparse
+import importlib.util
+from pathlib import Path
+
+# 直接按文件加载，避免导入插件包时初始化 NoneBot
+_MODULE_PATH = Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin" / "active_chat_filter.py"
+_spec = importlib.util.spec_from_file_location("active_chat_filter", _MODULE_PATH)
+active_chat_filter = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(active_chat_filter)
+
+def _parse_weights(text: str) -> dict:
+    weights = {}
+    for pair in text.split(","):
+        name, _, value = pair.partition("=")
+        weights[name.strip()] = float(value)
+    return weights
+
+def replay(entries: list, weights: dict, keywords: list, prior: float, alpha: float) -> list:
+    """按时间顺序重新打分，发言率按日志中的结论逐条更新。返回 [(得分, 模型是否决定发言)]。"""
+    prefilter = active_chat_filter.ActiveChatPrefilter(weights, 0.0, keywords, active_chat_filter.ReplyRateTracker(prior, alpha))
+    results = []
+    for entry in sorted(entries, key=lambda e: e["time"]):
+        score, _ = prefilter.score(entry["group_id"], entry["texts"], entry.get("keywords", []), entry.get("new_count", 1))
+        results.append((score, entry["should_reply"]))
+        prefilter.record_decision(entry["group_id"], entry["should_reply"])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log_path")
+    parser.add_argument("--weights", default="mention=1,question=0.6,topic_shift=0.4,reply_rate=0.5")
+    parser.add_argument("--keywords", default="一猫,猫猫,机器人,bot")
+    parser.add_argument("--thresholds", default="0.1,0.2,0.3,0.4,0.5,0.6,0.8,1.0")
+    parser.add_argument("--prior", type=float, default=0.3)
+    parser.add_argument("--alpha", type=float, default=0.1)
+    args = parser.parse_args()
+
+    entries = active_chat_filter.load_decision_log(args.log_path)
+    if not entries:
+        print("日志为空。")
+        return
+    results = replay(entries, _parse_weights(args.weights), [k for k in args.keywords.split(",") if k], args.prior, args.alpha)
+    total, replies = len(results), sum(1 for _, replied in results if replied)
+    print(f"共 {total} 次决策，其中模型决定发言 {replies} 次 ({replies * 100 / total:.0f}%)")
+    print(f"{'阈值':>6} {'跳过调用':>10} {'误杀发言':>10} {'保留发言':>10}")
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        skipped = [replied for score, replied in results if score < threshold]
+        lost = sum(1 for replied in skipped if replied)
+        kept = f"{(replies - lost) * 100 / replies:.0f}%" if replies else "-"
+        print(f"{threshold:>6.2f} {len(skipped):>6} ({len(skipped) * 100 / total:3.0f}%) {lost:>10} {kept:>10}")
+
+if __name__ == "__main__":
+    main()
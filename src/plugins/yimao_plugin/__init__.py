@@ -1,11 +1,7 @@
 # yimao_plugin/__init__.py
 import asyncio
-import base64
-import httpx
 import logging
-import datetime
-import json
-from typing import Optional, List, Dict, Any
+from typing import List, Dict, Any
 
 from nonebot import get_driver, on_command, on_message
 from nonebot.rule import to_me
@@ -15,7 +11,7 @@ from nonebot.params import CommandArg
 from nonebot.permission import SUPERUSER
 from nonebot.adapters.onebot.v11 import Bot, Event, Message, GroupMessageEvent
 
-from . import data_store, handlers, utils, config, llm_client
+from . import data_store, handlers, utils, config, llm_client, image_store, http_client, summary_cache, history_image_queue, message_store, forward_cache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("GeminiPlugin")
@@ -44,8 +40,13 @@ def _extract_text_from_raw_message(raw_msg: Any) -> str:
 # --- 生命周期钩子 ---
 @driver.on_startup
 async def on_startup():
+    await http_client.startup()
     logger.info("正在加载用户记忆...")
-    data_store.load_memory_from_file()
+    data_store.open_memory_store()
+    logger.info("正在打开图片摘要缓存...")
+    summary_cache.open_cache()
+    forward_cache.open_cache()
+    await history_image_queue.start()
     logger.info("正在加载群组长期记忆摘要...")
     data_store.load_group_summaries_from_file()
     logger.info("正在加载猜病游戏历史...") 
@@ -57,7 +58,7 @@ async def on_startup():
 @driver.on_shutdown
 async def on_shutdown():
     logger.info("正在保存用户记忆...")
-    data_store.save_memory_to_file()
+    data_store.close_memory_store()
     logger.info("正在保存群组长期记忆摘要...")
     data_store.save_group_summaries_to_file()
     logger.info("正在保存猜病游戏历史...") 
@@ -65,6 +66,10 @@ async def on_shutdown():
     logger.info("正在保存猜病游戏排行榜...") 
     data_store.save_challenge_leaderboard_to_file() 
     logger.info("用户记忆、群组摘要、游戏历史和排行榜已保存。") 
+    await history_image_queue.stop()
+    summary_cache.close_cache()
+    forward_cache.close_cache()
+    await http_client.shutdown()
 
 
 # --- 历史图片摘要迁移命令 ---
@@ -72,22 +77,17 @@ image_migrator = on_command("migrateimages", aliases={"迁移历史图片"}, per
 @image_migrator.handle()
 async def handle_image_migration(matcher: Matcher):
     await matcher.send("正在开始扫描历史数据，查找需要摘要的旧图片... 这个过程可能会很长。")
-    all_user_memory = data_store._user_memory_data
     tasks_to_run = []
     
-    for session_id, user_memory in all_user_memory.items():
-        for mode in ["normal", "slash"]:
-            mode_memory = getattr(user_memory, mode)
-            for slot in mode_memory.slots:
-                if slot.is_empty: continue
-                for record in slot.history:
-                    content = record.get("content")
-                    if isinstance(content, list):
-                        for item in content:
-                            if item.get("type") == "image_url" and "summary" not in item:
-                                image_url = item.get("image_url", {}).get("url", "")
-                                if image_url.startswith("data:image/jpeg;base64,"):
-                                    tasks_to_run.append((item, image_url.split(",")[1]))
+    for session_id, mode, slot_index, history in data_store.iter_all_histories():
+        for record in history:
+            content = record.get("content")
+            if isinstance(content, list):
+                for item in content:
+                    if item.get("type") == "image_url" and "summary" not in item:
+                        image_url = item.get("image_url", {}).get("url", "")
+                        if image_store.is_loadable_image_url(image_url):
+                            tasks_to_run.append(((session_id, mode, slot_index), item, image_url))
 
     if not tasks_to_run:
         await matcher.finish("扫描完成！没有找到需要迁移的历史图片。")
@@ -98,22 +98,30 @@ async def handle_image_migration(matcher: Matcher):
 
     async def migration_worker():
         processed_count = 0; api_rate_limit_delay = 30
-        for image_item, b64_data in tasks_to_run:
+        for slot_key, image_item, image_url in tasks_to_run:
             try:
                 logger.info(f"正在迁移第 {processed_count + 1}/{total_tasks} 张历史图片...")
-                summary = await llm_client.summarize_image_content(b64_data, model_to_use=config.SLASH_COMMAND_MODEL_NAME)
+                # 【新增】同一张图片之前已经摘要过的话直接用缓存，也不需要为限速等待
+                digest = image_store.get_image_digest(image_url)
+                summary = summary_cache.get(digest, config.SLASH_COMMAND_MODEL_NAME) if digest else None
+                from_cache = summary is not None
+                if not from_cache:
+                    b64_data = await asyncio.to_thread(image_store.load_image_base64, image_url)
+                    if not b64_data: raise FileNotFoundError(f"找不到图片数据 {image_url[:40]}")
+                    summary = await llm_client.summarize_image_content(b64_data, model_to_use=config.SLASH_COMMAND_MODEL_NAME, image_digest=digest)
                 image_item["summary"] = summary
+                data_store.mark_slot_dirty(*slot_key)
                 processed_count += 1
                 logger.info(f"迁移成功 ({processed_count}/{total_tasks})。")
                 if processed_count % 5 == 0:
-                    data_store.save_memory_to_file()
+                    for session_id in {key[0] for key, _, _ in tasks_to_run}: data_store.persist_session(session_id)
                     logger.info("迁移进度已保存。")
                     await matcher.send(f"迁移进度：已完成 {processed_count}/{total_tasks}...")
-                await asyncio.sleep(api_rate_limit_delay)
+                if not from_cache: await asyncio.sleep(api_rate_limit_delay)
             except Exception as e:
                 logger.error(f"迁移一张图片时发生错误: {e}", exc_info=True)
                 await matcher.send(f"处理第 {processed_count + 1} 张图片时出错，跳过此张。错误: {e}")
-        data_store.save_memory_to_file()
+        for session_id in {key[0] for key, _, _ in tasks_to_run}: data_store.persist_session(session_id)
         logger.info("全部历史图片迁移任务完成！")
         await matcher.send(f"🎉 全部 {total_tasks} 张历史图片已成功迁移并生成摘要！")
 
@@ -149,13 +157,50 @@ async def _(bot: Bot, event: Event, matcher: Matcher):
     try:
         cleared_count = data_store.clear_all_memory_for_group(group_id)
         if cleared_count > 0:
-            data_store.save_memory_to_file()
             await matcher.send(f"操作成功：已清空本群 {cleared_count} 位用户的全部对话记忆。")
         else: await matcher.send("本群尚无任何用户的对话记忆，无需操作。")
     except Exception as e:
         logger.error(f"清空群组 {group_id} 记忆时发生错误: {e}", exc_info=True)
         await matcher.send(f"执行清空操作时发生内部错误，请查看后台日志。")
 
+export_memory_matcher = on_command("exportmemory", aliases={"导出记忆"}, permission=SUPERUSER, priority=5, block=True)
+@export_memory_matcher.handle()
+async def _(matcher: Matcher):
+    # 快照在事件循环里取，线程只负责序列化和写文件，避免与正在进行的对话同时读写历史记录
+    snapshot = data_store.snapshot_memory()
+    await asyncio.to_thread(data_store.write_memory_snapshot, snapshot)
+    await matcher.finish(f"已将全部用户记忆导出到 {config.MEMORY_FILE_PATH}。")
+
+image_cache_stats_matcher = on_command("imagecachestats", aliases={"图片缓存统计"}, permission=SUPERUSER, priority=5, block=True)
+@image_cache_stats_matcher.handle()
+async def _(matcher: Matcher):
+    stats = summary_cache.get_stats()
+    queue_stats = history_image_queue.get_stats()
+    dedup_stats = llm_client.get_dedup_stats()["image_summary"]
+    await matcher.finish(
+        f"图片摘要缓存统计：\n命中 {stats['hits']} 次，未命中 {stats['misses']} 次 (命中率 {stats['hit_rate_percent']}%)\n"
+        f"新写入 {stats['stores']} 条，淘汰 {stats['evictions']} 条\n内存热点 {stats['memory_entries']} 条，磁盘共 {stats['disk_entries']} 条\n"
+        f"群聊图片队列：排队中 {queue_stats['queued']}，完成 {queue_stats['completed']}，失败 {queue_stats['failed']}，丢弃 {queue_stats['dropped']}\n"
+        f"合并重复的摘要请求 {dedup_stats['shared']} 次")
+
+forward_cache_stats_matcher = on_command("forwardcachestats", aliases={"转发缓存统计"}, permission=SUPERUSER, priority=5, block=True)
+@forward_cache_stats_matcher.handle()
+async def _(matcher: Matcher):
+    stats = forward_cache.get_stats()
+    await matcher.finish(
+        f"合并转发内容缓存统计：\n内存命中 {stats['memory_hits']} 次，磁盘命中 {stats['disk_hits']} 次，未命中 {stats['misses']} 次 (命中率 {stats['hit_rate_percent']}%)\n"
+        f"内存 {stats['memory_entries']} 条 / {stats['memory_bytes'] // 1024} KB，淘汰 {stats['memory_evictions']} 条\n磁盘 {stats['disk_entries']} 条，淘汰 {stats['disk_evictions']} 条")
+
+active_chat_stats_matcher = on_command("activechatstats", aliases={"主动聊天统计"}, permission=SUPERUSER, priority=5, block=True)
+@active_chat_stats_matcher.handle()
+async def _(matcher: Matcher):
+    stats = handlers.get_active_chat_prefilter().get_stats()
+    debounce_stats = handlers.get_active_chat_debouncer().stats
+    await matcher.finish(
+        f"主动聊天去抖：收到 {debounce_stats['triggers']} 条消息，合并为 {debounce_stats['runs']} 次评估，取消过时的评估 {debounce_stats['cancelled']} 次\n"
+        f"主动聊天预筛选统计：\n评估 {stats['evaluated']} 次，跳过 {stats['skipped']} 次 (省下 {stats['avoided_percent']}% 的决策调用)，放行 {stats['passed']} 次\n"
+        f"决策模型给出结论 {stats['decisions']} 次，其中决定发言 {stats['replies']} 次")
+
 # --- 核心处理器：“总指挥官”模式 ---
 at_me_handler = on_message(rule=to_me(), priority=10, block=True)
 @at_me_handler.handle()
@@ -175,7 +220,7 @@ async def _(bot: Bot, matcher: Matcher, event: MessageEvent):
             current_mode = "slash" if cmd.startswith('//') else "normal"
             if current_mode == confirmed_mode:
                 result_message = data_store.clear_active_slot(session_id, confirmed_mode)
-                data_store.save_memory_to_file()
+                data_store.persist_session(session_id)
                 await matcher.finish(f"已确认。{result_message}")
             else: await matcher.finish("模式不匹配，已取消清空操作。")
         else:
@@ -217,11 +262,10 @@ async def build_multimodal_content(event: MessageEvent) -> List[Dict[str, Any]]:
             img_url = seg.data.get('url')
             if img_url:
                 try:
-                    async with httpx.AsyncClient() as c:
-                        resp = await c.get(img_url, timeout=60.0)
-                        resp.raise_for_status()
-                        img_b64 = base64.b64encode(resp.content).decode()
-                        content_list.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
+                    resp = await http_client.get_client().get(img_url, timeout=config.IMAGE_DOWNLOAD_TIMEOUT)
+                    resp.raise_for_status()
+                    image_ref = await asyncio.to_thread(image_store.put_image, resp.content)
+                    content_list.append({"type": "image_url", "image_url": {"url": image_ref}})
                 except Exception as e:
                     logger.error(f"下载图片失败: {img_url}, error: {e}")
                     text_parts.append("[图片下载失败]")
@@ -232,15 +276,19 @@ async def build_multimodal_content(event: MessageEvent) -> List[Dict[str, Any]]:
 async def handle_forwarded_message(bot: Bot, matcher: Matcher, event: MessageEvent, forward_id: str):
     logger.info(f"检测到合并转发消息，ID: {forward_id}，正在解析...")
     try:
-        forwarded_messages = await bot.get_forward_msg(id=forward_id)
-        if not forwarded_messages: desc = "[一段已无法打开的空聊天记录]"
-        else:
-            script = [
-                f"{m['sender'].get('card') or m['sender'].get('nickname', '未知')}: "
-                f"{_extract_text_from_raw_message(m.get('content')) or '[非文本消息]'}"
-                for m in forwarded_messages
-            ]
-            desc = f"[一段聊天记录，内容如下：\n---\n{'\n'.join(script)}\n---]"
+        # 【新增】同一份聊天记录被反复提问时，直接使用缓存的解析结果
+        desc = forward_cache.get(forward_id)
+        if desc is None:
+            forwarded_messages = await bot.get_forward_msg(id=forward_id)
+            if not forwarded_messages: desc = "[一段已无法打开的空聊天记录]"
+            else:
+                script = "\n".join(
+                    f"{m['sender'].get('card') or m['sender'].get('nickname', '未知')}: "
+                    f"{_extract_text_from_raw_message(m.get('content')) or '[非文本消息]'}"
+                    for m in forwarded_messages
+                )
+                desc = f"[一段聊天记录，内容如下：\n---\n{script}\n---]"
+                forward_cache.put(forward_id, desc)
         
         user_question = event.get_plaintext().strip()
         prompt = f"请基于以下聊天记录，回答用户的问题。\n\n【聊天记录】\n{desc}\n\n【需要你回答的用户的问题】\n{user_question}"
@@ -253,7 +301,8 @@ async def handle_forwarded_message(bot: Bot, matcher: Matcher, event: MessageEve
 # 【最终修复】恢复原始的、功能正确的 handle_reply_message 逻辑
 async def handle_reply_message(bot: Bot, matcher: Matcher, event: MessageEvent):
     try:
-        replied_msg_info = await bot.get_msg(message_id=event.reply.message_id)
+        # 【新增】先查本地消息索引，记录员刚见过的消息不必再走一次 get_msg
+        replied_msg_info = await message_store.get_message(bot, event.reply.message_id)
         
         # 区分是回复机器人还是回复他人
         if replied_msg_info.get('sender', {}).get('user_id') == int(bot.self_id):
@@ -267,14 +316,28 @@ async def handle_reply_message(bot: Bot, matcher: Matcher, event: MessageEvent):
 
 async def handle_reply_to_bot(bot: Bot, matcher: Matcher, event: MessageEvent, replied_msg_info: dict):
     logger.info("处理对机器人消息的回复...")
+    # 【新增】机器人以合并转发发出的长消息，缓存里有完整原文
+    bot_content_text = forward_cache.get(str(event.reply.message_id))
     # 使用安全的方式提取被回复的机器人消息内容
-    bot_content_text = _extract_text_from_raw_message(replied_msg_info.get('message'))
+    if not bot_content_text: bot_content_text = _extract_text_from_raw_message(replied_msg_info.get('message'))
     if not bot_content_text:
         # 如果机器人发的是图片等，给一个通用描述
         bot_content_text = "[机器人之前发送的一条非文本消息]"
 
+    # 【新增】通过机器人回复索引找到这条发言当时回答的提问，一并交给模型
+    original_question_text = ""
+    if isinstance(event, GroupMessageEvent):
+        question_id = data_store.find_user_question_id_by_bot_response_id(str(event.group_id), event.reply.message_id)
+        if question_id:
+            try:
+                question_msg_info = await message_store.get_message(bot, question_id)
+                original_question_text = _extract_text_from_raw_message(question_msg_info.get('message'))
+            except Exception as e:
+                logger.warning(f"获取原始提问({question_id})失败: {e}")
+
     user_question = event.get_plaintext().strip()
-    prompt = f"这是关于你的一条历史发言的问题。请根据上下文回答用户。\n\n【机器人当时的发言】\n{bot_content_text}\n\n【用户现在的问题】\n{user_question}"
+    question_section = f"【当时用户的提问】\n{original_question_text}\n\n" if original_question_text else ""
+    prompt = f"这是关于你的一条历史发言的问题。请根据上下文回答用户。\n\n{question_section}【机器人当时的发言】\n{bot_content_text}\n\n【用户现在的问题】\n{user_question}"
     
     # 组合成多模态内容发送
     final_content = await build_multimodal_content(event)
@@ -300,19 +363,21 @@ async def handle_reply_to_other(bot: Bot, matcher: Matcher, event: MessageEvent,
     
     if img_url:
         try:
-            # 下载被回复的图片
-            async with httpx.AsyncClient() as c:
-                resp = await c.get(img_url, timeout=60.0)
+            # 【新增】记录员已经为这张图片生成过摘要时直接复用，不再重新下载和分析
+            stored_summary = message_store.get_image_summary(replied_msg_info, img_url)
+            if stored_summary:
+                replied_image_item = {"type": "image_url", "image_url": {"url": img_url}, "summary": stored_summary}
+            else:
+                # 下载被回复的图片
+                resp = await http_client.get_client().get(img_url, timeout=config.IMAGE_DOWNLOAD_TIMEOUT)
                 resp.raise_for_status()
-                img_b64 = base64.b64encode(resp.content).decode()
+                image_ref = await asyncio.to_thread(image_store.put_image, resp.content)
+                replied_image_item = {"type": "image_url", "image_url": {"url": image_ref}}
 
             # 构建多模态内容，包含用户自己的问题和被回复的图片
             content_list = await build_multimodal_content(event)
             # 将被回复的图片数据添加到列表
-            content_list.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-            })
+            content_list.append(replied_image_item)
             
             # 确保有文本部分来承载问题
             text_part = next((p for p in content_list if p.get('type') == 'text'), None)
@@ -365,4 +430,4 @@ active_chat_handler = on_message(priority=99, block=False)
 @active_chat_handler.handle()
 async def _(bot: Bot, event: Event):
     if isinstance(event, GroupMessageEvent): 
-        await handlers.handle_active_chat_check(bot, event)
\ No newline at end of file
+        handlers.schedule_active_chat_check(bot, event)
\ No newline at end of file
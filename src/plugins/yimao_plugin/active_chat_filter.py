@@ -0,0 +1,130 @@
+# yimao_plugin/active_chat_filter.py
+"""
+主动聊天的本地预筛选。
+在调用决策模型之前先给新消息打分，分数低于阈值就不再花一次大模型调用去得到一个 should_reply: false。
+打分由若干可插拔的评分项加权求和：
+- mention: 新消息提到机器人的名字或关键词；
+- question: 新消息是一个提问；
+- topic_shift: 新消息和最近几条消息用词差异大，可能是刚冒头的新话题；
+- reply_rate: 本群过去的决策中模型选择发言的比例 (指数滑动平均)。
+本模块只依赖标准库，scripts/replay_active_chat_filter.py 可以直接加载它，用记录下来的决策离线调整阈值和权重。
+"""
+import json
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("GeminiPlugin.active_chat_filter")
+
+# 评分项：(按时间顺序的最近消息文本，最后一条是新消息, 关键词) -> [0, 1]
+Scorer = Callable[[Sequence[str], Sequence[str]], float]
+SCORERS: Dict[str, Scorer] = {}
+
+def register_scorer(name: str) -> Callable[[Scorer], Scorer]:
+    def decorator(func: Scorer) -> Scorer:
+        SCORERS[name] = func
+        return func
+    return decorator
+
+_QUESTION_MARKS = ("?", "？")
+_QUESTION_WORDS = ("吗", "怎么", "为什么", "为啥", "什么", "如何", "谁", "多少", "能不能", "有没有", "是不是", "哪里", "哪个")
+_IGNORED_CHARS = re.compile(r"[\s\W_]+")
+
+@register_scorer("mention")
+def score_mention(texts: Sequence[str], keywords: Sequence[str]) -> float:
+    new_message = texts[-1].lower()
+    return 1.0 if any(keyword and keyword.lower() in new_message for keyword in keywords) else 0.0
+
+@register_scorer("question")
+def score_question(texts: Sequence[str], keywords: Sequence[str]) -> float:
+    new_message = texts[-1].strip()
+    if new_message.endswith(_QUESTION_MARKS): return 1.0
+    return 0.5 if any(word in new_message for word in _QUESTION_WORDS) else 0.0
+
+def _bigrams(text: str) -> set:
+    text = _IGNORED_CHARS.sub("", text.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+@register_scorer("topic_shift")
+def score_topic_shift(texts: Sequence[str], keywords: Sequence[str]) -> float:
+    """新消息中没有在前面几条消息里出现过的二元组所占的比例。太短的消息不算。"""
+    new_grams = _bigrams(texts[-1])
+    if len(new_grams) < 4 or len(texts) < 2: return 0.0
+    recent_grams = set().union(*(_bigrams(text) for text in texts[:-1]))
+    return 1.0 - len(new_grams & recent_grams) / len(new_grams)
+
+class ReplyRateTracker:
+    """每个群的模型发言比例，用指数滑动平均跟踪最近的决策。"""
+
+    def __init__(self, prior: float, alpha: float):
+        self.prior = prior
+        self.alpha = alpha
+        self._rates: Dict[str, float] = {}
+
+    def get(self, group_id: str) -> float:
+        return self._rates.get(group_id, self.prior)
+
+    def record(self, group_id: str, replied: bool):
+        self._rates[group_id] = (1 - self.alpha) * self.get(group_id) + self.alpha * (1.0 if replied else 0.0)
+
+class ActiveChatPrefilter:
+    def __init__(self, weights: Dict[str, float], threshold: float, keywords: Sequence[str], reply_rate: ReplyRateTracker):
+        self.weights = weights
+        self.threshold = threshold
+        self.keywords = list(keywords)
+        self.reply_rate = reply_rate
+        self.stats: Dict[str, int] = {"evaluated": 0, "skipped": 0, "passed": 0, "decisions": 0, "replies": 0}
+
+    def score(self, group_id: str, texts: Sequence[str], extra_keywords: Sequence[str] = (), new_count: int = 1) -> Tuple[float, Dict[str, float]]:
+        """
+        texts 的最后 new_count 条是上次检查以来的新消息 (去抖会把一串消息合并成一次检查)。
+        每条新消息以它之前的消息为上下文单独打分，取得分最高的一条，这样一串消息中间的提及或提问不会被后面的闲聊盖住。
+        """
+        keywords = self.keywords + [keyword for keyword in extra_keywords if keyword]
+        best_total, best_parts = 0.0, {}
+        for end in range(max(1, len(texts) - new_count + 1), len(texts) + 1):
+            parts = {name: scorer(texts[:end], keywords) for name, scorer in SCORERS.items() if self.weights.get(name)}
+            if self.weights.get("reply_rate"): parts["reply_rate"] = self.reply_rate.get(group_id)
+            total = sum(self.weights[name] * value for name, value in parts.items())
+            if not best_parts or total > best_total: best_total, best_parts = total, parts
+        return best_total, best_parts
+
+    def should_call_llm(self, group_id: str, texts: Sequence[str], extra_keywords: Sequence[str] = (), new_count: int = 1) -> Tuple[bool, float, Dict[str, float]]:
+        """返回 (是否值得调用决策模型, 总分, 各评分项)，同时更新计数。"""
+        self.stats["evaluated"] += 1
+        if not texts:
+            self.stats["skipped"] += 1
+            return False, 0.0, {}
+        total, parts = self.score(group_id, texts, extra_keywords, new_count)
+        passed = total >= self.threshold
+        self.stats["passed" if passed else "skipped"] += 1
+        logger.debug(f"[主动聊天预筛选] 群({group_id}) 得分 {total:.2f} ({', '.join(f'{k}={v:.2f}' for k, v in parts.items())})，{'调用决策模型' if passed else '跳过'}。")
+        return passed, total, parts
+
+    def record_decision(self, group_id: str, should_reply: bool):
+        self.stats["decisions"] += 1
+        if should_reply: self.stats["replies"] += 1
+        self.reply_rate.record(group_id, should_reply)
+
+    def get_stats(self) -> Dict[str, Any]:
+        evaluated = self.stats["evaluated"]
+        return {**self.stats, "avoided_percent": round(self.stats["skipped"] * 100 / evaluated) if evaluated else 0}
+
+def append_decision_log(path: Optional[str], group_id: str, texts: Sequence[str], extra_keywords: Sequence[str],
+                        score: Optional[float], should_reply: bool, new_count: int = 1):
+    """把一次决策模型的判断追加到 JSONL 文件，供离线回放。path 为空时不记录。"""
+    if not path: return
+    entry = {"time": int(time.time()), "group_id": group_id, "texts": list(texts), "new_count": new_count,
+             "keywords": [k for k in extra_keywords if k], "score": score, "should_reply": should_reply}
+    try:
+        log_path = Path(path)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with log_path.open("a", encoding="utf-8") as f: f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning(f"写入主动聊天决策记录失败: {e}")
+
+def load_decision_log(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
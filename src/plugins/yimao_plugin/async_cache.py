@@ -0,0 +1,72 @@
+# yimao_plugin/async_cache.py
+"""
+小型异步缓存工具。
+- TTLCache: 带过期时间和条数上限 (LRU 淘汰) 的内存缓存；
+- SingleFlight: 相同 key 的并发请求合并为一次，所有调用方共享同一个结果 (或同一个异常)。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+class TTLCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None: return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SingleFlight:
+    """
+    do(key, factory) 在没有相同 key 的请求进行中时调用 factory()，否则等待已有的那一个。
+    某个调用方被取消不会影响其他调用方；所有调用方都取消时，底层请求也随之取消。
+    """
+
+    def __init__(self):
+        # key -> [底层任务, 当前等待者数量]
+        self._calls: Dict[Hashable, List[Any]] = {}
+        self.stats: Dict[str, int] = {"calls": 0, "shared": 0}
+
+    def is_running(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, call))
+            self.stats["calls"] += 1
+        else:
+            self.stats["shared"] += 1
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1 and not call[0].done(): call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def _forget(self, key: Hashable, call: List[Any]):
+        if self._calls.get(key) is call: del self._calls[key]
@@ -0,0 +1,168 @@
+# yimao_plugin/concurrency.py
+"""
+对话轮次和 LLM 请求的并发控制。
+- 每个会话一把锁：同一个人连发两条 @ 消息时，后一轮等前一轮写完历史再开始，不会交错写入同一份历史。
+- 全局带优先级的并发上限：网关繁忙时直接 @ 的对话最先拿到名额，
+  主动聊天和后台摘要排在后面，等待过久就放弃，而不是让所有请求一起超时。
+- 按键去抖：同一个群连续来消息时，等安静下来 (或等够最长时间) 再基于最新状态执行一次。
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+import weakref
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.concurrency")
+
+# 优先级从高到低
+PRIORITY_DIRECT = "direct"
+PRIORITY_CHALLENGE = "challenge"
+PRIORITY_ACTIVE_CHAT = "active_chat"
+PRIORITY_SUMMARY = "summary"
+_PRIORITY_ORDER = {PRIORITY_DIRECT: 0, PRIORITY_CHALLENGE: 1, PRIORITY_ACTIVE_CHAT: 2, PRIORITY_SUMMARY: 3}
+
+class LimiterBusyError(Exception):
+    """在允许的等待时间内没有拿到并发名额。"""
+
+class PriorityLimiter:
+    """容量固定的并发限制器。名额释放时交给等待队列中优先级最高 (同级先到先得) 的请求。"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._active = 0
+        self._waiters: List[list] = []
+        self._sequence = itertools.count()
+        self.stats: Dict[str, int] = {"granted": 0, "queued": 0, "gave_up": 0}
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: str, timeout: Optional[float] = None):
+        self.stats["granted"] += 1
+        if self._active < self.capacity and not self.waiting:
+            self._active += 1
+            return
+        self.stats["queued"] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [_PRIORITY_ORDER[priority], next(self._sequence), future])
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 名额已经转交过来了，还回去
+                self.release()
+            self.stats["granted"] -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["gave_up"] += 1
+                raise LimiterBusyError(f"等待 {timeout} 秒仍未获得并发名额 (优先级: {priority})") from None
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # 名额直接转交，_active 不变
+                future.set_result(None)
+                return
+        self._active -= 1
+
+_llm_limiter: Optional[PriorityLimiter] = None
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def get_llm_limiter() -> PriorityLimiter:
+    global _llm_limiter
+    if _llm_limiter is None: _llm_limiter = PriorityLimiter(config.LLM_MAX_CONCURRENT_REQUESTS)
+    return _llm_limiter
+
+@contextlib.asynccontextmanager
+async def llm_slot(priority: str = PRIORITY_DIRECT) -> AsyncIterator[None]:
+    """占用一个 LLM 并发名额。低优先级请求等待超过 LLM_PRIORITY_MAX_WAIT 中的时间会抛出 LimiterBusyError。"""
+    limiter = get_llm_limiter()
+    await limiter.acquire(priority, config.LLM_PRIORITY_MAX_WAIT.get(priority))
+    try:
+        yield
+    finally:
+        limiter.release()
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    """同一会话共用一把锁；没有协程持有或等待时会被自动回收。"""
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _session_locks[session_id] = lock
+    return lock
+
+class _DebounceState:
+    __slots__ = ("first_at", "last_at", "callback", "task", "running", "rerun")
+
+    def __init__(self, now: float, callback: Callable[[], Awaitable[None]]):
+        self.first_at = self.last_at = now
+        self.callback = callback
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+        self.rerun = False
+
+class KeyedDebouncer:
+    """
+    trigger(key, callback) 后，等到 quiet_seconds 内没有新的 trigger、或者距这一批的第一次 trigger 已满 max_delay 秒，
+    才执行最后一次传入的 callback。执行期间又有新的 trigger 时取消这次已经过时的执行、重新等待；
+    但这一批已经等满 max_delay 时不再取消，而是在执行结束后再补一次，避免消息不断时永远得不到结果。
+    """
+
+    def __init__(self, quiet_seconds: float, max_delay: float):
+        self.quiet_seconds = quiet_seconds
+        self.max_delay = max_delay
+        self._states: Dict[str, _DebounceState] = {}
+        self.stats: Dict[str, int] = {"triggers": 0, "runs": 0, "cancelled": 0}
+
+    def trigger(self, key: str, callback: Callable[[], Awaitable[None]]):
+        self.stats["triggers"] += 1
+        now = time.monotonic()
+        state = self._states.get(key)
+        if state is None or state.task is None or state.task.done():
+            state = self._states[key] = _DebounceState(now, callback)
+            state.task = asyncio.create_task(self._run(key, state))
+            return
+        state.callback, state.last_at = callback, now
+        if not state.running: return
+        if now - state.first_at < self.max_delay:
+            state.task.cancel()
+            self.stats["cancelled"] += 1
+            state.running = False
+            state.task = asyncio.create_task(self._run(key, state))
+        else:
+            state.rerun = True
+
+    async def _run(self, key: str, state: _DebounceState):
+        try:
+            while True:
+                delay = min(state.last_at + self.quiet_seconds, state.first_at + self.max_delay) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                state.running = True
+                self.stats["runs"] += 1
+                try:
+                    await state.callback()
+                except Exception as e:
+                    logger.error(f"去抖任务 {key} 执行出错: {e}", exc_info=True)
+                finally:
+                    if state.task is asyncio.current_task(): state.running = False
+                if not state.rerun: break
+                state.rerun = False
+                state.first_at = time.monotonic()
+        finally:
+            if state.task is asyncio.current_task() and self._states.get(key) is state: del self._states[key]
+
+    def pending(self) -> int:
+        return len(self._states)
+
+def get_stats() -> Dict[str, int]:
+    limiter = get_llm_limiter()
+    return {**limiter.stats, "active": limiter._active, "waiting": limiter.waiting, "capacity": limiter.capacity}
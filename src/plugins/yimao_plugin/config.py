@@ -82,27 +82,134 @@ EMOTIONLESS_SYSTEM_PROMPT = """
 NORMAL_CHAT_MAX_LENGTH = 5000
 SLASH_CHAT_MAX_LENGTH = 5000
 
+# --- 【新增】上下文窗口预算 ---
+# 完整历史仍然保存在磁盘上，这里只限制每次发送给模型的部分。超出预算的早期对话会被折叠进插槽的滚动摘要。
+# 各模型的上下文 token 预算 (估算值，包含系统提示词和滚动摘要)
+CONTEXT_TOKEN_BUDGETS = {
+    DEFAULT_MODEL_NAME: 32000,
+    SLASH_COMMAND_MODEL_NAME: 64000,
+}
+# 未在上表中列出的模型使用的默认预算
+CONTEXT_DEFAULT_TOKEN_BUDGET = 32000
+# 触发折叠后，原文保留部分压缩到预算的这个比例，避免每一轮都要重新生成摘要
+CONTEXT_FOLD_TARGET_RATIO = 0.6
+# 无论预算如何，至少原样保留最近的这么多条记录
+CONTEXT_MIN_RECENT_RECORDS = 6
+# 单次折叠最多读入的早期对话 token 数 (生成滚动摘要使用 MODEL_ROUTES["summary"] 的模型)
+CONTEXT_SUMMARY_INPUT_BUDGET = 24000
+CONTEXT_SUMMARY_PROMPT = """你正在维护一段长对话的滚动摘要。下面给出【已有摘要】和【新的早期对话片段】，请把两者合并成一份新的摘要。
+要求：保留用户的身份信息、偏好、做过的约定、尚未完成的事情以及对话中的关键事实和结论；省略寒暄和重复内容；使用中文，不超过800字。
+直接输出摘要正文，不要添加任何前缀或解释。
+
+【已有摘要】
+{old_summary}
+
+【新的早期对话片段】
+{new_records}
+"""
+
+# --- 【新增】工具调用超时（秒） ---
+# 同一轮的多个工具调用并发执行，每个调用单独计时，超时的调用以错误说明作为结果
+TOOL_CALL_TIMEOUTS = {"search_web": 25.0, "search_weather": 20.0}
+TOOL_CALL_DEFAULT_TIMEOUT = 30.0
+
 # --- 工具API配置 ---
 QWEATHER_API_KEY = get_env_variable("QWEATHER_API_KEY")
 QWEATHER_API_HOST = "mv5egka6uk.re.qweatherapi.com"
+# 【新增】天气查询缓存：城市名到地点ID的映射缓存 7 天，天气数据按地点ID缓存 10 分钟
+WEATHER_LOCATION_CACHE_TTL = 7 * 24 * 3600
+WEATHER_DATA_CACHE_TTL = 600
+WEATHER_CACHE_MAX_ENTRIES = 500
 
 # 加载 Google API 凭据
 GOOGLE_API_KEY = get_env_variable("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = get_env_variable("GOOGLE_CSE_ID")
+# 【新增】网页搜索结果缓存：相同 (规范化后) 的查询在有效期内直接复用结果，不消耗配额
+GOOGLE_SEARCH_CACHE_TTL = 6 * 3600
+GOOGLE_SEARCH_CACHE_MAX_ENTRIES = 1000
+# 每日配额 (Custom Search 免费额度为 100 次/天)，用完后不再请求，避免收到 429
+GOOGLE_SEARCH_DAILY_QUOTA = 100
+GOOGLE_SEARCH_QUOTA_FILE_PATH = "data/yimao_search_quota.json"
+GOOGLE_SEARCH_TIMEOUT = 20.0
 
 # 【新增】加载代理配置
 HTTP_PROXY = os.getenv("HTTP_PROXY")
 HTTPS_PROXY = os.getenv("HTTPS_PROXY")
 
+# --- 【新增】HTTP 连接池配置 ---
+# 是否对 new-api 网关启用 HTTP/2 (需要安装 h2，未安装时自动退回 HTTP/1.1 keep-alive)
+LLM_GATEWAY_HTTP2 = True
+# 与网关之间的最大连接数
+LLM_GATEWAY_MAX_CONNECTIONS = 20
+# 其他外部请求 (图片下载、天气、短链接等) 的连接数上限
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+# 空闲连接保活时间（秒）
+HTTP_KEEPALIVE_EXPIRY = 60.0
+# 超时设置（秒）
+HTTP_CONNECT_TIMEOUT = 10.0
+HTTP_DEFAULT_TIMEOUT = 30.0
+LLM_REQUEST_TIMEOUT = 180.0
+VISION_REQUEST_TIMEOUT = 300.0
+IMAGE_DOWNLOAD_TIMEOUT = 60.0
+# 【新增】同时进行的 LLM 请求上限 (所有会话共享)。名额按优先级分配：直接 @ > 猜病挑战 > 主动聊天 > 群摘要
+LLM_MAX_CONCURRENT_REQUESTS = 8
+# 各优先级排队等待名额的最长时间（秒），超时则放弃本次请求；不在这里的优先级会一直等
+LLM_PRIORITY_MAX_WAIT = {"active_chat": 20.0, "summary": 120.0}
+# 【新增】LLM 请求的重试策略：指数退避 + 随机抖动，服务端返回 Retry-After 时以它为准
+LLM_RETRY_MAX_ATTEMPTS = 5
+LLM_RETRY_BASE_DELAY = 0.5
+LLM_RETRY_MAX_DELAY = 10.0
+# 单个请求 (含所有重试) 的总截止时间（秒）
+LLM_RETRY_DEADLINE = 240.0
+# 视觉请求 (图片摘要/图片问答) 的重试次数和总截止时间
+VISION_RETRY_MAX_ATTEMPTS = 3
+VISION_RETRY_DEADLINE = 300.0
+# 熔断器：同一模型连续失败这么多次后，在冷却时间内直接失败
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30.0
+
+# --- 【新增】图片摘要并发控制 ---
+# 全局同时进行的图片摘要请求上限 (所有群和会话共享)
+IMAGE_SUMMARY_MAX_CONCURRENCY = 10
+# 单张图片摘要的超时时间（秒），超时后该图片记为分析失败，不影响同一条消息里的其他图片
+IMAGE_SUMMARY_TIMEOUT = 90.0
+# 【新增】图片摘要缓存 (按图片内容哈希 + 模型名)，重复出现的表情包不再重复调用视觉模型
+IMAGE_SUMMARY_CACHE_PATH = "data/yimao_image_summaries.db"
+# 磁盘上最多保留的摘要条数，超出后按最近使用时间淘汰
+IMAGE_SUMMARY_CACHE_MAX_ENTRIES = 50000
+# 内存中热点摘要的条数
+IMAGE_SUMMARY_CACHE_MEMORY_ENTRIES = 2000
+# 【新增】群聊记录中的图片由后台队列生成摘要，记录员不再等待。队列满时丢弃最早排队的图片
+GROUP_IMAGE_QUEUE_MAX_SIZE = 200
+GROUP_IMAGE_QUEUE_WORKERS = 4
+# 【新增】群成员显示名 (群名片/昵称) 缓存的有效期（秒），过期后由消息事件、名片变更通知或一次查询刷新
+MEMBER_NAME_CACHE_TTL = 6 * 3600
+# 【新增】本地消息索引保留的最近消息条数 (群聊记录和机器人自己发出的消息)，处理引用回复时优先查这里
+MESSAGE_STORE_MAX_ENTRIES = 5000
+# 【新增】机器人回复 message_id -> 对应提问的索引最多保留的条数，超出后淘汰最早的回复
+BOT_RESPONSE_INDEX_MAX_ENTRIES = 20000
+# 【新增】合并转发内容缓存：内存中按字节数限制的 LRU，同时写入 SQLite 以便重启后仍能命中；路径留空则只缓存在内存中
+FORWARD_CACHE_PATH = "data/yimao_forward_cache.db"
+FORWARD_CACHE_MEMORY_BYTES = 8 * 1024 * 1024
+FORWARD_CACHE_DISK_MAX_ENTRIES = 20000
+
 # 触发合并转发的阈值 (大于这个值就使用合并转发)
 FORWARD_TRIGGER_THRESHOLD = 200
 
 # 合并转发内部，每个节点的分割字数
 FORWARD_NODE_CHUNK_SIZE = 2000
 
+# 【新增】使用流式响应的对话模式。回复超过一个转发节点时，每攒够 FORWARD_NODE_CHUNK_SIZE 字就先发出一条合并转发
+STREAMING_RESPONSE_MODES = ["slash"]
+
 
 # --- 持久化记忆配置 ---
 MEMORY_FILE_PATH = "data/yimao_memory.json"
+# 【新增】增量记忆数据库 (SQLite)。旧的 JSON 文件仅在数据库为空时导入一次，之后作为导出格式使用。
+MEMORY_DB_PATH = "data/yimao_memory.db"
+# 【新增】图片按内容哈希去重存放的目录，对话历史中只保存引用
+IMAGE_STORE_DIR = "data/image_blobs"
 MEMORY_SLOTS_PER_USER = 10 # <-- 恢复这一行
 
 
@@ -125,6 +232,31 @@ ACTIVE_CHAT_MESSAGE_THRESHOLD = 10
 # 主动聊天决策模型 (建议使用一个快速且便宜的模型)
 ACTIVE_CHAT_DECISION_MODEL = "gemini-1.5-pro" 
 
+# 【新增】两级决策：先由快速模型只判断要不要说话 (只输出 should_reply)，决定说话时才由 ACTIVE_CHAT_DECISION_MODEL 生成回复内容。
+# 关闭时退回到由 ACTIVE_CHAT_DECISION_MODEL 一次给出判断和回复。
+ACTIVE_CHAT_TWO_TIER = True
+ACTIVE_CHAT_FAST_DECISION_MODEL = "gemini-2.0-flash"
+# 【新增】请求网关以 JSON 模式输出 (OpenAI 的 response_format)；网关不支持 (返回 400) 时自动改为普通输出
+ACTIVE_CHAT_JSON_MODE = True
+
+# 【新增】主动聊天去抖：群里连续 QUIET 秒没有新消息 (或距这一批第一条消息已满 MAX_DELAY 秒) 时才做一次决策
+ACTIVE_CHAT_DEBOUNCE_QUIET_SECONDS = 8
+ACTIVE_CHAT_DEBOUNCE_MAX_DELAY = 30
+
+# 【新增】主动聊天本地预筛选：先给新消息打分 (提及/关键词、提问、话题转换、本群历史发言率)，低于阈值就不调用决策模型
+ACTIVE_CHAT_PREFILTER_ENABLED = True
+ACTIVE_CHAT_PREFILTER_THRESHOLD = 0.5
+ACTIVE_CHAT_PREFILTER_WEIGHTS = {"mention": 1.0, "question": 0.6, "topic_shift": 0.4, "reply_rate": 0.5}
+# 除机器人昵称外，提到这些词也视为在叫机器人
+ACTIVE_CHAT_PREFILTER_KEYWORDS = ["一猫", "猫猫", "机器人", "bot"]
+# 话题转换参考的最近消息条数 (不含新消息)
+ACTIVE_CHAT_PREFILTER_WINDOW = 10
+# 本群发言率的初始值和滑动平均系数
+ACTIVE_CHAT_REPLY_RATE_PRIOR = 0.3
+ACTIVE_CHAT_REPLY_RATE_ALPHA = 0.1
+# 每次调用决策模型的输入和结论追加到这里，供 scripts/replay_active_chat_filter.py 离线调参；留空则不记录
+ACTIVE_CHAT_DECISION_LOG_PATH = "data/yimao_active_chat_decisions.jsonl"
+
 # 这是核心：用于决策的系统提示词
 ACTIVE_CHAT_DECISION_PROMPT = """
 # --- 角色与使命 ---
@@ -212,6 +344,16 @@ ACTIVE_CHAT_DECISION_PROMPT = """
 (判断：这只是ID为99999的一个用户在打招呼，没有提供帮助的机会，保持沉默。)
 """
 
+# 【新增】两级决策时附加在决策提示词之后，分别用于第一步 (只做判断) 和第二步 (生成回复)
+ACTIVE_CHAT_DECISION_ONLY_SUFFIX = """
+# 本次任务 (优先于上面的输出要求)：
+只判断是否应该发言，不要写回复内容。返回的 JSON 对象只包含 `should_reply` 一个键，例如 {"should_reply": false}。
+"""
+ACTIVE_CHAT_REPLY_SUFFIX = """
+# 本次任务 (优先于上面的输出要求)：
+你已经判断过，现在应该发言。`should_reply` 固定为 true，在 `reply_content` 中写出要发送的内容。
+"""
+
 
 # --- 猜病挑战配置 ---
 CHALLENGE_MODEL_NAME = "gemini-2.0-flash"
@@ -322,4 +464,25 @@ CHALLENGE_SYSTEM_PROMPT = """
     -   玩家输入: `#你是一个AI吗？`
     -   你的回应:
         > 你突然停下了手中的动作，对着空气小声嘀咕了一句“你是一个AI吗？”。正在不远处擦拭杯子的夜月闻言，冷冷地瞥了他一眼，眼神里充满了看怪人似的的费解，然后继续专注于自己的工作，仿佛他只是个无聊的疯子。
-"""
\ No newline at end of file
+"""
+
+# --- 【新增】模型路由 ---
+# 每种用途按顺序尝试的模型列表：前一个模型出错 (或熔断) 时改用下一个。
+# hedge 为 True 的用途在主模型迟迟没有返回时，会向下一个模型并行发出第二个请求，先返回的结果胜出，另一个被取消。
+MODEL_ROUTES = {
+    "chat": {"models": [DEFAULT_MODEL_NAME, SLASH_COMMAND_MODEL_NAME], "hedge": True},
+    "slash": {"models": [SLASH_COMMAND_MODEL_NAME, DEFAULT_MODEL_NAME], "hedge": False},
+    "challenge": {"models": [CHALLENGE_MODEL_NAME, DEFAULT_MODEL_NAME], "hedge": True},
+    "active_chat": {"models": [ACTIVE_CHAT_FAST_DECISION_MODEL, ACTIVE_CHAT_DECISION_MODEL] if ACTIVE_CHAT_TWO_TIER else [ACTIVE_CHAT_DECISION_MODEL, DEFAULT_MODEL_NAME], "hedge": True},
+    # 两级决策的第二步：生成主动发言的内容
+    "active_chat_reply": {"models": [ACTIVE_CHAT_DECISION_MODEL, DEFAULT_MODEL_NAME], "hedge": True},
+    "summary": {"models": [DEFAULT_MODEL_NAME, SLASH_COMMAND_MODEL_NAME], "hedge": False},
+}
+# 对冲请求的等待时间取主模型最近成功请求耗时的 P95，并限制在下面的范围内；样本不足时使用默认值
+HEDGE_LATENCY_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 15.0
+HEDGE_MIN_DELAY = 3.0
+HEDGE_MAX_DELAY = 60.0
+# 每个模型保留的最近耗时样本数
+HEDGE_LATENCY_WINDOW = 200
@@ -0,0 +1,171 @@
+# yimao_plugin/context_window.py
+"""
+按模型的 token 预算组装发送给 LLM 的上下文窗口。
+最近的对话原样保留，超出预算的早期对话由 LLM 折叠进插槽的滚动摘要 (MemorySlot.context_summary)。
+完整历史依然保存在记忆数据库里，这里只决定“发送哪些”。
+
+每个插槽维护一份与历史记录一一对应的缓存条目 [记录, token 估算, 指纹, 压缩后的 API 消息]，
+新记录追加时才计算，因此每轮构建上下文的开销只与新增记录数有关。
+"""
+import hashlib
+import itertools
+import logging
+import re
+from typing import Any, Callable, Deque, Dict, List, Sequence
+
+from . import concurrency, config, data_store, llm_client
+from .data_store import MemorySlot
+
+logger = logging.getLogger("GeminiPlugin.context")
+
+# 未生成摘要的图片按 Gemini 的单图开销估算
+IMAGE_TOKEN_COST = 258
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token。"""
+    if not text: return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+def _record_text(record: Dict[str, Any], with_image_summary: bool = True) -> str:
+    content = record.get("content")
+    if isinstance(content, str): return content
+    if not isinstance(content, list): return ""
+    parts = []
+    for item in content:
+        if item.get("type") == "text": parts.append(item.get("text", ""))
+        elif item.get("type") in ("image_url", "image"):
+            summary = item.get("summary")
+            parts.append(f"[图片: {summary}]" if with_image_summary and summary else "[图片]")
+    return " ".join(parts)
+
+def estimate_record_tokens(record: Dict[str, Any]) -> int:
+    tokens = 4
+    content = record.get("content")
+    if isinstance(content, list):
+        for item in content:
+            if item.get("type") == "text": tokens += estimate_text_tokens(item.get("text", ""))
+            elif item.get("type") in ("image_url", "image"):
+                tokens += estimate_text_tokens(item["summary"]) if item.get("summary") else IMAGE_TOKEN_COST
+    elif isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    for tool_call in record.get("tool_calls") or []:
+        tokens += 8 + estimate_text_tokens(tool_call.get("function", {}).get("arguments", ""))
+    return tokens
+
+def record_fingerprint(record: Dict[str, Any]) -> str:
+    """
+    记录指纹，用来在历史中定位折叠边界。
+    有消息 ID 或工具调用 ID 时只用这些不会变化的字段；都没有时才退回到文本 (不含图片摘要，因为摘要可能在记录写入后才被补上)。
+    """
+    if record.get("message_id") is not None or record.get("tool_call_id") is not None:
+        key = f"{record.get('role')}|{record.get('message_id')}|{record.get('tool_call_id')}"
+    else:
+        key = f"{record.get('role')}|{_record_text(record, with_image_summary=False)}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+# 缓存条目中各字段的下标
+ENTRY_RECORD, ENTRY_TOKENS, ENTRY_FINGERPRINT, ENTRY_COMPRESSED = range(4)
+
+def sync_cache(cache: Deque[list], history: Sequence[Dict[str, Any]]):
+    """让缓存与历史队列重新对齐，只为新追加的记录计算 token 和指纹。"""
+    _, new_records = data_store.align_with_history(cache, history, lambda entry: entry[ENTRY_RECORD])
+    for record in new_records:
+        cache.append([record, estimate_record_tokens(record), record_fingerprint(record), None])
+
+def get_token_budget(model: str) -> int:
+    return config.CONTEXT_TOKEN_BUDGETS.get(model, config.CONTEXT_DEFAULT_TOKEN_BUDGET)
+
+def _render_records_for_summary(records: Sequence[Dict[str, Any]]) -> str:
+    lines = []
+    for record in records:
+        role = record.get("role")
+        text = _record_text(record).strip()
+        if role == "user": lines.append(f"用户: {text}")
+        elif role == "assistant" and text: lines.append(f"助手: {text}")
+        elif role == "tool": lines.append(f"[工具 {record.get('name', '')} 的结果]: {text[:500]}")
+    return "\n".join(lines)
+
+async def _fold_into_summary(old_summary: str, records: Sequence[Dict[str, Any]]) -> str:
+    # 折叠的输入本身也要受预算限制：只取最靠近窗口的那部分，更早的直接放弃
+    kept, tokens = [], 0
+    for record in reversed(records):
+        tokens += estimate_record_tokens(record)
+        if tokens > config.CONTEXT_SUMMARY_INPUT_BUDGET and kept: break
+        kept.append(record)
+    if len(kept) < len(records):
+        logger.warning(f"待折叠的早期对话过长，仅将最近的 {len(kept)}/{len(records)} 条并入滚动摘要。")
+    prompt = config.CONTEXT_SUMMARY_PROMPT.format(
+        old_summary=old_summary or "（无）", new_records=_render_records_for_summary(list(reversed(kept))))
+    api_response = await llm_client.call_model_route(
+        "summary", messages=[{"role": "user", "content": prompt}], system_prompt_content="",
+        use_tools=False, priority=concurrency.PRIORITY_SUMMARY)
+    if "error" in api_response: raise RuntimeError(api_response["error"].get("message", "发生未知错误"))
+    new_summary = (api_response["choices"][0]["message"].get("content") or "").strip()
+    # 空结果同样视为失败，否则会用空摘要覆盖旧摘要并推进折叠标记
+    if not new_summary: raise RuntimeError("模型返回了空的摘要")
+    return new_summary
+
+async def prepare_window(history: Sequence[Dict[str, Any]], cache: Deque[list], slot: MemorySlot, model: str, system_prompt: str) -> int:
+    """
+    返回应当原样发送的第一条记录的下标。
+    如果未折叠部分超出预算，会先把较早的记录并入 slot 的滚动摘要并推进折叠标记。
+    """
+    sync_cache(cache, history)
+    total = len(cache)
+    available = get_token_budget(model) - estimate_text_tokens(system_prompt) - estimate_text_tokens(slot.context_summary)
+    # 从最新的记录往回扫描，直到遇到上次折叠后保留的第一条记录
+    suffix_tokens: Dict[int, int] = {total: 0}
+    boundary, tokens = 0, 0
+    for i, entry in zip(range(total - 1, -1, -1), reversed(cache)):
+        tokens += entry[ENTRY_TOKENS]
+        suffix_tokens[i] = tokens
+        if slot.context_marker and entry[ENTRY_FINGERPRINT] == slot.context_marker:
+            boundary = i
+            break
+    if tokens <= available: return boundary
+
+    records = [entry[ENTRY_RECORD] for entry in itertools.islice(cache, boundary, None)]
+    # 只能在用户消息处切分，避免把工具调用和它的结果拆开
+    user_indices = [boundary + i for i, record in enumerate(records) if record.get("role") == "user"]
+    if not user_indices: return boundary
+    target = available * config.CONTEXT_FOLD_TARGET_RATIO
+    new_start = next((i for i in user_indices if suffix_tokens[i] <= target), user_indices[-1])
+    for i in reversed(user_indices):
+        if i >= new_start: continue
+        if total - new_start >= config.CONTEXT_MIN_RECENT_RECORDS or suffix_tokens[i] > available: break
+        new_start = i
+    if new_start <= boundary: return boundary
+
+    logger.info(f"上下文超出预算 (约 {tokens} / {available} tokens)，正在将 {new_start - boundary} 条早期记录折叠进滚动摘要...")
+    try:
+        new_summary = await _fold_into_summary(slot.context_summary, records[:new_start - boundary])
+        slot.context_summary = new_summary
+        slot.context_marker = cache[new_start][ENTRY_FINGERPRINT]
+        logger.info(f"滚动摘要已更新，长度: {len(new_summary)}")
+    except Exception as e:
+        # 摘要失败时本轮仍然只发送预算内的部分，下一轮会重新尝试折叠
+        logger.error(f"生成滚动摘要失败: {e}", exc_info=True)
+    return new_start
+
+def build_summary_preamble(summary: str) -> str:
+    return f"[更早对话的摘要]\n{summary}\n\n---\n\n"
+
+def rewrite_message_text(message: Dict[str, Any], rewrite: Callable[[str], str], insert_if_missing: bool = False):
+    """改写消息的 (第一段) 文本。列表内容先复制再改，不修改与历史记录和压缩缓存共享的内容对象。"""
+    content = message.get("content")
+    if isinstance(content, str):
+        message["content"] = rewrite(content)
+    elif isinstance(content, list):
+        new_content = [dict(item) for item in content]
+        text_part = next((item for item in new_content if item.get("type") == "text"), None)
+        if text_part: text_part["text"] = rewrite(text_part.get("text", ""))
+        elif insert_if_missing: new_content.insert(0, {"type": "text", "text": rewrite("")})
+        else: return
+        message["content"] = new_content
+
+def prefix_first_message(messages_for_api: List[Dict[str, Any]], prefix: str):
+    """给第一条消息的文本加前缀。"""
+    if not messages_for_api: return
+    rewrite_message_text(messages_for_api[0], lambda text: prefix + text, insert_if_missing=True)
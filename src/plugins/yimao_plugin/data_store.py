@@ -2,14 +2,15 @@
 import json
 import logging
 import os
-from collections import deque
+from collections import OrderedDict, deque
 from pathlib import Path
 import time
-from typing import Dict, List, Deque, Optional, Tuple, Any
+from typing import Callable, Dict, List, Deque, Optional, Tuple, Any
 
 from pydantic import BaseModel, Field
 
-from . import config
+from . import config, image_store, memory_db
+from .group_history import GroupMessage
 
 logger = logging.getLogger("GeminiPlugin.datastore")
 
@@ -17,6 +18,9 @@ logger = logging.getLogger("GeminiPlugin.datastore")
 class MemorySlot(BaseModel):
     summary: str = "（空插槽）"
     history: List[Dict] = Field(default_factory=list)
+    # 【新增】滚动摘要：超出上下文预算而被折叠的早期对话，以及折叠后第一条原样保留的记录 (用户消息) 的指纹
+    context_summary: str = ""
+    context_marker: str = ""
 
     @property
     def is_empty(self) -> bool:
@@ -38,19 +42,29 @@ _history_deques: Dict[str, Dict[str, Dict[int, deque]]] = {}
 _challenge_histories: Dict[str, Deque[Dict]] = {}
 _group_summaries: Dict[str, str] = {}
 _group_message_counters: Dict[str, int] = {}
-# 【修复】将 Deque[str] 修改为 Deque[Dict]，以匹配实际存储的数据类型
-_group_chat_history: Dict[str, Deque[Dict[str, Any]]] = {}
+# 【修改】群消息记录改为紧凑的 GroupMessage 对象，见 group_history
+_group_chat_history: Dict[str, Deque[GroupMessage]] = {}
 _group_cooldown_timers: Dict[str, float] = {}
 _group_active_chat_message_counts: Dict[str, int] = {}
-_forward_content_cache: Dict[int, str] = {}
 _challenge_char_counts: Dict[str, int] = {}
 _challenge_victory_leaderboard: Dict[str, List[Dict]] = {}
 _restart_confirm_sessions: Dict[str, Tuple[float, str]] = {}
+# 【新增】记忆数据库中已落盘的记录 (行号, 记录对象)，与 _history_deques 中的顺序一一对应
+_persisted_rows: Dict[Tuple[str, str, int], Deque[Tuple[int, Dict]]] = {}
+# 需要整槽重写的插槽 (例如记录内容被原地修改过)
+_dirty_slots: set = set()
+# 【新增】每个插槽的上下文构建缓存，条目与历史记录一一对应，详见 context_window
+_context_caches: Dict[Tuple[str, str, int], Deque[list]] = {}
+# 【新增】机器人回复的 message_id -> (会话, 模式, 插槽, 对应提问的 message_id)，按登记顺序淘汰
+_bot_response_index: "OrderedDict[int, Tuple[str, str, int, int]]" = OrderedDict()
 
 # 文件持久化
 def _get_memory_path() -> Path:
     return Path(config.MEMORY_FILE_PATH)
 
+def _get_memory_db_path() -> Path:
+    return Path(config.MEMORY_DB_PATH)
+
 def _get_group_summary_path() -> Path:
     return Path(config.MEMORY_FILE_PATH).parent / "yimao_group_summaries.json"
 
@@ -74,6 +88,7 @@ def load_memory_from_file():
                 _history_deques[session_id]["normal"][i] = deque(slot.history, maxlen=config.NORMAL_CHAT_MAX_LENGTH)
             for i, slot in enumerate(user_mem.slash.slots):
                 _history_deques[session_id]["slash"][i] = deque(slot.history, maxlen=config.SLASH_CHAT_MAX_LENGTH)
+        rebuild_bot_response_index()
         logger.info(f"成功从 {path} 加载了 {len(_user_memory_data)} 位用户的分层记忆。")
     except Exception as e:
         logger.error(f"加载记忆文件 {path} 失败: {e}。将创建备份并开始新的记忆。")
@@ -127,8 +142,13 @@ def load_challenge_leaderboard_from_file():
         _challenge_victory_leaderboard = {}
 
 def save_memory_to_file():
-    path = _get_memory_path()
-    path.parent.mkdir(parents=True, exist_ok=True)
+    write_memory_snapshot(snapshot_memory())
+
+def snapshot_memory() -> Dict[str, Dict]:
+    """
+    把全部会话的记忆转换成可以直接序列化的普通字典。必须在事件循环中调用：
+    历史队列和其中的记录会被对话轮次原地修改，.dict() 得到的是与运行时数据互不共享的副本。
+    """
     data_to_save = {}
     for session_id, user_mem in _user_memory_data.items():
         if session_id in _history_deques:
@@ -141,9 +161,129 @@ def save_memory_to_file():
                     if i in _history_deques[session_id]["slash"]:
                         slot.history = list(_history_deques[session_id]["slash"][i])
         data_to_save[session_id] = user_mem.dict()
+    return data_to_save
+
+def write_memory_snapshot(data_to_save: Dict[str, Dict]):
+    """序列化并写入 snapshot_memory 的结果，不访问运行时数据，可以放到线程里执行。"""
+    path = _get_memory_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
     try: path.write_text(json.dumps(data_to_save, ensure_ascii=False, indent=2), "utf-8")
     except Exception as e: logger.error(f"保存记忆至 {path} 时出错: {e}", exc_info=True)
 
+# --- 【新增】增量记忆存储 (SQLite) ---
+# JSON 文件只作为导入/导出格式，日常每轮对话只向数据库追加新记录。
+def open_memory_store():
+    memory_db.open_db(_get_memory_db_path())
+    if memory_db.is_empty():
+        if _get_memory_path().exists():
+            logger.info("记忆数据库为空，正在从旧的 JSON 记忆文件导入...")
+            load_memory_from_file()
+            _externalize_inline_images()
+            for session_id in list(_user_memory_data):
+                for mode in ("normal", "slash"):
+                    for slot_index in _history_deques[session_id][mode]:
+                        _dirty_slots.add((session_id, mode, slot_index))
+                persist_session(session_id)
+            logger.info(f"已将 {len(_user_memory_data)} 位用户的记忆导入数据库。")
+    else:
+        _load_memory_from_db()
+        changed_sessions = _externalize_inline_images()
+        for session_id in changed_sessions: persist_session(session_id)
+        if changed_sessions: memory_db.vacuum()
+
+def _externalize_inline_images() -> set:
+    """把旧记录里内嵌的 base64 图片转存到图片仓库，历史中只留下引用，返回被修改的会话。"""
+    changed_sessions = set()
+    for session_id, mode, slot_index, history in iter_all_histories():
+        slot_changed = False
+        for record in history:
+            if image_store.externalize_record(record): slot_changed = True
+        if slot_changed:
+            mark_slot_dirty(session_id, mode, slot_index)
+            changed_sessions.add(session_id)
+    if changed_sessions: logger.info(f"已将 {len(changed_sessions)} 个会话中内嵌的图片转存到图片仓库。")
+    return changed_sessions
+
+def _load_memory_from_db():
+    active_slots, summaries, records = memory_db.load_all()
+    for session_id, modes in active_slots.items():
+        user_mem = _get_or_create_user_memory(session_id)
+        for mode, active_index in modes.items():
+            mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+            if 0 <= active_index < config.MEMORY_SLOTS_PER_USER: mode_mem.active_slot_index = active_index
+            for i, slot in enumerate(mode_mem.slots):
+                if (session_id, mode, i) in summaries:
+                    slot.summary, slot.context_summary, slot.context_marker = summaries[(session_id, mode, i)]
+    for (session_id, mode, slot_index), rows in records.items():
+        if session_id not in _history_deques or slot_index >= config.MEMORY_SLOTS_PER_USER: continue
+        maxlen = config.NORMAL_CHAT_MAX_LENGTH if mode == "normal" else config.SLASH_CHAT_MAX_LENGTH
+        _history_deques[session_id][mode][slot_index] = deque((record for _, record in rows), maxlen=maxlen)
+        _persisted_rows[(session_id, mode, slot_index)] = deque(rows)
+    rebuild_bot_response_index()
+    logger.info(f"成功从记忆数据库加载了 {len(_user_memory_data)} 位用户的分层记忆。")
+
+def close_memory_store():
+    if not memory_db.is_open(): return
+    for session_id in list(_user_memory_data):
+        persist_session(session_id)
+    memory_db.close_db()
+
+def mark_slot_dirty(session_id: str, mode: str, slot_index: int):
+    """记录被原地修改后调用，下次落盘时整槽重写。"""
+    _dirty_slots.add((session_id, mode, slot_index))
+
+def align_with_history(entries: deque, history: deque, record_of: Callable[[Any], Dict]) -> Tuple[List[Any], List[Dict]]:
+    """
+    让按记录对象跟踪的 entries 与 history 重新对齐，返回 (被移除的条目, 尚未跟踪的新记录)。
+    历史队列只会在右侧追加/弹出、在左侧因 maxlen 淘汰，所以只需比对两端。
+    """
+    removed = []
+    if not history:
+        removed.extend(entries)
+        entries.clear()
+        return removed, []
+    head = history[0]
+    while entries and record_of(entries[0]) is not head:
+        removed.append(entries.popleft())
+    while entries and (len(entries) > len(history) or record_of(entries[-1]) is not history[len(entries) - 1]):
+        removed.append(entries.pop())
+    return removed, [history[i] for i in range(len(entries), len(history))]
+
+def _sync_slot(session_id: str, mode: str, slot_index: int, history: deque):
+    key = (session_id, mode, slot_index)
+    rows = _persisted_rows.setdefault(key, deque())
+    if key in _dirty_slots or not history:
+        _dirty_slots.discard(key)
+        if not rows and not history: return
+        new_records = list(history)
+        new_ids = memory_db.apply_slot_changes(session_id, mode, slot_index, [], new_records, clear=True)
+        _persisted_rows[key] = deque(zip(new_ids, new_records))
+        return
+    removed_rows, new_records = align_with_history(rows, history, lambda row: row[1])
+    delete_ids = [row_id for row_id, _ in removed_rows]
+    if not delete_ids and not new_records: return
+    new_ids = memory_db.apply_slot_changes(session_id, mode, slot_index, delete_ids, new_records)
+    rows.extend(zip(new_ids, new_records))
+
+def persist_session(session_id: str):
+    """把一个会话自上次落盘以来的变化写入数据库，开销只与新增记录数有关。"""
+    if session_id not in _user_memory_data or not memory_db.is_open(): return
+    user_mem = _user_memory_data[session_id]
+    try:
+        for mode in ("normal", "slash"):
+            mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+            memory_db.save_mode_state(session_id, mode, mode_mem.active_slot_index, [(i, slot.summary, slot.context_summary, slot.context_marker) for i, slot in enumerate(mode_mem.slots)])
+            for slot_index, history in _history_deques[session_id][mode].items():
+                _sync_slot(session_id, mode, slot_index, history)
+    except Exception as e:
+        logger.error(f"保存会话 {session_id} 的记忆至数据库时出错: {e}", exc_info=True)
+
+def iter_all_histories():
+    for session_id, modes in _history_deques.items():
+        for mode, slots in modes.items():
+            for slot_index, history_deque in slots.items():
+                yield session_id, mode, slot_index, history_deque
+
 def save_group_summaries_to_file():
     path = _get_group_summary_path()
     path.parent.mkdir(parents=True, exist_ok=True)
@@ -165,18 +305,7 @@ def save_challenge_leaderboard_to_file():
     try: path.write_text(json.dumps(_challenge_victory_leaderboard, ensure_ascii=False, indent=2), "utf-8")
     except Exception as e: logger.error(f"保存猜病游戏排行榜至 {path} 时出错: {e}", exc_info=True)
 
-def cache_forward_content(message_id: int, content: str):
-    if len(_forward_content_cache) > 500:
-        _forward_content_cache.pop(next(iter(_forward_content_cache)))
-    _forward_content_cache[message_id] = content
-    logger.info(f"已缓存合并转发消息 {message_id} 的内容。")
-
-def get_forward_content_from_cache(message_id: int) -> Optional[str]:
-    content = _forward_content_cache.get(message_id)
-    if content: logger.info(f"从缓存中命中合并转发消息 {message_id} 的内容。")
-    return content
-
-def get_group_history(group_id: str) -> Deque[Dict[str, Any]]:
+def get_group_history(group_id: str) -> Deque[GroupMessage]:
     if group_id not in _group_chat_history: _group_chat_history[group_id] = deque(maxlen=config.GROUP_HISTORY_MAX_LENGTH)
     return _group_chat_history[group_id]
 
@@ -188,6 +317,13 @@ def check_and_set_cooldown(group_id: str) -> bool:
         return True
     return False
 
+def is_in_cooldown(group_id: str) -> bool:
+    """只查询，不像 check_and_set_cooldown 那样刷新计时。"""
+    return time.time() - _group_cooldown_timers.get(group_id, 0) <= config.ACTIVE_CHAT_COOLDOWN
+
+def clear_cooldown(group_id: str):
+    _group_cooldown_timers.pop(group_id, None)
+
 def get_or_create_challenge_history(session_id: str) -> Deque[Dict]:
     if session_id not in _challenge_histories: _challenge_histories[session_id] = deque(maxlen=config.CHALLENGE_CHAT_MAX_LENGTH)
     return _challenge_histories[session_id]
@@ -214,6 +350,19 @@ def get_active_history(session_id: str, mode: str) -> deque:
          _history_deques[session_id][mode][active_index] = deque(maxlen=config.NORMAL_CHAT_MAX_LENGTH if mode == "normal" else config.SLASH_CHAT_MAX_LENGTH)
     return _history_deques[session_id][mode][active_index]
 
+def get_active_slot(session_id: str, mode: str) -> MemorySlot:
+    user_mem = _get_or_create_user_memory(session_id)
+    mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+    return mode_mem.slots[mode_mem.active_slot_index]
+
+def get_context_cache(session_id: str, mode: str) -> Deque[list]:
+    user_mem = _get_or_create_user_memory(session_id)
+    mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+    return _context_caches.setdefault((session_id, mode, mode_mem.active_slot_index), deque())
+
+def _drop_context_cache(session_id: str, mode: str, slot_index: int):
+    _context_caches.pop((session_id, mode, slot_index), None)
+
 def get_active_chat_message_count(group_id: str) -> int:
     return _group_active_chat_message_counts.get(group_id, 0)
 
@@ -231,7 +380,7 @@ def update_slot_summary_if_needed(session_id: str, mode: str, prompt: str):
     user_mem = _get_or_create_user_memory(session_id)
     mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
     active_slot = mode_mem.slots[mode_mem.active_slot_index]
-    if active_slot.is_empty:
+    if not get_active_history(session_id, mode):
         active_slot.summary = (prompt[:30] + '...') if len(prompt) > 30 else prompt
 
 def get_memory_summary_list(session_id: str, mode: str) -> str:
@@ -251,6 +400,8 @@ def set_active_slot(session_id: str, mode: str, slot_index: int) -> tuple[bool,
         return False, f"无效的插槽编号。请输入 1-{config.MEMORY_SLOTS_PER_USER} 之间的数字。"
     user_mem = _get_or_create_user_memory(session_id)
     mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+    # 切换插槽时释放旧插槽的上下文缓存，下次切回来时重新构建
+    _drop_context_cache(session_id, mode, mode_mem.active_slot_index)
     mode_mem.active_slot_index = slot_index
     summary = mode_mem.slots[slot_index].summary
     return True, f"已切换到记忆插槽 [{slot_index + 1}]。\n摘要: {summary}"
@@ -264,6 +415,9 @@ def clear_active_slot(session_id: str, mode: str) -> str:
         _history_deques[session_id][mode][active_index].clear()
     active_slot.summary = "（空插槽）"
     active_slot.history = []
+    active_slot.context_summary, active_slot.context_marker = "", ""
+    _drop_context_cache(session_id, mode, active_index)
+    _forget_bot_responses(lambda entry: entry[:3] == (session_id, mode, active_index))
     return f"当前记忆插槽 [{active_index + 1}] 已清空。"
 
 def get_group_summary(group_id: str) -> str:
@@ -283,21 +437,44 @@ def increment_and_check_summary_trigger(group_id: str) -> bool:
     _group_message_counters[group_id] = count
     return False
 
+def register_bot_response(session_id: str, mode: str, record: Dict):
+    """助手记录追加到当前插槽的历史后调用，登记其 message_id 以便之后按回复反查提问。"""
+    bot_message_id, question_id = record.get('message_id'), record.get('response_to_id')
+    if record.get('role') != 'assistant' or bot_message_id is None or not question_id: return
+    user_mem = _get_or_create_user_memory(session_id)
+    mode_mem = user_mem.normal if mode == "normal" else user_mem.slash
+    _index_bot_response(int(bot_message_id), (session_id, mode, mode_mem.active_slot_index, question_id))
+
+def _index_bot_response(bot_message_id: int, entry: Tuple[str, str, int, int]):
+    _bot_response_index[bot_message_id] = entry
+    _bot_response_index.move_to_end(bot_message_id)
+    while len(_bot_response_index) > config.BOT_RESPONSE_INDEX_MAX_ENTRIES:
+        _bot_response_index.popitem(last=False)
+
+def _forget_bot_responses(predicate: Callable[[Tuple[str, str, int, int]], bool]):
+    for bot_message_id in [k for k, entry in _bot_response_index.items() if predicate(entry)]:
+        del _bot_response_index[bot_message_id]
+
+def rebuild_bot_response_index():
+    """从全部历史重建索引，加载记忆后调用。"""
+    _bot_response_index.clear()
+    for session_id, mode, slot_index, history_deque in iter_all_histories():
+        for record in history_deque:
+            bot_message_id, question_id = record.get('message_id'), record.get('response_to_id')
+            if record.get('role') == 'assistant' and bot_message_id is not None and question_id:
+                _index_bot_response(int(bot_message_id), (session_id, mode, slot_index, question_id))
+    logger.info(f"已重建机器人回复索引，共 {len(_bot_response_index)} 条。")
+
 def find_user_question_id_by_bot_response_id(group_id: str, bot_message_id: int) -> Optional[int]:
-    logger.info(f"在群组 {group_id} 的实时内存中查找响应 {bot_message_id} 的原始提问...")
-    group_prefix = f"{group_id}_"
-    for session_id, modes in _history_deques.items():
-        if not session_id.startswith(group_prefix): continue
-        for mode, slots in modes.items():
-            for slot_index, history_deque in slots.items():
-                for record in reversed(history_deque):
-                    if record.get('role') == 'assistant' and record.get('message_id') == bot_message_id:
-                        original_question_id = record.get('response_to_id')
-                        if original_question_id:
-                            logger.info(f"找到匹配！机器人消息 {bot_message_id} 是对用户消息 {original_question_id} 的回应。")
-                            return original_question_id
-    logger.warning(f"在群组 {group_id} 的所有实时记忆中，未能找到机器人消息 {bot_message_id} 的原始提问。")
-    return None
+    entry = _bot_response_index.get(int(bot_message_id))
+    # 会话 ID 的格式为 group_{群号}_{QQ号}
+    if entry is None or not entry[0].startswith(f"group_{group_id}_"):
+        # 主动聊天等不是在回答提问的发言本来就不在索引里
+        logger.info(f"在群组 {group_id} 的回复索引中，未能找到机器人消息 {bot_message_id} 的原始提问。")
+        return None
+    original_question_id = entry[3]
+    logger.info(f"找到匹配！机器人消息 {bot_message_id} 是对用户消息 {original_question_id} 的回应。")
+    return original_question_id
 
 def get_challenge_char_count(session_id: str) -> int:
     return _challenge_char_counts.get(session_id, 0)
@@ -353,7 +530,14 @@ def clear_all_memory_for_group(group_id: str) -> int:
     for session_id in sessions_to_delete:
         if session_id in _user_memory_data: del _user_memory_data[session_id]
         if session_id in _history_deques: del _history_deques[session_id]
+        for key in [k for k in _persisted_rows if k[0] == session_id]: del _persisted_rows[key]
+        for key in [k for k in _context_caches if k[0] == session_id]: del _context_caches[key]
         cleared_count += 1
+    deleted_sessions = set(sessions_to_delete)
+    _forget_bot_responses(lambda entry: entry[0] in deleted_sessions)
+    if memory_db.is_open():
+        try: memory_db.delete_sessions(sessions_to_delete)
+        except Exception as e: logger.error(f"从记忆数据库删除群组 {group_id} 的记忆时出错: {e}", exc_info=True)
         
     logger.info(f"已成功清空群组 {group_id} 中 {cleared_count} 位用户的全部记忆。")
     return cleared_count
\ No newline at end of file
@@ -0,0 +1,116 @@
+# yimao_plugin/forward_cache.py
+"""
+合并转发内容缓存。
+- 机器人自己发出的长消息 (合并转发) 以发送后的 message_id 为键缓存原文，用户引用回复时直接拿到全文；
+- 用户转发给机器人的聊天记录以 forward id 为键缓存解析结果，再次提问时不必重新调用 get_forward_msg。
+内存中是按字节数限制的 LRU；配置了 FORWARD_CACHE_PATH 时同时写入 SQLite，内存淘汰或重启后仍能从磁盘命中。
+"""
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.forward_cache")
+
+_conn: Optional[sqlite3.Connection] = None
+_entries: "OrderedDict[str, str]" = OrderedDict()
+_memory_bytes = 0
+_disk_entry_count = 0
+_stats: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "memory_evictions": 0, "disk_evictions": 0}
+
+def _content_size(content: str) -> int:
+    return len(content.encode("utf-8"))
+
+def open_cache():
+    global _conn, _disk_entry_count
+    if _conn is not None or not config.FORWARD_CACHE_PATH: return
+    path = Path(config.FORWARD_CACHE_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute("CREATE TABLE IF NOT EXISTS forward_contents (key TEXT PRIMARY KEY, content TEXT NOT NULL, last_used REAL NOT NULL)")
+    _conn.execute("CREATE INDEX IF NOT EXISTS idx_forward_contents_last_used ON forward_contents (last_used)")
+    _disk_entry_count = _conn.execute("SELECT COUNT(*) FROM forward_contents").fetchone()[0]
+    logger.info(f"已打开合并转发内容缓存 {path}，共 {_disk_entry_count} 条。")
+
+def close_cache():
+    global _conn
+    if _conn is None: return
+    _conn.close()
+    _conn = None
+    logger.info(f"合并转发内容缓存已关闭。统计: {get_stats()}")
+
+def _remember(key: str, content: str):
+    global _memory_bytes
+    old_content = _entries.pop(key, None)
+    if old_content is not None: _memory_bytes -= _content_size(old_content)
+    _entries[key] = content
+    _memory_bytes += _content_size(content)
+    # 至少保留刚放入的这一条，即使它本身超出预算
+    while _memory_bytes > config.FORWARD_CACHE_MEMORY_BYTES and len(_entries) > 1:
+        _, evicted = _entries.popitem(last=False)
+        _memory_bytes -= _content_size(evicted)
+        _stats["memory_evictions"] += 1
+
+def get(key: str) -> Optional[str]:
+    key = str(key)
+    content = _entries.get(key)
+    if content is not None:
+        _entries.move_to_end(key)
+        _stats["memory_hits"] += 1
+        logger.info(f"从缓存中命中合并转发消息 {key} 的内容。")
+        return content
+    if _conn is not None:
+        try:
+            row = _conn.execute("SELECT content FROM forward_contents WHERE key = ?", (key,)).fetchone()
+            if row:
+                _conn.execute("UPDATE forward_contents SET last_used = ? WHERE key = ?", (time.time(), key))
+                _stats["disk_hits"] += 1
+                _remember(key, row[0])
+                logger.info(f"从磁盘缓存中命中合并转发消息 {key} 的内容。")
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"读取合并转发内容缓存失败: {e}")
+    _stats["misses"] += 1
+    return None
+
+def put(key: str, content: str):
+    global _disk_entry_count
+    if not content: return
+    key = str(key)
+    _remember(key, content)
+    _stats["stores"] += 1
+    logger.info(f"已缓存合并转发消息 {key} 的内容。")
+    if _conn is None: return
+    try:
+        is_new = _conn.execute("SELECT 1 FROM forward_contents WHERE key = ?", (key,)).fetchone() is None
+        _conn.execute(
+            "INSERT INTO forward_contents (key, content, last_used) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET content = excluded.content, last_used = excluded.last_used",
+            (key, content, time.time()))
+        if is_new: _disk_entry_count += 1
+        overflow = _disk_entry_count - config.FORWARD_CACHE_DISK_MAX_ENTRIES
+        if overflow > 0:
+            _conn.execute(
+                "DELETE FROM forward_contents WHERE rowid IN (SELECT rowid FROM forward_contents ORDER BY last_used LIMIT ?)",
+                (overflow,))
+            _disk_entry_count -= overflow
+            _stats["disk_evictions"] += overflow
+    except sqlite3.Error as e:
+        logger.error(f"写入合并转发内容缓存失败: {e}")
+
+def get_stats() -> Dict[str, int]:
+    hits = _stats["memory_hits"] + _stats["disk_hits"]
+    lookups = hits + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate_percent": round(hits * 100 / lookups) if lookups else 0,
+        "memory_entries": len(_entries),
+        "memory_bytes": _memory_bytes,
+        "disk_entries": _disk_entry_count,
+    }
@@ -0,0 +1,71 @@
+# yimao_plugin/group_history.py
+"""
+群聊记录员保存的群消息记录。
+每条消息是一个带 __slots__ 的小对象：时间存整数时间戳，用户 ID 和昵称经过 intern 在所有记录间共享，
+纯文本内容直接存字符串；只有含图片占位项的消息才保留列表 (占位项会被后台图片队列原地补上摘要)。
+渲染好的一行提示词文本在记录创建时就缓存下来，拼装提示词只需要连接现成的行；
+含有尚未生成摘要的图片时不缓存，等摘要落地后下一次渲染再缓存最终结果。
+"""
+import functools
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+Content = Union[str, List[Dict[str, Any]]]
+
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(epoch_seconds: int) -> str:
+    # 同一批记录每次检查都会重新渲染，时间格式化结果值得缓存
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(epoch_seconds))
+
+def _compact_content(content: Any) -> Content:
+    """只含文本项的列表合并为字符串，格式化结果与原列表相同。"""
+    if isinstance(content, list) and all(item.get("type") == "text" for item in content):
+        return " ".join(item.get("text", "") for item in content)
+    return content if content is not None else ""
+
+def _has_pending_image(content: Content) -> bool:
+    return not isinstance(content, str) and any(item.get("pending") for item in content)
+
+def render_content(content: Content) -> str:
+    if isinstance(content, str): return content
+    parts = []
+    for item in content:
+        if item.get("type") == "text": parts.append(item.get("text", ""))
+        elif item.get("type") == "image" and "summary" in item: parts.append(f"[图片: {item['summary']}]")
+        elif item.get("type") == "image" and item.get("pending"): parts.append("[图片(描述生成中)]")
+        else: parts.append(f"[{item.get('type', '未知内容')}]")
+    return " ".join(parts)
+
+class GroupMessage:
+    __slots__ = ("time", "user_id", "user_name", "content", "is_bot", "_line")
+
+    def __init__(self, user_id: Any, user_name: str, content: Any, is_bot: bool = False, timestamp: Optional[int] = None):
+        self.time = int(time.time()) if timestamp is None else timestamp
+        self.user_id = sys.intern(str(user_id))
+        self.user_name = sys.intern(user_name or "")
+        self.content = _compact_content(content)
+        self.is_bot = is_bot
+        self._line: Optional[str] = None
+        self.render()
+
+    @property
+    def plain_text(self) -> str:
+        """只含文字部分，不含图片摘要等。"""
+        if isinstance(self.content, str): return self.content
+        return " ".join(item.get("text", "") for item in self.content if item.get("type") == "text")
+
+    @property
+    def timestamp(self) -> str:
+        return format_timestamp(self.time)
+
+    def render(self) -> str:
+        if self._line is not None: return self._line
+        line = f"[{self.timestamp}] [用户ID:{self.user_id} (昵称:{self.user_name})]: {render_content(self.content).strip()}"
+        if not _has_pending_image(self.content): self._line = line
+        return line
+
+def render_history(messages: Iterable[GroupMessage]) -> List[str]:
+    return [message.render() for message in messages]
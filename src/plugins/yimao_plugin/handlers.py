@@ -7,79 +7,109 @@ import os
 import random
 import shutil
 import re
-import httpx
 import datetime
+import itertools
 import time
-import base64
 from urllib.parse import urlparse, urlunparse
 from pathlib import Path
-from typing import Literal, List, Dict, Any
+from typing import Literal, List, Deque, Dict, Any, Optional, Set, Tuple
 
 from jmcomic import create_option_by_file, download_album, JmcomicClient
 from jmcomic.jm_exception import MissingAlbumPhotoException, PartialDownloadFailedException
 
-from nonebot import on_message
+from nonebot import on_message, on_notice
 from nonebot.rule import Rule
 from nonebot.matcher import Matcher
 from nonebot.typing import T_State
 from nonebot.params import CommandArg
 from nonebot.adapters.onebot.v11 import MessageEvent
-from nonebot.adapters.onebot.v11 import Bot, Event, Message, GroupMessageEvent, MessageSegment
+from nonebot.adapters.onebot.v11 import Bot, Event, Message, GroupMessageEvent, MessageSegment, NoticeEvent
 
-from . import config, data_store, llm_client, tools, utils
+from . import active_chat_filter, concurrency, config, context_window, data_store, group_history, history_image_queue, http_client, image_store, llm_client, member_cache, message_store, summary_cache, tools, utils
 
 logger = logging.getLogger("GeminiPlugin.handlers")
 
 DownloadResult = Literal["ok", "not_found", "error"]
 
 # 【修改】上下文压缩函数现在需要传递模型名称
-async def build_api_messages_with_compression(history: List[Dict[str, Any]], summary_model_for_new_images: str) -> List[Dict[str, Any]]:
+async def build_api_messages_with_compression(history: List[Dict[str, Any]], summary_model_for_new_images: str, cache_entries: Optional[List[list]] = None) -> List[Dict[str, Any]]:
     """
-    遍历完整的对话历史，构建一个用于API请求的、经过压缩的上下文。
+    遍历对话历史，构建一个用于API请求的、经过压缩的上下文。
     为新图片生成摘要时，使用指定的 summary_model_for_new_images。
+    传入与 history 对齐的 cache_entries (见 context_window) 时，已经压缩过的记录直接复用缓存。
     """
+    records_to_compress = [
+        record for index, record in enumerate(history)
+        if cache_entries is None or cache_entries[index][context_window.ENTRY_COMPRESSED] is None
+    ]
+    # 【新增】本轮所有待处理的图片一起并发生成摘要，而不是一张一张地等
+    await _summarize_pending_images(records_to_compress, summary_model_for_new_images)
+
     api_messages = []
-    for record in history:
-        processed_record = record.copy() 
-        content = processed_record.get("content")
-
-        if isinstance(content, list):
-            new_content_parts = []
-            has_image_to_process = False
-
-            for item in content:
-                if item.get("type") == "image_url":
-                    if "summary" in item:
-                        summary_text = f"[图片描述: {item['summary']}]"
-                        new_content_parts.append({"type": "text", "text": summary_text})
-                    else:
-                        new_content_parts.append(item)
-                        has_image_to_process = True
-                else:
-                    new_content_parts.append(item)
-            
-            processed_record["content"] = new_content_parts
-
-            if has_image_to_process:
-                for original_item in content: # 只遍历原始记录
-                    if original_item.get("type") == "image_url" and "summary" not in original_item:
-                        image_url = original_item.get("image_url", {}).get("url", "")
-                        if image_url.startswith("data:image/jpeg;base64,"):
-                            b64_data = image_url.split(",")[1]
-                            logger.info(f"正在为新图片生成摘要，使用模型: {summary_model_for_new_images}")
-                            # 【关键】传入指定的模型
-                            summary = await llm_client.summarize_image_content(b64_data, model_to_use=summary_model_for_new_images)
-                            original_item["summary"] = summary
-                            
-                            # 更新本次要发送的上下文，将图片替换为摘要
-                            for i, part in enumerate(new_content_parts):
-                                if part.get("type") == "image_url" and part.get("image_url") == original_item.get("image_url"):
-                                    new_content_parts[i] = {"type": "text", "text": f"[图片描述: {summary}]"}
-                                    break
-                            logger.info("图片摘要已生成并替换了上下文中的图片。")
+    for index, record in enumerate(history):
+        entry = cache_entries[index] if cache_entries is not None else None
+        if entry is not None and entry[context_window.ENTRY_COMPRESSED] is not None:
+            api_messages.append(dict(entry[context_window.ENTRY_COMPRESSED]))
+            continue
+        processed_record = _compress_record(record)
+        if entry is not None:
+            entry[context_window.ENTRY_COMPRESSED] = processed_record
+            # 新图片有了摘要之后，重新估算这条记录的 token 数
+            entry[context_window.ENTRY_TOKENS] = context_window.estimate_record_tokens(record)
+            processed_record = dict(processed_record)
         api_messages.append(processed_record)
     return api_messages
 
+async def _summarize_pending_images(records: List[Dict[str, Any]], summary_model_for_new_images: str):
+    """为记录中尚无摘要的图片并发生成摘要，并把摘要写回原始记录。"""
+    candidates: List[Tuple[Dict[str, Any], str, Optional[str]]] = []
+    for record in records:
+        content = record.get("content")
+        if not isinstance(content, list): continue
+        for item in content:
+            if item.get("type") == "image_url" and "summary" not in item:
+                image_url = item.get("image_url", {}).get("url", "")
+                # 【新增】图片仓库里的图片已知内容哈希，缓存命中时连图片都不必读回
+                digest = image_store.get_image_digest(image_url)
+                cached_summary = summary_cache.get(digest, summary_model_for_new_images) if digest else None
+                if cached_summary is not None:
+                    item["summary"] = cached_summary
+                    continue
+                candidates.append((item, image_url, digest))
+    if not candidates: return
+    # 图片数据只在真正需要生成摘要时才从图片仓库读回，所有图片在线程池里同时读取
+    loaded = await asyncio.gather(*(asyncio.to_thread(image_store.load_image_base64, image_url) for _, image_url, _ in candidates))
+    pending_items, pending_b64, pending_digests = [], [], []
+    for (item, _, digest), b64_data in zip(candidates, loaded):
+        if b64_data:
+            pending_items.append(item)
+            pending_b64.append(b64_data)
+            pending_digests.append(digest)
+    if not pending_items: return
+    logger.info(f"正在为 {len(pending_items)} 张新图片并发生成摘要，使用模型: {summary_model_for_new_images}")
+    # 【关键】传入指定的模型
+    summaries = await llm_client.summarize_images(pending_b64, model_to_use=summary_model_for_new_images, image_digests=pending_digests)
+    for item, summary in zip(pending_items, summaries):
+        item["summary"] = summary
+    logger.info("图片摘要已生成，将替换上下文中的图片。")
+
+def _compress_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """把记录中的图片替换为其文字摘要，得到发送给 API 的消息。"""
+    processed_record = record.copy()
+    content = processed_record.get("content")
+    if isinstance(content, list):
+        new_content_parts = []
+        for item in content:
+            if item.get("type") == "image_url":
+                if "summary" in item:
+                    new_content_parts.append({"type": "text", "text": f"[图片描述: {item['summary']}]"})
+                else:
+                    new_content_parts.append({"type": "text", "text": "[图片已丢失，无法查看]"})
+            else:
+                new_content_parts.append(item)
+        processed_record["content"] = new_content_parts
+    return processed_record
+
 # ... (run_jm_download_task, handle_random_jm 等函数保持不变) ...
 async def run_jm_download_task(bot: Bot, event: Event, album_id: str) -> DownloadResult:
     # ...
@@ -184,6 +214,13 @@ async def handle_random_jm(bot: Bot, event: Event, matcher: Matcher):
 
 # 【修改】主聊天会话现在决定为新图片使用哪个模型来生成摘要
 async def handle_chat_session(bot: Bot, matcher: Matcher, event: MessageEvent, user_message_content: Any):
+    # 【新增】同一会话的对话轮次依次执行，避免两轮交错写入同一份历史
+    session_lock = concurrency.get_session_lock(event.get_session_id())
+    if session_lock.locked(): logger.info(f"会话 {event.get_session_id()} 的上一轮对话尚未结束，本轮排队等待。")
+    async with session_lock:
+        await _run_chat_turn(bot, matcher, event, user_message_content)
+
+async def _run_chat_turn(bot: Bot, matcher: Matcher, event: MessageEvent, user_message_content: Any):
     session_id = event.get_session_id()
     if isinstance(event, GroupMessageEvent):
         try: await bot.call_api("set_msg_emoji_like", message_id=event.message_id, emoji_id='128164')
@@ -204,9 +241,26 @@ async def handle_chat_session(bot: Bot, matcher: Matcher, event: MessageEvent, u
     history = data_store.get_active_history(session_id, mode)
     history.append(history_record_for_user)
 
+    # 【新增】模型由路由决定，上下文预算按主模型计算
+    route = "slash" if mode == "slash" else "chat"
+    model = llm_client.get_primary_model(route)
+    if mode == "slash":
+        system_prompt, use_function_calling = "", False
+    else:
+        use_function_calling = True
+        if isinstance(event, GroupMessageEvent) and str(event.group_id) in config.EMOTIONLESS_PROMPT_GROUP_IDS:
+            system_prompt = config.EMOTIONLESS_SYSTEM_PROMPT
+        else:
+            system_prompt = config.DEFAULT_SYSTEM_PROMPT_TEMPLATE
+
     try:
+        # 【新增】只发送预算内的最近记录，更早的对话由插槽的滚动摘要代替
+        active_slot = data_store.get_active_slot(session_id, mode)
+        context_cache = data_store.get_context_cache(session_id, mode)
+        window_start = await context_window.prepare_window(history, context_cache, active_slot, model, system_prompt)
+        window_entries = list(itertools.islice(context_cache, window_start, None))
         # 【关键】普通对话中，使用最强模型来分析图片
-        messages_for_api = await build_api_messages_with_compression(list(history), summary_model_for_new_images=config.DEFAULT_MODEL_NAME)
+        messages_for_api = await build_api_messages_with_compression([entry[context_window.ENTRY_RECORD] for entry in window_entries], summary_model_for_new_images=config.DEFAULT_MODEL_NAME, cache_entries=window_entries)
     except Exception as e:
         logger.error(f"构建压缩上下文时出错: {e}", exc_info=True)
         await matcher.send("喵呜~ 我在整理记忆的时候出错了，请检查后台日志。")
@@ -216,42 +270,41 @@ async def handle_chat_session(bot: Bot, matcher: Matcher, event: MessageEvent, u
     # ... (后续的 API 调用和响应处理逻辑保持不变) ...
     now_ts_str = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ")
     if mode == "slash":
-        model, system_prompt, use_function_calling = config.SLASH_COMMAND_MODEL_NAME, "", False
         if len(messages_for_api) == 1:
-            first_turn_payload = messages_for_api[0]
-            if isinstance(first_turn_payload.get('content'), str):
-                original_content = first_turn_payload['content']
-                first_turn_payload['content'] = f"{config.SLASH_COMMAND_SYSTEM_PROMPT}\n\n---\n\n{original_content.lstrip('/')}"
-            elif isinstance(first_turn_payload.get('content'), list):
-                 for item in first_turn_payload['content']:
-                     if item.get('type') == 'text':
-                         original_content = item['text']
-                         item['text'] = f"{config.SLASH_COMMAND_SYSTEM_PROMPT}\n\n---\n\n{original_content.lstrip('/')}"
-                         break
+            # 【修改】只改写发送用的副本，提示词不会写进历史记录
+            context_window.rewrite_message_text(messages_for_api[0], lambda text: f"{config.SLASH_COMMAND_SYSTEM_PROMPT}\n\n---\n\n{text.lstrip('/')}")
+        if active_slot.context_summary:
+            context_window.prefix_first_message(messages_for_api, context_window.build_summary_preamble(active_slot.context_summary))
     else: 
-        model, use_function_calling = config.DEFAULT_MODEL_NAME, True
         for msg in messages_for_api:
             if msg.get('role') in ['user', 'assistant']:
-                content = msg.get('content', '')
-                if isinstance(content, str) and not content.startswith('['): msg['content'] = now_ts_str + content
-                elif isinstance(content, list):
-                    text_part = next((p for p in content if p.get('type') == 'text'), None)
-                    if text_part and not text_part['text'].startswith('['): text_part['text'] = now_ts_str + text_part['text']
+                context_window.rewrite_message_text(msg, lambda text: text if text.startswith('[') else now_ts_str + text)
 
-        if isinstance(event, GroupMessageEvent) and str(event.group_id) in config.EMOTIONLESS_PROMPT_GROUP_IDS:
-            system_prompt = config.EMOTIONLESS_SYSTEM_PROMPT
-        else:
-            system_prompt = config.DEFAULT_SYSTEM_PROMPT_TEMPLATE        
+        if active_slot.context_summary:
+            summary_text = active_slot.context_summary
+            # 系统提示词之后会用 str.format 注入时间，摘要里的花括号需要转义
+            if "{current_time}" in system_prompt: summary_text = summary_text.replace("{", "{{").replace("}", "}}")
+            system_prompt = f"{system_prompt}\n\n# --- 更早对话的摘要 ---\n{summary_text}"
 
     logger.info(f"会话 {session_id} (模式: {mode}) 收到请求。")
+    request_started_at = time.monotonic()
     
     try:
         max_turns = 5
         for _ in range(max_turns):
-            api_response = await llm_client.call_gemini_api(messages_for_api, system_prompt, model, use_function_calling)
+            # 【新增】长回复模式使用流式响应，每攒够一个转发节点就先发出去
+            stream_sender = None
+            if mode in config.STREAMING_RESPONSE_MODES:
+                stream_sender = utils.ProgressiveForwardSender(bot, event, "Loki" if mode == "slash" else "一猫", started_at=request_started_at)
+                api_response = await llm_client.stream_model_route(route, messages_for_api, system_prompt, use_function_calling, on_content=stream_sender.feed)
+            else:
+                api_response = await llm_client.call_model_route(route, messages_for_api, system_prompt, use_function_calling)
             if "error" in api_response:
                 error_msg_from_api = api_response["error"].get("message", "发生未知错误")
-                await matcher.send(f"喵呜~ API出错了: {error_msg_from_api}")
+                if api_response["error"].get("type") == llm_client.UPSTREAM_UNAVAILABLE:
+                    await matcher.send("喵呜~ 我的大脑好像被毛线缠住啦！")
+                else:
+                    await matcher.send(f"喵呜~ API出错了: {error_msg_from_api}")
                 if history: history.pop()
                 break
             
@@ -262,24 +315,25 @@ async def handle_chat_session(bot: Bot, matcher: Matcher, event: MessageEvent, u
                 messages_for_api.append(assistant_message)
                 history.append(assistant_message) 
 
-                for tool_call in response_message["tool_calls"]:
+                # 【新增】同一轮的多个工具调用并发执行，结果仍按调用顺序写入，保证对话记录是确定的
+                tool_calls = [tool_call for tool_call in response_message["tool_calls"] if tool_call["function"]["name"] in tools.available_tools]
+                tool_outputs = await asyncio.gather(*(tools.run_tool_call(tool_call) for tool_call in tool_calls))
+                for tool_call, tool_output in zip(tool_calls, tool_outputs):
                     function_name = tool_call["function"]["name"]
-                    function_args = json.loads(tool_call["function"].get("arguments", "{}"))
-                    if function_name in tools.available_tools:
-                        function_to_call = tools.available_tools[function_name]
-                        tool_output = await function_to_call(**function_args)
-                        messages_for_api.append({"tool_call_id": tool_call["id"], "role": "tool", "name": function_name, "content": tool_output})
-                        history.append({"tool_call_id": tool_call["id"], "role": "tool", "name": function_name, "content": tool_output})
+                    messages_for_api.append({"tool_call_id": tool_call["id"], "role": "tool", "name": function_name, "content": tool_output})
+                    history.append({"tool_call_id": tool_call["id"], "role": "tool", "name": function_name, "content": tool_output})
                 continue
             else:
                 response_content = response_message.get("content", "")
                 if isinstance(event, GroupMessageEvent) and response_content:
-                    bot_name = "Loki" if mode == "slash" else (await bot.get_login_info())['nickname'] or "一猫"
-                    data_store.get_group_history(str(event.group_id)).append({ "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "user_id": bot.self_id, "user_name": bot_name, "content": response_content, "is_bot": True})
+                    bot_name = "Loki" if mode == "slash" else await member_cache.get_bot_nickname(bot)
+                    data_store.get_group_history(str(event.group_id)).append(group_history.GroupMessage(bot.self_id, bot_name, response_content, is_bot=True))
                 
                 assistant_message_payload = {"role": "assistant", "content": response_content}
                 sent_msg_receipt = None
-                if len(response_content) > config.FORWARD_TRIGGER_THRESHOLD:
+                if stream_sender is not None and stream_sender.started:
+                    sent_msg_receipt = await stream_sender.finish()
+                elif len(response_content) > config.FORWARD_TRIGGER_THRESHOLD:
                     bot_name = "Loki" if mode == "slash" else "一猫"
                     sent_msg_receipt = await utils.send_long_message_as_forward(bot, event, response_content, bot_name)
                 elif response_content:
@@ -292,12 +346,13 @@ async def handle_chat_session(bot: Bot, matcher: Matcher, event: MessageEvent, u
                     assistant_message_payload['response_to_id'] = event.message_id
                 
                 history.append(assistant_message_payload)
+                data_store.register_bot_response(session_id, mode, assistant_message_payload)
                 break
         else:
             await matcher.send("喵呜~ 我思考得太久了...")
         
         if "error" not in locals().get("api_response", {}):
-            data_store.save_memory_to_file()
+            data_store.persist_session(session_id)
 
         if isinstance(event, GroupMessageEvent):
             try:
@@ -328,11 +383,15 @@ async def handle_memory_command(matcher: Matcher, event: Event, args: Message =
             success, message = data_store.set_active_slot(session_id, mode, slot_num - 1)
             await matcher.send(message)
             if success:
-                data_store.save_memory_to_file()
+                data_store.persist_session(session_id)
         except ValueError:
             await matcher.send("无效的指令。请输入数字编号。")
 
 async def handle_challenge_chat(bot: Bot, matcher: Matcher, event: Event):
+    async with concurrency.get_session_lock(f"challenge:{event.get_session_id()}"):
+        await _run_challenge_turn(bot, matcher, event)
+
+async def _run_challenge_turn(bot: Bot, matcher: Matcher, event: Event):
     # ...
     if str(event.user_id) in config.USER_BLACKLIST_IDS:
         await matcher.finish()
@@ -340,7 +399,10 @@ async def handle_challenge_chat(bot: Bot, matcher: Matcher, event: Event):
     user_id_str = str(event.user_id)
     user_text = event.get_plaintext().lstrip('#').strip()
     history = data_store.get_or_create_challenge_history(session_id)
-    player_name = event.sender.card or event.sender.nickname or user_id_str
+    if isinstance(event, GroupMessageEvent):
+        player_name = await member_cache.get_member_name(bot, str(event.group_id), user_id_str, sender=event.sender)
+    else:
+        player_name = event.sender.card or event.sender.nickname or user_id_str
     shopkeeper_name = f"{player_name}的神秘店长"
     group_id_str = str(event.group_id) if isinstance(event, GroupMessageEvent) else None
     if user_text.lower() in ["rank", "排行榜", "leaderboard"]:
@@ -384,7 +446,7 @@ async def handle_challenge_chat(bot: Bot, matcher: Matcher, event: Event):
         messages_for_api = list(history)
     logger.info(f"会话 {session_id} (店长: {shopkeeper_name}) - 新游戏: {is_new_game} | 用户输入: '{user_text}'")
     try:
-        api_response = await llm_client.call_gemini_api(messages=messages_for_api, system_prompt_content=config.CHALLENGE_SYSTEM_PROMPT, model_to_use=config.CHALLENGE_MODEL_NAME, use_tools=False)
+        api_response = await llm_client.call_model_route("challenge", messages=messages_for_api, system_prompt_content=config.CHALLENGE_SYSTEM_PROMPT, use_tools=False, priority=concurrency.PRIORITY_CHALLENGE)
         if "error" in api_response: raise RuntimeError(api_response.get("error", {}).get("message", "发生未知API错误"))
         full_response_content = api_response["choices"][0]["message"].get("content", "")
         game_state_jsons = re.findall(r"<GAME_STATE>(.*?)</GAME_STATE>", full_response_content, re.DOTALL)
@@ -433,14 +495,27 @@ async def handle_challenge_chat(bot: Bot, matcher: Matcher, event: Event):
             except: pass
 
 
+# 正在生成摘要的群，同一个群同时只跑一个摘要任务
+_summary_in_progress: Set[str] = set()
+
 async def update_summary_for_group(group_id: str, history_list: list):
     # ...
+    if group_id in _summary_in_progress:
+        logger.info(f"群组 {group_id} 的摘要仍在生成中，跳过本次触发。")
+        return
+    _summary_in_progress.add(group_id)
+    try:
+        await _generate_group_summary(group_id, history_list)
+    finally:
+        _summary_in_progress.discard(group_id)
+
+async def _generate_group_summary(group_id: str, history_list: list):
     logger.info(f"正在为群组 {group_id} 生成摘要...")
     old_summary = data_store.get_group_summary(group_id)
     history_str = "\n".join(format_history_for_prompt(history_list))
     summary_prompt = f"""...""" # Prompt content is long, omitted for brevity
     try:
-        api_response = await llm_client.call_gemini_api(messages=[{"role": "user", "content": summary_prompt}], system_prompt_content="", model_to_use=config.DEFAULT_MODEL_NAME, use_tools=False)
+        api_response = await llm_client.call_model_route("summary", messages=[{"role": "user", "content": summary_prompt}], system_prompt_content="", use_tools=False, priority=concurrency.PRIORITY_SUMMARY)
         new_summary = api_response["choices"][0]["message"].get("content", "").strip()
         if new_summary:
             data_store.update_group_summary(group_id, new_summary)
@@ -462,9 +537,8 @@ def is_bilibili_card() -> Rule:
 async def expand_b23_url(short_url: str) -> str:
     # ...
     try:
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            resp = await client.head(short_url, timeout=10.0)
-            return urlunparse(urlparse(str(resp.url))._replace(params='', query='', fragment=''))
+        resp = await http_client.get_client().head(short_url, timeout=10.0, follow_redirects=True)
+        return urlunparse(urlparse(str(resp.url))._replace(params='', query='', fragment=''))
     except Exception as e:
         logger.error(f"展开或净化B站短链接 {short_url} 时出错: {e}")
         return short_url
@@ -480,8 +554,8 @@ async def handle_bili_card(bot: Bot, event: GroupMessageEvent, matcher: Matcher)
                 if short_url:
                     long_url = await expand_b23_url(short_url)
                     await matcher.send(Message([MessageSegment.reply(id_=event.message_id), MessageSegment.text(long_url)]))
-                    bot_name = (await bot.get_login_info())['nickname'] or "一猫"
-                    data_store.get_group_history(str(event.group_id)).append({"timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "user_id": bot.self_id, "user_name": bot_name, "content": long_url, "is_bot": True})
+                    bot_name = await member_cache.get_bot_nickname(bot)
+                    data_store.get_group_history(str(event.group_id)).append(group_history.GroupMessage(bot.self_id, bot_name, long_url, is_bot=True))
                     return
             except Exception as e:
                 logger.error(f"解析B站小程序时出错: {e}", exc_info=True)
@@ -496,38 +570,49 @@ async def _(bot: Bot, event: GroupMessageEvent):
     group_id, user_id = str(event.group_id), str(event.user_id)
     history = data_store.get_group_history(group_id)
     
-    try:
-        member_info = await bot.get_group_member_info(group_id=event.group_id, user_id=int(user_id))
-        user_name = member_info.get('card') or member_info.get('nickname') or user_id
-    except Exception:
-        user_name = event.sender.nickname or user_id
+    user_name = await member_cache.get_member_name(bot, group_id, user_id, sender=event.sender)
     
     # 【关键】调用新的、能处理图片的 format_message_for_history
-    structured_content = await format_message_for_history(bot, event)
+    structured_content, image_tasks = await format_message_for_history(bot, event)
+    # 登记到本地消息索引，之后引用这条消息时不必再调用 get_msg；图片项与群历史共享，摘要生成后自动可见
+    message_store.record_event(event, {img_url: placeholder for placeholder, img_url in image_tasks})
     
-    history.append({
-        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "user_id": user_id, "user_name": user_name,
-        "content": structured_content, "is_bot": user_id == bot.self_id
-    })
-    logger.debug(f"[记录员 V3] 已记录群({group_id})消息并预处理图片。")
+    history.append(group_history.GroupMessage(user_id, user_name, structured_content, is_bot=user_id == bot.self_id))
+    # 记录先落地，图片摘要交给后台队列，不阻塞后续消息的记录
+    for placeholder, img_url in image_tasks:
+        history_image_queue.enqueue(placeholder, img_url)
+    logger.debug(f"[记录员 V3] 已记录群({group_id})消息，{len(image_tasks)} 张图片等待生成摘要。")
     
     if user_id != bot.self_id:
         data_store.increment_active_chat_message_count(group_id)
         if data_store.increment_and_check_summary_trigger(group_id):
             asyncio.create_task(update_summary_for_group(group_id, list(history)))
 
-# 【核心修改】此函数现在返回结构化内容，并能即时生成图片摘要
-async def format_message_for_history(bot: Bot, event: GroupMessageEvent) -> Any:
+# 群名片变更、成员退群时同步成员显示名缓存
+member_notice_listener = on_notice(priority=1, block=False)
+@member_notice_listener.handle()
+async def _(event: NoticeEvent):
+    group_id, user_id = getattr(event, "group_id", None), getattr(event, "user_id", None)
+    if group_id is None or user_id is None: return
+    if event.notice_type == "group_card":
+        card_new = getattr(event, "card_new", "")
+        # 名片被清空时显示名退回昵称，这里不知道昵称，等下次消息或查询时再刷新
+        if card_new: member_cache.remember(str(group_id), str(user_id), card_new)
+        else: member_cache.forget(str(group_id), str(user_id))
+    elif event.notice_type == "group_decrease":
+        member_cache.forget(str(group_id), str(user_id))
+
+# 【核心修改】此函数返回结构化内容，以及需要后台生成摘要的 (图片占位项, 图片URL) 列表
+async def format_message_for_history(bot: Bot, event: GroupMessageEvent) -> Tuple[Any, List[Tuple[Dict[str, Any], str]]]:
     message = event.message
     has_non_text = any(seg.type != 'text' for seg in message)
 
-    if not has_non_text: return event.get_plaintext()
+    if not has_non_text: return event.get_plaintext(), []
 
-    content_list, text_buffer = [], []
+    content_list, text_buffer, image_tasks = [], [], []
     if event.reply:
         try:
-            replied_msg_info = await bot.get_msg(message_id=event.reply.message_id)
+            replied_msg_info = await message_store.get_message(bot, event.reply.message_id)
             replied_sender = replied_msg_info.get('sender', {})
             replied_user_name = replied_sender.get('card') or replied_sender.get('nickname', f"用户{replied_sender.get('user_id')}")
             raw_msg = replied_msg_info.get('message', '')
@@ -547,18 +632,10 @@ async def format_message_for_history(bot: Bot, event: GroupMessageEvent) -> Any:
             if seg.type == 'image':
                 img_url = seg.data.get('url')
                 if img_url:
-                    try:
-                        async with httpx.AsyncClient() as c:
-                            resp = await c.get(img_url, timeout=60.0)
-                            resp.raise_for_status()
-                            img_b64 = base64.b64encode(resp.content).decode()
-                        # 【关键】为主动聊天图片摘要使用更快的模型
-                        summary = await llm_client.summarize_image_content(img_b64, model_to_use=config.SLASH_COMMAND_MODEL_NAME)
-                        content_list.append({"type": "image", "summary": summary})
-                        logger.info(f"主动聊天记录：已为新图片生成摘要。")
-                    except Exception as e:
-                        logger.error(f"为主动聊天下载/摘要图片时失败: {img_url}, error: {e}")
-                        content_list.append({"type": "text", "text": "[图片处理失败]"})
+                    # 先放入占位项，摘要由后台队列生成后原地补上
+                    placeholder = history_image_queue.make_placeholder()
+                    image_tasks.append((placeholder, img_url))
+                    content_list.append(placeholder)
                 else: content_list.append({"type": "text", "text": "[图片]"})
             elif seg.type != 'reply': content_list.append({"type": "text", "text": f"[{seg.type}]"})
     
@@ -566,55 +643,131 @@ async def format_message_for_history(bot: Bot, event: GroupMessageEvent) -> Any:
     return content_list
 
 
-def format_history_for_prompt(hist_list: List[Dict]) -> List[str]:
-    # ... (此函数保持不变) ...
-    formatted_lines = []
-    for msg in hist_list:
-        user_info = f"[{msg['timestamp']}] [用户ID:{msg['user_id']} (昵称:{msg['user_name']})]:"
-        content, content_str = msg.get('content'), ""
-        if isinstance(content, str): content_str = content
-        elif isinstance(content, list):
-            parts = []
-            for item in content:
-                if item.get("type") == "text": parts.append(item.get("text", ""))
-                elif item.get("type") == "image" and "summary" in item: parts.append(f"[图片: {item['summary']}]")
-                else: parts.append(f"[{item.get('type', '未知内容')}]")
-            content_str = " ".join(parts)
-        formatted_lines.append(f"{user_info} {content_str.strip()}")
-    return formatted_lines
+def format_history_for_prompt(hist_list: List[group_history.GroupMessage]) -> List[str]:
+    # 【修改】格式化逻辑移到 group_history，每条记录缓存自己渲染好的一行，这里只是取出现成的行
+    return group_history.render_history(hist_list)
+
+
+_active_chat_prefilter: Optional[active_chat_filter.ActiveChatPrefilter] = None
+
+def get_active_chat_prefilter() -> active_chat_filter.ActiveChatPrefilter:
+    global _active_chat_prefilter
+    if _active_chat_prefilter is None:
+        _active_chat_prefilter = active_chat_filter.ActiveChatPrefilter(
+            config.ACTIVE_CHAT_PREFILTER_WEIGHTS, config.ACTIVE_CHAT_PREFILTER_THRESHOLD, config.ACTIVE_CHAT_PREFILTER_KEYWORDS,
+            active_chat_filter.ReplyRateTracker(config.ACTIVE_CHAT_REPLY_RATE_PRIOR, config.ACTIVE_CHAT_REPLY_RATE_ALPHA))
+    return _active_chat_prefilter
+
+_active_chat_debouncer: Optional[concurrency.KeyedDebouncer] = None
 
+def get_active_chat_debouncer() -> concurrency.KeyedDebouncer:
+    global _active_chat_debouncer
+    if _active_chat_debouncer is None:
+        _active_chat_debouncer = concurrency.KeyedDebouncer(config.ACTIVE_CHAT_DEBOUNCE_QUIET_SECONDS, config.ACTIVE_CHAT_DEBOUNCE_MAX_DELAY)
+    return _active_chat_debouncer
+
+def schedule_active_chat_check(bot: Bot, event: GroupMessageEvent):
+    """【新增】每条群消息只登记一次去抖，等群里安静下来后基于最新的记录做一次决策；新消息会取消已过时的决策。"""
+    group_id = str(event.group_id)
+    if not config.ACTIVE_CHAT_ENABLED or group_id not in config.ACTIVE_CHAT_WHITELIST or str(event.user_id) == bot.self_id: return
+    get_active_chat_debouncer().trigger(group_id, lambda: handle_active_chat_check(bot, event))
+
+# 每个群上一次完成检查时的最后一条消息，下次检查只给它之后的消息打分
+_active_chat_last_checked: Dict[str, group_history.GroupMessage] = {}
+
+def _count_messages_since_last_check(group_id: str, history: Deque[group_history.GroupMessage]) -> int:
+    """上次检查以来的新消息数，机器人自己发言之前的消息不算 (已经回应过)，最多 ACTIVE_CHAT_PREFILTER_WINDOW 条。"""
+    last_checked = _active_chat_last_checked.get(group_id)
+    count = 0
+    for message in reversed(history):
+        if message is last_checked or message.is_bot or count >= config.ACTIVE_CHAT_PREFILTER_WINDOW: break
+        count += 1
+    return max(count, 1)
+
+async def _send_active_reply(bot: Bot, event: GroupMessageEvent, group_id: str, reply_text: str, history: Deque[group_history.GroupMessage]):
+    await bot.send(event, message=reply_text)
+    data_store.reset_active_chat_message_count(group_id)
+    bot_name = await member_cache.get_bot_nickname(bot)
+    history.append(group_history.GroupMessage(bot.self_id, bot_name, reply_text, is_bot=True))
+
+# 网关对 response_format 返回过 400 后，本次运行不再使用 JSON 输出模式
+_active_chat_json_mode_supported = True
+
+async def _request_active_chat_json(route: str, messages: list, system_prompt: str) -> Optional[Dict[str, Any]]:
+    """请求主动聊天的决策/回复，返回模型输出中的第一个 JSON 对象；调用失败或无法解析时返回 None。"""
+    global _active_chat_json_mode_supported
+    use_json_mode = config.ACTIVE_CHAT_JSON_MODE and _active_chat_json_mode_supported
+    response_format = {"type": "json_object"} if use_json_mode else None
+    api_response = await llm_client.call_model_route(route, messages=messages, system_prompt_content=system_prompt, use_tools=False, priority=concurrency.PRIORITY_ACTIVE_CHAT, response_format=response_format)
+    if use_json_mode and api_response.get("error", {}).get("status_code") == 400:
+        api_response = await llm_client.call_model_route(route, messages=messages, system_prompt_content=system_prompt, use_tools=False, priority=concurrency.PRIORITY_ACTIVE_CHAT)
+        if "error" not in api_response:
+            logger.warning("[主动聊天] 网关不支持 JSON 输出模式，之后改为普通输出。")
+            _active_chat_json_mode_supported = False
+    if "error" in api_response:
+        logger.error(f"[主动聊天] {route} 调用失败: {api_response['error']}")
+        return None
+    response_content = api_response["choices"][0]["message"].get("content") or ""
+    data = utils.extract_json_object(response_content)
+    if data is None: logger.warning(f"[主动聊天] 无法从模型输出中解析 JSON: {response_content[:200]}")
+    return data
 
 async def handle_active_chat_check(bot: Bot, event: GroupMessageEvent):
     # ... (此函数保持不变) ...
     group_id = str(event.group_id)
-    if not config.ACTIVE_CHAT_ENABLED or group_id not in config.ACTIVE_CHAT_WHITELIST or not data_store.check_and_set_cooldown(group_id): return
+    if not config.ACTIVE_CHAT_ENABLED or group_id not in config.ACTIVE_CHAT_WHITELIST: return
     if data_store.get_active_chat_message_count(group_id) < config.ACTIVE_CHAT_MESSAGE_THRESHOLD: return
     history = data_store.get_group_history(group_id)
-    if not history: return
+    if not history or history[-1].is_bot or data_store.is_in_cooldown(group_id): return
+    # 【新增】本地预筛选：得分太低的消息不值得一次决策模型调用，也不占用冷却时间
+    prefilter = get_active_chat_prefilter()
+    # 去抖会把一串消息合并成一次检查，这一串里的每条新消息都要打分
+    latest_message = history[-1]
+    new_count = _count_messages_since_last_check(group_id, history)
+    window_texts = [msg.plain_text for msg in itertools.islice(history, max(0, len(history) - config.ACTIVE_CHAT_PREFILTER_WINDOW - new_count), None)]
+    bot_names = [member_cache.peek_bot_nickname(bot)]
+    score = None
+    if config.ACTIVE_CHAT_PREFILTER_ENABLED:
+        passed, score, _ = prefilter.should_call_llm(group_id, window_texts, bot_names, new_count)
+        if not passed:
+            _active_chat_last_checked[group_id] = latest_message
+            return
+    if not data_store.check_and_set_cooldown(group_id): return
     group_summary = data_store.get_group_summary(group_id)
-    history_for_prompt = format_history_for_prompt(list(history))
+    history_for_prompt = format_history_for_prompt(history)
     if not history_for_prompt: return
     recent_history, new_message = "\n".join(history_for_prompt[:-1]), history_for_prompt[-1]
     decision_payload = f"Group Summary:\n{group_summary}\n\nRecent History:\n{recent_history}\n\nNew Message:\n{new_message}"
     decision_messages = [{"role": "user", "content": decision_payload}]
     system_prompt = config.ACTIVE_CHAT_DECISION_PROMPT.format(current_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    replying = False
     try:
         logger.info(f"[主动聊天] 群({group_id}) 正在进行决策 (上下文包含图片摘要)...")
-        api_response = await llm_client.call_gemini_api(messages=decision_messages, system_prompt_content=system_prompt, model_to_use=config.ACTIVE_CHAT_DECISION_MODEL, use_tools=False)
-        if "error" in api_response:
-            logger.error(f"[主动聊天] 决策API调用失败: {api_response['error']}")
-            return
-        response_content = api_response["choices"][0]["message"].get("content", "").strip("```json").strip("```").strip()
-        decision_data = json.loads(response_content)
-        if decision_data.get("should_reply"):
-            reply_text = decision_data.get("reply_content", "").strip()
-            if reply_text:
-                logger.info(f"[主动聊天] 决定回复群({group_id})，内容: {reply_text}")
-                await bot.send(event, message=reply_text)
-                data_store.reset_active_chat_message_count(group_id)
-                bot_name = (await bot.get_login_info())['nickname'] or "一猫"
-                history.append({"timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "user_id": bot.self_id, "user_name": bot_name, "content": reply_text, "is_bot": True})
-    except json.JSONDecodeError:
-        logger.warning(f"[主动聊天] 解析决策JSON失败: {response_content}")
+        # 【修改】两级决策时先由快速模型只回答要不要说话，省去大多数“不说话”判断里的回复生成
+        decision_prompt = system_prompt + config.ACTIVE_CHAT_DECISION_ONLY_SUFFIX if config.ACTIVE_CHAT_TWO_TIER else system_prompt
+        decision_data = await _request_active_chat_json("active_chat", decision_messages, decision_prompt)
+        # 决策已经完成 (哪怕失败)，这一串消息不再参与下次打分；被取消时则留给下一次检查
+        _active_chat_last_checked[group_id] = latest_message
+        if decision_data is None: return
+        should_reply = decision_data.get("should_reply") in (True, "true", "True")
+        prefilter.record_decision(group_id, should_reply)
+        active_chat_filter.append_decision_log(config.ACTIVE_CHAT_DECISION_LOG_PATH, group_id, window_texts, bot_names, score, should_reply, new_count)
+        if not should_reply: return
+        reply_text = str(decision_data.get("reply_content") or "").strip()
+        if not reply_text and config.ACTIVE_CHAT_TWO_TIER:
+            logger.info(f"[主动聊天] 群({group_id}) 快速模型决定发言，正在生成回复内容...")
+            reply_data = await _request_active_chat_json("active_chat_reply", decision_messages, system_prompt + config.ACTIVE_CHAT_REPLY_SUFFIX)
+            reply_text = str((reply_data or {}).get("reply_content") or "").strip()
+        if reply_text:
+            logger.info(f"[主动聊天] 决定回复群({group_id})，内容: {reply_text}")
+            # 已经决定发言，即使此时来了新消息也要把这句话发完、记完
+            replying = True
+            await asyncio.shield(_send_active_reply(bot, event, group_id, reply_text, history))
+    except asyncio.CancelledError:
+        # 群里来了新消息，这次决策已经过时；归还冷却时间，让基于新状态的决策可以立即进行
+        if not replying:
+            logger.info(f"[主动聊天] 群({group_id}) 有新消息，取消过时的决策。")
+            data_store.clear_cooldown(group_id)
+        raise
     except Exception as e:
         logger.error(f"[主动聊天] 处理过程中发生未知错误: {e}", exc_info=True)
\ No newline at end of file
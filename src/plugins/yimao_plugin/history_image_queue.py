@@ -0,0 +1,86 @@
+# yimao_plugin/history_image_queue.py
+"""
+群聊记录中图片摘要的后台队列。
+记录员遇到图片时只放入一个占位项 {"type": "image", "pending": True} 并立即写入群历史，
+下载和视觉模型调用由这里的后台 worker 完成，完成后原地补上 summary。
+队列有上限，满了以后丢弃最早排队的图片，保证新消息的图片优先得到描述。
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import config, http_client, llm_client
+
+logger = logging.getLogger("GeminiPlugin.image_queue")
+
+_queue: Optional["asyncio.Queue[Tuple[Dict[str, Any], str]]"] = None
+_workers: List[asyncio.Task] = []
+_stats: Dict[str, int] = {"enqueued": 0, "completed": 0, "failed": 0, "dropped": 0}
+
+def make_placeholder() -> Dict[str, Any]:
+    return {"type": "image", "pending": True}
+
+def _resolve(item: Dict[str, Any], **fields):
+    item.clear()
+    item.update(fields)
+
+async def start():
+    global _queue
+    if _queue is None: _queue = asyncio.Queue(maxsize=config.GROUP_IMAGE_QUEUE_MAX_SIZE)
+    while len(_workers) < config.GROUP_IMAGE_QUEUE_WORKERS:
+        _workers.append(asyncio.create_task(_worker(len(_workers))))
+    logger.info(f"群聊图片摘要队列已启动 ({len(_workers)} 个 worker，容量 {config.GROUP_IMAGE_QUEUE_MAX_SIZE})。")
+
+async def stop():
+    for task in _workers: task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    logger.info(f"群聊图片摘要队列已停止。统计: {get_stats()}")
+
+def enqueue(item: Dict[str, Any], img_url: str):
+    """把占位项交给后台处理。队列已满时丢弃最早排队的一项，被丢弃的图片不再生成描述。"""
+    if _queue is None or not _workers:
+        logger.warning("群聊图片摘要队列未启动，图片将不生成描述。")
+        _resolve(item, type="text", text="[图片]")
+        return
+    while _queue.full():
+        try: dropped_item, _ = _queue.get_nowait()
+        except asyncio.QueueEmpty: break
+        _queue.task_done()
+        _resolve(dropped_item, type="text", text="[图片]")
+        _stats["dropped"] += 1
+        logger.warning(f"群聊图片摘要队列已满 ({_queue.maxsize})，丢弃了最早排队的一张图片。")
+    _queue.put_nowait((item, img_url))
+    _stats["enqueued"] += 1
+
+async def _worker(worker_index: int):
+    while True:
+        item, img_url = await _queue.get()
+        try:
+            await _summarize_into(item, img_url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[图片队列 worker {worker_index}] 处理图片时出现意外错误: {e}", exc_info=True)
+        finally:
+            _queue.task_done()
+
+async def _summarize_into(item: Dict[str, Any], img_url: str):
+    try:
+        resp = await http_client.get_client().get(img_url, timeout=config.IMAGE_DOWNLOAD_TIMEOUT)
+        resp.raise_for_status()
+        img_b64 = base64.b64encode(resp.content).decode()
+        # 【关键】为主动聊天图片摘要使用更快的模型
+        summary = await llm_client.summarize_image_content(img_b64, model_to_use=config.SLASH_COMMAND_MODEL_NAME, image_digest=hashlib.sha256(resp.content).hexdigest())
+        _resolve(item, type="image", summary=summary)
+        _stats["completed"] += 1
+        logger.info("主动聊天记录：已为新图片生成摘要。")
+    except Exception as e:
+        _resolve(item, type="text", text="[图片处理失败]")
+        _stats["failed"] += 1
+        logger.error(f"为主动聊天下载/摘要图片时失败: {img_url}, error: {e}")
+
+def get_stats() -> Dict[str, int]:
+    return {**_stats, "queued": _queue.qsize() if _queue is not None else 0}
@@ -0,0 +1,100 @@
+# yimao_plugin/http_client.py
+"""
+插件共享的 httpx 连接池。
+在驱动器 on_startup 时创建、on_shutdown 时关闭，所有 LLM 网关请求、图片下载和工具请求复用长连接，
+不再每次调用都重新建立 TCP/TLS 连接。
+"""
+import logging
+from typing import Optional
+
+import httpx
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.http")
+
+_gateway_client: Optional[httpx.AsyncClient] = None
+_general_client: Optional[httpx.AsyncClient] = None
+_search_client: Optional[httpx.AsyncClient] = None
+_gateway_uses_http2 = False
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _build_gateway_client() -> httpx.AsyncClient:
+    global _gateway_uses_http2
+    use_http2 = config.LLM_GATEWAY_HTTP2 and _http2_available()
+    _gateway_uses_http2 = use_http2
+    if config.LLM_GATEWAY_HTTP2 and not use_http2:
+        logger.warning("未安装 h2，LLM 网关连接将使用 HTTP/1.1 keep-alive。")
+    return httpx.AsyncClient(
+        http2=use_http2,
+        timeout=httpx.Timeout(config.LLM_REQUEST_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=config.LLM_GATEWAY_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_GATEWAY_MAX_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+def _build_general_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(config.HTTP_DEFAULT_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+def _get_search_proxy() -> Optional[str]:
+    if not config.HTTP_PROXY: return None
+    # 关键：SOCKS5 代理写成 socks5h://，由代理端解析域名
+    return f"socks5h://{config.HTTP_PROXY.split('//')[1]}"
+
+def _build_search_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        proxy=_get_search_proxy(),
+        timeout=httpx.Timeout(config.GOOGLE_SEARCH_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+async def startup():
+    global _gateway_client, _general_client, _search_client
+    if _gateway_client is None: _gateway_client = _build_gateway_client()
+    if _general_client is None: _general_client = _build_general_client()
+    if _search_client is None: _search_client = _build_search_client()
+    logger.info(f"HTTP 连接池已创建 (网关 HTTP/2: {_gateway_uses_http2})。")
+
+async def shutdown():
+    global _gateway_client, _general_client, _search_client
+    for client in (_gateway_client, _general_client, _search_client):
+        if client is not None: await client.aclose()
+    _gateway_client, _general_client, _search_client = None, None, None
+    logger.info("HTTP 连接池已关闭。")
+
+def get_gateway_client() -> httpx.AsyncClient:
+    """用于访问 new-api 网关的客户端。"""
+    global _gateway_client
+    if _gateway_client is None: _gateway_client = _build_gateway_client()
+    return _gateway_client
+
+def get_client() -> httpx.AsyncClient:
+    """用于图片下载、天气查询、短链接展开等其他外部请求的客户端。"""
+    global _general_client
+    if _general_client is None: _general_client = _build_general_client()
+    return _general_client
+
+def get_search_client() -> httpx.AsyncClient:
+    """用于访问 Google 搜索 API 的客户端，经由 HTTP_PROXY 指定的 SOCKS5 代理。"""
+    global _search_client
+    if _search_client is None: _search_client = _build_search_client()
+    return _search_client
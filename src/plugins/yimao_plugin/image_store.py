@@ -0,0 +1,73 @@
+# yimao_plugin/image_store.py
+"""
+按内容哈希存放图片的本地仓库。
+对话历史里只保留形如 "blob:sha256:<hex>" 的引用，同一张图片无论被多少人、多少群发过，磁盘上只存一份，
+需要生成摘要时再按引用读回 base64。
+"""
+import base64
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.image_store")
+
+IMAGE_REF_PREFIX = "blob:sha256:"
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+def _get_store_dir() -> Path:
+    return Path(config.IMAGE_STORE_DIR)
+
+def _get_blob_path(digest: str) -> Path:
+    return _get_store_dir() / digest[:2] / f"{digest}.jpg"
+
+def put_image(data: bytes) -> str:
+    """保存图片内容 (已存在则跳过)，返回可以写进历史记录的引用。"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _get_blob_path(digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".tmp.{os.urandom(4).hex()}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        logger.debug(f"已存储新图片 {digest[:12]}，大小 {len(data)} 字节。")
+    return IMAGE_REF_PREFIX + digest
+
+def get_image_digest(image_url: str) -> Optional[str]:
+    if image_url.startswith(IMAGE_REF_PREFIX): return image_url[len(IMAGE_REF_PREFIX):]
+    return None
+
+def is_loadable_image_url(image_url: str) -> bool:
+    return image_url.startswith(IMAGE_REF_PREFIX) or image_url.startswith(DATA_URL_PREFIX)
+
+def load_image_base64(image_url: str) -> Optional[str]:
+    """把历史记录中的图片地址 (引用或旧的 data URL) 还原为 base64，找不到时返回 None。"""
+    if image_url.startswith(DATA_URL_PREFIX):
+        return image_url.split(",", 1)[1]
+    digest = get_image_digest(image_url)
+    if not digest: return None
+    path = _get_blob_path(digest)
+    try:
+        return base64.b64encode(path.read_bytes()).decode()
+    except OSError as e:
+        logger.error(f"读取图片 {digest[:12]} 失败: {e}")
+        return None
+
+def externalize_record(record: dict) -> bool:
+    """把记录中内嵌的 base64 图片转存到仓库并替换为引用，返回记录是否被修改。"""
+    content = record.get("content")
+    if not isinstance(content, list): return False
+    changed = False
+    for item in content:
+        if not isinstance(item, dict) or item.get("type") != "image_url": continue
+        image_url = item.get("image_url", {}).get("url", "")
+        if image_url.startswith(DATA_URL_PREFIX):
+            try:
+                item["image_url"]["url"] = put_image(base64.b64decode(image_url.split(",", 1)[1]))
+                changed = True
+            except Exception as e:
+                logger.error(f"转存历史图片时出错: {e}")
+    return changed
@@ -1,15 +1,31 @@
 # yimao_plugin/llm_client.py
 import asyncio
+import base64
+import copy
+import hashlib
 import httpx
 import json
 import logging
 import datetime
-from . import config, tools
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import concurrency, config, http_client, retry_policy, summary_cache, tools
+from .async_cache import SingleFlight
 
 logger = logging.getLogger("GeminiPlugin.client")
 
-async def call_gemini_api(messages: list, system_prompt_content: str, model_to_use: str, use_tools: bool) -> dict:
-    # ... (此函数保持不变) ...
+# 【新增】完全相同的请求并发进行时只向网关发一次，例如同一群的主动聊天判断或同一张图片的摘要被重复触发
+_llm_flights = SingleFlight()
+_image_summary_flights = SingleFlight()
+
+def _request_key(payload: dict) -> str:
+    """按请求体 (模型、消息、工具、温度) 计算合并用的键。"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _build_chat_request(messages: list, system_prompt_content: str, model_to_use: str, use_tools: bool, stream: bool = False,
+                        response_format: Optional[dict] = None) -> Tuple[str, dict, dict]:
     api_url = f"{config.DEFAULT_API_BASE_URL}/chat/completions"
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {config.DEFAULT_API_TOKEN}"}
     formatted_system_prompt = system_prompt_content
@@ -25,33 +41,241 @@ async def call_gemini_api(messages: list, system_prompt_content: str, model_to_u
         logger.info("检测到空消息列表，添加占位符以触发AI开场白。")
     else:
         all_messages.extend(messages)
-    payload = { "model": model_to_use, "messages": all_messages, "stream": False, "temperature": 0.75, }
+    payload = { "model": model_to_use, "messages": all_messages, "stream": stream, "temperature": 0.75, }
     if use_tools:
         payload["tools"] = tools.tools_definition_openai
         payload["tool_choice"] = "auto"
-    MAX_RETRIES = 5
-    RETRY_DELAY = 10
-    async with httpx.AsyncClient(timeout=180.0) as client:
-        for attempt in range(MAX_RETRIES):
-            try:
-                logger.info(f"向LLM发送API请求 (尝试 {attempt + 1}/{MAX_RETRIES})... (使用系统代理)")
-                response = await client.post(api_url, headers=headers, json=payload)
+    if response_format: payload["response_format"] = response_format
+    return api_url, headers, payload
+
+# 重试用尽后仍然连不上网关或超时的错误类型，由调用方决定如何向用户道歉
+UPSTREAM_UNAVAILABLE = "upstream_unavailable"
+
+def _busy_response(e: Exception) -> dict:
+    logger.warning(f"LLM 并发已满，放弃本次请求: {e}")
+    return {"error": {"message": "当前请求太多，请稍后再试"}}
+
+async def call_gemini_api(messages: list, system_prompt_content: str, model_to_use: str, use_tools: bool,
+                          priority: str = concurrency.PRIORITY_DIRECT, response_format: Optional[dict] = None) -> dict:
+    """
+    priority 决定网关繁忙时的排队顺序，见 concurrency 模块。
+    response_format 原样传给网关 (OpenAI 格式，例如 {"type": "json_object"})。
+    与正在进行的请求完全相同时不再单独发送，而是等待那一个的结果 (排队优先级也沿用先到的请求)。
+    """
+    api_url, headers, payload = _build_chat_request(messages, system_prompt_content, model_to_use, use_tools, response_format=response_format)
+    api_response = await _llm_flights.do(_request_key(payload), lambda: _post_chat_request(api_url, headers, payload, model_to_use, priority))
+    # 结果由所有等待者共享，各自拿一份副本，避免调用方修改时互相影响
+    return copy.deepcopy(api_response)
+
+async def _post_chat_request(api_url: str, headers: dict, payload: dict, model_to_use: str, priority: str) -> dict:
+    client = http_client.get_gateway_client()
+
+    async def send(timeout: float) -> httpx.Response:
+        # 只在请求进行期间占用并发名额，重试等待时不占
+        async with concurrency.llm_slot(priority):
+            return await client.post(api_url, headers=headers, json=payload, timeout=timeout)
+
+    try:
+        response = await retry_policy.send_with_retry(send, retry_policy.get_llm_policy(), model_to_use, config.LLM_REQUEST_TIMEOUT)
+        return response.json()
+    except concurrency.LimiterBusyError as e:
+        return _busy_response(e)
+    except retry_policy.CircuitOpenError as e:
+        logger.warning(str(e))
+        return {"error": {"message": str(e)}}
+    except httpx.HTTPStatusError as e:
+        logger.error(f"调用API时发生HTTP错误: {e.response.status_code} - {e.response.text}")
+        raise
+    except Exception as e:
+        logger.error(f"调用API时发生未知错误: {e}", exc_info=True)
+        # 返回错误而不是兜底文案：路由层据此改用备用模型，这次失败的耗时也不会记成成功样本
+        return {"error": {"message": _describe_error(e), "type": UPSTREAM_UNAVAILABLE}}
+
+async def stream_gemini_api(messages: list, system_prompt_content: str, model_to_use: str, use_tools: bool,
+                            on_content: Optional[Callable[[str], Awaitable[None]]] = None,
+                            priority: str = concurrency.PRIORITY_DIRECT) -> dict:
+    """
+    以 SSE 流式请求模型，每收到一段文本就交给 on_content，结束后返回与 call_gemini_api 相同结构的响应。
+    分片到达的 tool_calls 按 index 拼接。还没有交付任何文本就出错时，退回到非流式的 call_gemini_api。
+    """
+    api_url, headers, payload = _build_chat_request(messages, system_prompt_content, model_to_use, use_tools, stream=True)
+    # 流式请求不重试，但和非流式请求一样计入熔断器：失败累计到阈值会熔断，半开时也占用探测名额
+    breaker = retry_policy.get_breaker(model_to_use)
+    probing = breaker.state == "half-open"
+    if not breaker.allow(): return {"error": {"message": f"模型 {model_to_use} 暂时不可用 (熔断中)，请稍后再试"}}
+    content_parts: List[str] = []
+    tool_calls: Dict[int, dict] = {}
+    delivered = False
+    started_at = time.monotonic()
+    try:
+        logger.info(f"向LLM发送流式API请求，模型: {model_to_use}")
+        async with concurrency.llm_slot(priority), http_client.get_gateway_client().stream("POST", api_url, headers=headers, json=payload, timeout=config.LLM_REQUEST_TIMEOUT) as response:
+            if response.status_code >= 400:
+                await response.aread()
                 response.raise_for_status()
-                return response.json()
-            except httpx.HTTPStatusError as e:
-                if e.response.status_code in [500, 503] and attempt < MAX_RETRIES - 1:
-                    logger.warning(f"API返回 {e.response.status_code} (服务器临时错误)，将在 {RETRY_DELAY} 秒后重试...")
-                    await asyncio.sleep(RETRY_DELAY)
-                else:
-                    logger.error(f"调用API时发生HTTP错误: {e.response.status_code} - {e.response.text}")
-                    raise
-            except Exception as e:
-                logger.error(f"调用API时发生未知错误: {e}", exc_info=True)
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY)
-                else:
-                    return {"choices": [{"message": {"content": "喵呜~ 我的大脑好像被毛线缠住啦！"}}]}
-    return {"choices": [{"message": {"content": "喵呜~ API持续繁忙或出错，请稍后再试吧！"}}]}
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"): continue
+                data = line[5:].strip()
+                if data == "[DONE]": break
+                if not data: continue
+                for choice in json.loads(data).get("choices", []):
+                    delta = choice.get("delta") or {}
+                    for tool_call_delta in delta.get("tool_calls") or []:
+                        _merge_tool_call_delta(tool_calls, tool_call_delta)
+                    text = delta.get("content")
+                    if not text: continue
+                    if not content_parts:
+                        logger.info(f"[流式] 收到首个文本片段，耗时 {time.monotonic() - started_at:.2f} 秒。")
+                    content_parts.append(text)
+                    if on_content:
+                        delivered = True
+                        await on_content(text)
+    except concurrency.LimiterBusyError as e:
+        if probing: breaker.release_probe()
+        return _busy_response(e)
+    except Exception as e:
+        retry_policy.record_attempt_error(breaker, e, probing)
+        if not delivered:
+            logger.warning(f"流式请求失败 ({e})，改用非流式请求重试。")
+            return await call_gemini_api(messages, system_prompt_content, model_to_use, use_tools, priority)
+        logger.error(f"流式响应在输出过程中中断: {e}", exc_info=True)
+        return {"error": {"message": "回复生成到一半中断了"}}
+    except BaseException as e:
+        retry_policy.record_attempt_error(breaker, e, probing)
+        raise
+    breaker.record_success()
+    content = "".join(content_parts)
+    logger.info(f"[流式] 响应完成，共 {len(content)} 字，总耗时 {time.monotonic() - started_at:.2f} 秒。")
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+        if not content: message["content"] = None
+    return {"choices": [{"message": message}]}
+
+def _merge_tool_call_delta(tool_calls: Dict[int, dict], tool_call_delta: dict):
+    # 部分网关不带 index，把每个这样的分片当作一个完整的新调用
+    index = tool_call_delta.get("index", len(tool_calls))
+    tool_call = tool_calls.setdefault(index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+    if tool_call_delta.get("id"): tool_call["id"] = tool_call_delta["id"]
+    if tool_call_delta.get("type"): tool_call["type"] = tool_call_delta["type"]
+    function_delta = tool_call_delta.get("function") or {}
+    if function_delta.get("name"): tool_call["function"]["name"] += function_delta["name"]
+    if function_delta.get("arguments"): tool_call["function"]["arguments"] += function_delta["arguments"]
+
+
+# --- 【新增】模型路由：按用途的备用模型列表与对冲请求 ---
+_latency_samples: Dict[str, Deque[float]] = {}
+
+def _record_latency(model: str, seconds: float):
+    samples = _latency_samples.get(model)
+    if samples is None:
+        samples = _latency_samples[model] = deque(maxlen=config.HEDGE_LATENCY_WINDOW)
+    samples.append(seconds)
+
+def get_hedge_delay(model: str) -> float:
+    """对冲等待时间：该模型最近成功请求耗时的 P95，限制在 [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]。"""
+    samples = _latency_samples.get(model)
+    if not samples or len(samples) < config.HEDGE_MIN_SAMPLES: return config.HEDGE_DEFAULT_DELAY
+    ordered = sorted(samples)
+    percentile_value = ordered[min(len(ordered) - 1, int(len(ordered) * config.HEDGE_LATENCY_PERCENTILE))]
+    return min(config.HEDGE_MAX_DELAY, max(config.HEDGE_MIN_DELAY, percentile_value))
+
+def get_route_models(route: str) -> List[str]:
+    return list(config.MODEL_ROUTES[route]["models"])
+
+def get_primary_model(route: str) -> str:
+    return config.MODEL_ROUTES[route]["models"][0]
+
+def _describe_error(e: Exception) -> str:
+    if isinstance(e, httpx.HTTPStatusError): return f"HTTP {e.response.status_code}"
+    return f"{type(e).__name__}: {e}"
+
+def _error_response(e: Exception) -> dict:
+    """把异常转换成错误响应；网关返回了 HTTP 错误时附带 status_code，调用方据此判断，而不是解析 message 文本。"""
+    error: Dict[str, Any] = {"message": _describe_error(e)}
+    if isinstance(e, httpx.HTTPStatusError): error["status_code"] = e.response.status_code
+    return {"error": error}
+
+async def _timed_call(messages: list, system_prompt_content: str, model: str, use_tools: bool, priority: str,
+                      response_format: Optional[dict] = None) -> dict:
+    started_at = time.monotonic()
+    try:
+        api_response = await call_gemini_api(messages, system_prompt_content, model, use_tools, priority, response_format)
+    except Exception as e:
+        # 在路由层把异常也当作该模型出错，以便继续尝试备用模型
+        return _error_response(e)
+    if "error" not in api_response: _record_latency(model, time.monotonic() - started_at)
+    return api_response
+
+async def call_model_route(route: str, messages: list, system_prompt_content: str, use_tools: bool,
+                           priority: str = concurrency.PRIORITY_DIRECT, response_format: Optional[dict] = None) -> dict:
+    """
+    按 MODEL_ROUTES[route] 调用模型：出错时依次改用备用模型；
+    开启对冲时，主模型超过 P95 耗时仍未返回就同时请求下一个模型，先成功的结果胜出，另一个请求被取消。
+    """
+    models = get_route_models(route)
+    hedge = config.MODEL_ROUTES[route].get("hedge", False)
+    api_response: dict = {"error": {"message": f"路由 {route} 没有可用的模型"}}
+    index = 0
+    while index < len(models):
+        model = models[index]
+        primary = asyncio.create_task(_timed_call(messages, system_prompt_content, model, use_tools, priority, response_format))
+        if not hedge or index + 1 >= len(models):
+            api_response = await primary
+            index += 1
+        else:
+            api_response, index = await _hedged_call(primary, models, index, messages, system_prompt_content, use_tools, priority, response_format)
+        if "error" not in api_response: return api_response
+        if index < len(models): logger.warning(f"[模型路由] {route}: 模型出错 ({api_response['error'].get('message')})，改用 {models[index]}。")
+    return api_response
+
+async def stream_model_route(route: str, messages: list, system_prompt_content: str, use_tools: bool,
+                             on_content: Optional[Callable[[str], Awaitable[None]]] = None,
+                             priority: str = concurrency.PRIORITY_DIRECT) -> dict:
+    """流式版本的 call_model_route：只做顺序回退，不做对冲；已经向用户输出过内容后不再换模型。"""
+    delivered = False
+
+    async def forward_content(text: str):
+        nonlocal delivered
+        delivered = True
+        if on_content: await on_content(text)
+
+    models = get_route_models(route)
+    api_response: dict = {"error": {"message": f"路由 {route} 没有可用的模型"}}
+    for index, model in enumerate(models):
+        try:
+            api_response = await stream_gemini_api(messages, system_prompt_content, model, use_tools, on_content=forward_content, priority=priority)
+        except Exception as e:
+            api_response = _error_response(e)
+        if "error" not in api_response or delivered: return api_response
+        if index + 1 < len(models): logger.warning(f"[模型路由] {route}: 模型出错 ({api_response['error'].get('message')})，改用 {models[index + 1]}。")
+    return api_response
+
+async def _hedged_call(primary: asyncio.Task, models: List[str], index: int, messages: list, system_prompt_content: str,
+                       use_tools: bool, priority: str, response_format: Optional[dict] = None) -> Tuple[dict, int]:
+    """返回 (结果, 下一个要尝试的模型下标)。"""
+    delay = get_hedge_delay(models[index])
+    hedged: Optional[asyncio.Task] = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), index + 1
+        logger.info(f"[模型路由] {models[index]} 超过 {delay:.1f} 秒未返回，向 {models[index + 1]} 发出对冲请求。")
+        hedged = asyncio.create_task(_timed_call(messages, system_prompt_content, models[index + 1], use_tools, priority, response_format))
+        pending = {primary, hedged}
+        api_response: dict = {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                api_response = task.result()
+                if "error" not in api_response:
+                    logger.info(f"[模型路由] {'对冲请求' if task is hedged else '主请求'}先返回结果。")
+                    return api_response, index + 2
+        return api_response, index + 2
+    finally:
+        # asyncio.wait 不会把调用方的取消传给任务，这里统一取消，否则落败或被放弃的请求会一直占着并发名额
+        for task in (primary, hedged):
+            if task is not None: task.cancel()
 
 
 async def call_gemini_vision_api_for_qa(prompt_text: str, image_base64: str) -> str:
@@ -65,19 +289,59 @@ async def call_gemini_vision_api_for_qa(prompt_text: str, image_base64: str) ->
     }
     logger.info(f"发送 Vision API (问答) 请求: {data['model']}")
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(api_url, headers=headers, json=data)
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+        response = await _send_vision_request(api_url, headers, data)
+        return response.json()["choices"][0]["message"]["content"]
     except Exception as e:
         logger.error(f"调用 Vision API (问答) 时出错: {e}", exc_info=True)
         return "喵呜~ 我的视觉模块好像被毛线缠住啦！"
         
+async def _send_vision_request(api_url: str, headers: dict, data: dict) -> httpx.Response:
+    """视觉请求同样按重试策略发送，并与对话请求共用每个模型的熔断器。"""
+    client = http_client.get_gateway_client()
+    async def send(timeout: float) -> httpx.Response:
+        return await client.post(api_url, headers=headers, json=data, timeout=timeout)
+    return await retry_policy.send_with_retry(send, retry_policy.get_vision_policy(), data["model"], config.VISION_REQUEST_TIMEOUT)
+
+_image_summary_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_dedup_stats() -> Dict[str, Any]:
+    return {"llm": dict(_llm_flights.stats), "image_summary": dict(_image_summary_flights.stats)}
+
+def _get_image_summary_semaphore() -> asyncio.Semaphore:
+    global _image_summary_semaphore
+    if _image_summary_semaphore is None:
+        _image_summary_semaphore = asyncio.Semaphore(config.IMAGE_SUMMARY_MAX_CONCURRENCY)
+    return _image_summary_semaphore
+
+async def summarize_images(images_base64: List[str], model_to_use: str, image_digests: Optional[List[Optional[str]]] = None) -> List[str]:
+    """并发地为多张图片生成摘要，结果顺序与输入一致。并发数受全局信号量限制。"""
+    digests = image_digests or [None] * len(images_base64)
+    return list(await asyncio.gather(*(summarize_image_content(b64, model_to_use, digest) for b64, digest in zip(images_base64, digests))))
+
 # 【修改】函数增加 model_to_use 参数
-async def summarize_image_content(image_base64: str, model_to_use: str) -> str:
+async def summarize_image_content(image_base64: str, model_to_use: str, image_digest: Optional[str] = None) -> str:
     """
     专门用于分析图片并返回其文字描述，使用指定的模型。
+    先按图片内容哈希查询摘要缓存；未命中时才请求视觉模型，
+    同时进行的请求数受 IMAGE_SUMMARY_MAX_CONCURRENCY 限制，单张图片超过 IMAGE_SUMMARY_TIMEOUT 记为失败。
     """
+    digest = image_digest or hashlib.sha256(base64.b64decode(image_base64)).hexdigest()
+    cached_summary = summary_cache.get(digest, model_to_use)
+    if cached_summary is not None: return cached_summary
+    # 同一张图片 (例如群历史记录和引用回复同时处理) 只请求一次
+    return await _image_summary_flights.do((digest, model_to_use), lambda: _summarize_uncached(image_base64, model_to_use, digest))
+
+async def _summarize_uncached(image_base64: str, model_to_use: str, digest: str) -> str:
+    async with _get_image_summary_semaphore():
+        try:
+            summary = await asyncio.wait_for(_request_image_summary(image_base64, model_to_use), timeout=config.IMAGE_SUMMARY_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"图片摘要请求超时 ({config.IMAGE_SUMMARY_TIMEOUT}秒)，模型: {model_to_use}")
+            return "[图片分析失败，无法生成描述]"
+    summary_cache.put(digest, model_to_use, summary)
+    return summary
+
+async def _request_image_summary(image_base64: str, model_to_use: str) -> str:
     api_url = f"{config.DEFAULT_API_BASE_URL}/chat/completions"
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {config.DEFAULT_API_TOKEN}"}
     
@@ -91,12 +355,10 @@ async def summarize_image_content(image_base64: str, model_to_use: str) -> str:
 
     logger.info(f"发送 Vision API (图片摘要) 请求，使用模型: {data['model']}")
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(api_url, headers=headers, json=data)
-            response.raise_for_status()
-            summary = response.json()["choices"][0]["message"]["content"]
-            logger.info(f"图片摘要生成成功，长度: {len(summary)}")
-            return summary
+        response = await _send_vision_request(api_url, headers, data)
+        summary = response.json()["choices"][0]["message"]["content"]
+        logger.info(f"图片摘要生成成功，长度: {len(summary)}")
+        return summary
     except Exception as e:
         logger.error(f"调用 Vision API (图片摘要) 时出错: {e}", exc_info=True)
         return "[图片分析失败，无法生成描述]"
\ No newline at end of file
@@ -0,0 +1,112 @@
+# yimao_plugin/member_cache.py
+"""
+群成员显示名 (群名片或昵称) 的 TTL 缓存。
+消息事件自带的 sender 信息、群名片变更通知以及首次见到某个群时批量拉取的成员列表都会刷新缓存，
+记录群消息时不再为每条消息调用一次 get_group_member_info。
+机器人自己的昵称 (get_login_info) 也缓存在这里。
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from nonebot.adapters.onebot.v11 import Bot
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.member_cache")
+
+# (group_id, user_id) -> (显示名, 过期时间)
+_member_names: Dict[Tuple[str, str], Tuple[str, float]] = {}
+# group_id -> 上次批量拉取成员列表的时间
+_prefilled_at: Dict[str, float] = {}
+_prefill_in_progress: Set[str] = set()
+# bot.self_id -> (昵称, 过期时间)
+_bot_nicknames: Dict[str, Tuple[str, float]] = {}
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "api_lookups": 0, "prefills": 0}
+
+def _display_name(info: Any) -> Optional[str]:
+    if info is None: return None
+    if isinstance(info, dict): return info.get("card") or info.get("nickname") or None
+    return getattr(info, "card", None) or getattr(info, "nickname", None) or None
+
+def remember(group_id: str, user_id: str, name: Optional[str]):
+    if not name: return
+    _member_names[(group_id, user_id)] = (name, time.monotonic() + config.MEMBER_NAME_CACHE_TTL)
+
+def forget(group_id: str, user_id: str):
+    _member_names.pop((group_id, user_id), None)
+
+def observe_sender(group_id: str, user_id: str, sender: Any):
+    """用消息事件自带的 sender 信息刷新缓存。"""
+    remember(group_id, user_id, _display_name(sender))
+
+def get_cached(group_id: str, user_id: str) -> Optional[str]:
+    entry = _member_names.get((group_id, user_id))
+    if entry is None: return None
+    name, expires_at = entry
+    if expires_at < time.monotonic():
+        del _member_names[(group_id, user_id)]
+        return None
+    return name
+
+async def get_member_name(bot: Bot, group_id: str, user_id: str, sender: Any = None) -> str:
+    """
+    解析群成员的显示名。优先使用缓存和事件自带的 sender，
+    都没有时才通过 OneBot 查询一次，查询失败则退回到 user_id。
+    """
+    _schedule_prefill(bot, group_id)
+    if sender is not None: observe_sender(group_id, user_id, sender)
+    name = get_cached(group_id, user_id)
+    if name:
+        _stats["hits"] += 1
+        return name
+    _stats["misses"] += 1
+    try:
+        _stats["api_lookups"] += 1
+        member_info = await bot.get_group_member_info(group_id=int(group_id), user_id=int(user_id))
+        name = _display_name(member_info)
+        remember(group_id, user_id, name)
+    except Exception as e:
+        logger.debug(f"查询群({group_id})成员({user_id})信息失败: {e}")
+    return name or user_id
+
+def _schedule_prefill(bot: Bot, group_id: str):
+    prefilled_at = _prefilled_at.get(group_id)
+    if group_id in _prefill_in_progress: return
+    if prefilled_at is not None and time.monotonic() - prefilled_at < config.MEMBER_NAME_CACHE_TTL: return
+    _prefill_in_progress.add(group_id)
+    asyncio.create_task(_prefill_group(bot, group_id))
+
+async def _prefill_group(bot: Bot, group_id: str):
+    try:
+        member_list = await bot.get_group_member_list(group_id=int(group_id))
+        for member_info in member_list:
+            remember(group_id, str(member_info.get("user_id")), _display_name(member_info))
+        _stats["prefills"] += 1
+        logger.info(f"已为群({group_id})预加载 {len(member_list)} 名成员的显示名。")
+    except Exception as e:
+        logger.warning(f"预加载群({group_id})成员列表失败: {e}")
+    finally:
+        # 失败也记下时间，避免每条消息都重新尝试
+        _prefilled_at[group_id] = time.monotonic()
+        _prefill_in_progress.discard(group_id)
+
+async def get_bot_nickname(bot: Bot, default: str = "一猫") -> str:
+    entry = _bot_nicknames.get(bot.self_id)
+    if entry and entry[1] >= time.monotonic(): return entry[0] or default
+    try:
+        nickname = (await bot.get_login_info()).get("nickname") or ""
+    except Exception as e:
+        logger.warning(f"获取机器人昵称失败: {e}")
+        return entry[0] if entry and entry[0] else default
+    _bot_nicknames[bot.self_id] = (nickname, time.monotonic() + config.MEMBER_NAME_CACHE_TTL)
+    return nickname or default
+
+def peek_bot_nickname(bot: Bot) -> str:
+    """只读缓存，不发起查询。"""
+    entry = _bot_nicknames.get(bot.self_id)
+    return entry[0] if entry else ""
+
+def get_stats() -> Dict[str, int]:
+    return {**_stats, "cached_names": len(_member_names), "prefilled_groups": len(_prefilled_at)}
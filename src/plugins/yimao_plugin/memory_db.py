@@ -0,0 +1,142 @@
+# yimao_plugin/memory_db.py
+"""
+基于 SQLite 的增量记忆存储。
+每条对话记录单独占一行，一轮对话只需要追加新产生的记录，
+不再像 JSON 文件那样每次把所有用户的全部历史重写一遍。
+"""
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("GeminiPlugin.memory_db")
+
+_conn: Optional[sqlite3.Connection] = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mode_state (
+    session_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    active_slot_index INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (session_id, mode)
+);
+CREATE TABLE IF NOT EXISTS slot_meta (
+    session_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    slot_index INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    context_summary TEXT NOT NULL DEFAULT '',
+    context_marker TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (session_id, mode, slot_index)
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    slot_index INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_records_slot ON records (session_id, mode, slot_index, id);
+"""
+
+def open_db(path: Path):
+    global _conn
+    if _conn is not None: return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.executescript(_SCHEMA)
+    _migrate_schema()
+    logger.info(f"已打开记忆数据库 {path}。")
+
+def _migrate_schema():
+    columns = {row[1] for row in _conn.execute("PRAGMA table_info(slot_meta)")}
+    for column in ("context_summary", "context_marker"):
+        if column not in columns:
+            _conn.execute(f"ALTER TABLE slot_meta ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+
+def close_db():
+    global _conn
+    if _conn is None: return
+    try: _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.Error as e: logger.warning(f"记忆数据库检查点失败: {e}")
+    _conn.close()
+    _conn = None
+    logger.info("记忆数据库已关闭。")
+
+def vacuum():
+    logger.info("正在压缩记忆数据库文件...")
+    _conn.execute("VACUUM")
+
+def is_open() -> bool:
+    return _conn is not None
+
+def is_empty() -> bool:
+    return _conn.execute("SELECT 1 FROM mode_state LIMIT 1").fetchone() is None
+
+def dumps_record(record: dict) -> str:
+    return json.dumps(record, ensure_ascii=False)
+
+def load_all() -> Tuple[Dict[str, Dict[str, int]], Dict[Tuple[str, str, int], Tuple[str, str, str]], Dict[Tuple[str, str, int], List[Tuple[int, dict]]]]:
+    """一次性读出全部会话状态、插槽摘要和记录 (记录按写入顺序排列，附带行号)。"""
+    active_slots: Dict[str, Dict[str, int]] = {}
+    for session_id, mode, index in _conn.execute("SELECT session_id, mode, active_slot_index FROM mode_state"):
+        active_slots.setdefault(session_id, {})[mode] = index
+    summaries = {
+        (session_id, mode, slot_index): (summary, context_summary, context_marker)
+        for session_id, mode, slot_index, summary, context_summary, context_marker
+        in _conn.execute("SELECT session_id, mode, slot_index, summary, context_summary, context_marker FROM slot_meta")
+    }
+    records: Dict[Tuple[str, str, int], List[Tuple[int, dict]]] = {}
+    for row_id, session_id, mode, slot_index, data in _conn.execute("SELECT id, session_id, mode, slot_index, data FROM records ORDER BY id"):
+        records.setdefault((session_id, mode, slot_index), []).append((row_id, json.loads(data)))
+    return active_slots, summaries, records
+
+def save_mode_state(session_id: str, mode: str, active_slot_index: int, summaries: Iterable[Tuple[int, str, str, str]]):
+    _conn.execute("BEGIN")
+    try:
+        _conn.execute(
+            "INSERT INTO mode_state (session_id, mode, active_slot_index) VALUES (?, ?, ?) "
+            "ON CONFLICT (session_id, mode) DO UPDATE SET active_slot_index = excluded.active_slot_index",
+            (session_id, mode, active_slot_index))
+        _conn.executemany(
+            "INSERT INTO slot_meta (session_id, mode, slot_index, summary, context_summary, context_marker) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (session_id, mode, slot_index) DO UPDATE SET summary = excluded.summary, "
+            "context_summary = excluded.context_summary, context_marker = excluded.context_marker",
+            [(session_id, mode, i, s, cs, cm) for i, s, cs, cm in summaries])
+        _conn.execute("COMMIT")
+    except Exception:
+        _conn.execute("ROLLBACK")
+        raise
+
+def apply_slot_changes(session_id: str, mode: str, slot_index: int, delete_ids: List[int], new_records: List[dict], clear: bool = False) -> List[int]:
+    """在一个事务内删除过期行 (或整槽清空) 并追加新记录，返回新记录的行号。"""
+    new_ids = []
+    _conn.execute("BEGIN")
+    try:
+        if clear:
+            _conn.execute("DELETE FROM records WHERE session_id = ? AND mode = ? AND slot_index = ?", (session_id, mode, slot_index))
+        elif delete_ids:
+            _conn.executemany("DELETE FROM records WHERE id = ?", [(i,) for i in delete_ids])
+        for record in new_records:
+            cursor = _conn.execute(
+                "INSERT INTO records (session_id, mode, slot_index, data) VALUES (?, ?, ?, ?)",
+                (session_id, mode, slot_index, dumps_record(record)))
+            new_ids.append(cursor.lastrowid)
+        _conn.execute("COMMIT")
+    except Exception:
+        _conn.execute("ROLLBACK")
+        raise
+    return new_ids
+
+def delete_sessions(session_ids: List[str]):
+    _conn.execute("BEGIN")
+    try:
+        for table in ("records", "slot_meta", "mode_state"):
+            _conn.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(sid,) for sid in session_ids])
+        _conn.execute("COMMIT")
+    except Exception:
+        _conn.execute("ROLLBACK")
+        raise
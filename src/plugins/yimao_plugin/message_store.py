@@ -0,0 +1,88 @@
+# yimao_plugin/message_store.py
+"""
+最近见过的消息的本地索引 (按 message_id)。
+群聊记录员和机器人自己发出的消息都会登记在这里，处理引用回复时先查这里，查不到才调用 bot.get_msg。
+条目的格式与 get_msg 的返回值一致 (message / sender / time)，另外附带该消息中图片的摘要占位项，
+后台图片队列生成摘要后，这里也能直接拿到。
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from nonebot.adapters.onebot.v11 import Bot, Message, MessageEvent
+
+from . import config, member_cache
+
+logger = logging.getLogger("GeminiPlugin.message_store")
+
+_messages: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+# 会产生新消息的发送接口
+_SEND_APIS = {"send_msg", "send_group_msg", "send_private_msg"}
+
+def _segments_to_raw(message: Any) -> List[Dict[str, Any]]:
+    if isinstance(message, str): message = Message(message)
+    return [{"type": seg.type, "data": dict(seg.data)} for seg in message]
+
+def _store(message_id: Any, entry: Dict[str, Any]):
+    key = str(message_id)
+    _messages[key] = entry
+    _messages.move_to_end(key)
+    while len(_messages) > config.MESSAGE_STORE_MAX_ENTRIES:
+        _messages.popitem(last=False)
+
+def record_event(event: MessageEvent, image_items: Optional[Dict[str, Dict[str, Any]]] = None):
+    """
+    登记收到的消息。image_items 是 {图片URL: 群历史中的图片项}，
+    与群历史共享同一个对象，因此摘要生成后这里自动可见。
+    """
+    _store(event.message_id, {
+        "message_id": event.message_id,
+        "time": event.time,
+        "message": _segments_to_raw(event.message),
+        "sender": {"user_id": event.user_id, "nickname": event.sender.nickname or "", "card": event.sender.card or ""},
+        "image_items": image_items or {},
+    })
+
+def record_sent(bot: Bot, message_id: Any, message: Any):
+    _store(message_id, {
+        "message_id": message_id,
+        "time": int(time.time()),
+        "message": _segments_to_raw(message),
+        "sender": {"user_id": int(bot.self_id), "nickname": member_cache.peek_bot_nickname(bot), "card": ""},
+        "image_items": {},
+    })
+
+def get(message_id: Any) -> Optional[Dict[str, Any]]:
+    return _messages.get(str(message_id))
+
+async def get_message(bot: Bot, message_id: Any) -> Dict[str, Any]:
+    """先查本地索引，查不到再通过 OneBot 的 get_msg 获取 (并登记结果)。get_msg 失败时抛出异常。"""
+    entry = get(message_id)
+    if entry is not None:
+        _stats["hits"] += 1
+        return entry
+    _stats["misses"] += 1
+    replied_msg_info = await bot.get_msg(message_id=message_id)
+    raw_msg = replied_msg_info.get("message", "")
+    if isinstance(raw_msg, dict): replied_msg_info["message"] = [raw_msg]
+    _store(message_id, replied_msg_info)
+    return replied_msg_info
+
+def get_image_summary(entry: Dict[str, Any], img_url: str) -> Optional[str]:
+    item = entry.get("image_items", {}).get(img_url)
+    if item and item.get("type") == "image": return item.get("summary")
+    return None
+
+@Bot.on_called_api
+async def _record_bot_send(bot: Bot, exception: Optional[Exception], api: str, data: Dict[str, Any], result: Any):
+    if exception is not None or api not in _SEND_APIS or not isinstance(result, dict): return
+    message_id = result.get("message_id")
+    if message_id is None: return
+    try: record_sent(bot, message_id, data.get("message", ""))
+    except Exception as e: logger.debug(f"登记机器人发送的消息({message_id})失败: {e}")
+
+def get_stats() -> Dict[str, int]:
+    return {**_stats, "stored": len(_messages)}
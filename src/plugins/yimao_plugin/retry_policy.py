@@ -0,0 +1,154 @@
+# yimao_plugin/retry_policy.py
+"""
+访问 LLM 网关的重试策略和熔断器。
+- 指数退避 + 全抖动 (full jitter)，服务端给了 Retry-After 时以它为准；
+- 每个请求有总截止时间，单次尝试的超时也不会超过剩余时间；
+- 每个模型一个熔断器：连续失败达到阈值后一段时间内直接失败，不再让每个用户都等完整的重试流程。
+"""
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.retry")
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发出。"""
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float, deadline: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff_delay(self, attempt: int) -> float:
+        """第 attempt 次 (从 0 开始) 失败后的等待时间：[0, min(max_delay, base * 2^attempt)] 内均匀随机。"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+class CircuitBreaker:
+    """closed -> (连续失败达到阈值) -> open -> (冷却结束) -> half-open，放行一个探测请求，成功则恢复，失败则重新打开。"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None: return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout: return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed": return True
+        if state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self._opened_at is not None: logger.info(f"模型 {self.name} 的熔断器已恢复。")
+        self._failures, self._opened_at, self._probe_in_flight = 0, None, False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probe_in_flight or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._probe_in_flight:
+                logger.warning(f"模型 {self.name} 连续失败 {self._failures} 次，熔断 {self.reset_timeout} 秒。")
+            self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """探测请求因为与网关无关的原因 (如客户端错误) 结束时，允许下一个请求继续探测。"""
+        self._probe_in_flight = False
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(model: str) -> CircuitBreaker:
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = CircuitBreaker(model, config.CIRCUIT_BREAKER_FAILURE_THRESHOLD, config.CIRCUIT_BREAKER_RESET_TIMEOUT)
+        _breakers[model] = breaker
+    return breaker
+
+def get_llm_policy() -> RetryPolicy:
+    return RetryPolicy(config.LLM_RETRY_MAX_ATTEMPTS, config.LLM_RETRY_BASE_DELAY, config.LLM_RETRY_MAX_DELAY, config.LLM_RETRY_DEADLINE)
+
+def get_vision_policy() -> RetryPolicy:
+    return RetryPolicy(config.VISION_RETRY_MAX_ATTEMPTS, config.LLM_RETRY_BASE_DELAY, config.LLM_RETRY_MAX_DELAY, config.VISION_RETRY_DEADLINE)
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+def record_attempt_error(breaker: CircuitBreaker, error: BaseException, probing: bool):
+    """
+    不经过 send_with_retry 的单次请求 (如流式请求) 出错后的熔断器记账，规则与 send_with_retry 相同：
+    网关侧的错误计入失败；客户端错误、取消等与网关无关的结束只归还探测名额 (如果这次请求占用了它)。
+    """
+    if isinstance(error, Exception) and _is_retryable(error): breaker.record_failure()
+    elif probing: breaker.release_probe()
+
+async def send_with_retry(send: Callable[[float], Awaitable[httpx.Response]], policy: RetryPolicy, model: str, request_timeout: float) -> httpx.Response:
+    """
+    按策略反复调用 send(本次超时秒数)，直到拿到 2xx 响应。
+    不可重试的错误 (如 400) 立即抛出；重试用尽或超过截止时间时抛出最后一次的错误；熔断时抛出 CircuitOpenError。
+    """
+    breaker = get_breaker(model)
+    started_at = time.monotonic()
+    attempt = 0
+    while True:
+        probing = breaker.state == "half-open"
+        if not breaker.allow():
+            raise CircuitOpenError(f"模型 {model} 暂时不可用 (熔断中)，请稍后再试")
+        remaining = policy.deadline - (time.monotonic() - started_at)
+        try:
+            logger.info(f"向LLM发送API请求 (尝试 {attempt + 1}/{policy.max_attempts})，模型: {model}")
+            response = await send(min(request_timeout, max(remaining, 1.0)))
+            response.raise_for_status()
+            breaker.record_success()
+            return response
+        except Exception as e:
+            if not _is_retryable(e):
+                breaker.release_probe()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            retry_after = parse_retry_after(e.response) if isinstance(e, httpx.HTTPStatusError) else None
+            delay = retry_after if retry_after is not None else policy.backoff_delay(attempt - 1)
+            elapsed = time.monotonic() - started_at
+            if attempt >= policy.max_attempts or elapsed + delay >= policy.deadline:
+                logger.error(f"调用模型 {model} 失败，已尝试 {attempt} 次，耗时 {elapsed:.1f} 秒，不再重试: {e!r}")
+                raise
+            reason = f"HTTP {e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+            logger.warning(f"调用模型 {model} 失败 ({reason})，{delay:.2f} 秒后重试{' (遵循 Retry-After)' if retry_after is not None else ''}...")
+            await asyncio.sleep(delay)
+        except BaseException:
+            # 被取消 (对冲落败、主动聊天决策过时等) 时既不算成功也不算失败，但探测名额必须归还，否则熔断器会一直停在半开状态
+            if probing: breaker.release_probe()
+            raise
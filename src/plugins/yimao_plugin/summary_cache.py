@@ -0,0 +1,106 @@
+# yimao_plugin/summary_cache.py
+"""
+图片摘要缓存：以 (图片内容哈希, 模型名) 为键，把生成过的图片描述持久化到 SQLite。
+同一个表情包/梗图无论在哪个群被谁发出来，都只需要调用一次视觉模型。
+内存里保留一份较小的 LRU 热点副本，磁盘上按最近使用时间淘汰。
+"""
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from . import config
+
+logger = logging.getLogger("GeminiPlugin.summary_cache")
+
+_conn: Optional[sqlite3.Connection] = None
+_hot_entries: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_disk_entry_count = 0
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+# 这些前缀代表摘要失败，不应该被缓存
+_FAILURE_PREFIXES = ("[图片分析失败",)
+
+def _get_cache_path() -> Path:
+    return Path(config.IMAGE_SUMMARY_CACHE_PATH)
+
+def open_cache():
+    global _conn, _disk_entry_count
+    if _conn is not None: return
+    path = _get_cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute(
+        "CREATE TABLE IF NOT EXISTS image_summaries ("
+        "digest TEXT NOT NULL, model TEXT NOT NULL, summary TEXT NOT NULL, last_used REAL NOT NULL, "
+        "PRIMARY KEY (digest, model))")
+    _conn.execute("CREATE INDEX IF NOT EXISTS idx_image_summaries_last_used ON image_summaries (last_used)")
+    _disk_entry_count = _conn.execute("SELECT COUNT(*) FROM image_summaries").fetchone()[0]
+    logger.info(f"已打开图片摘要缓存 {path}，共 {_disk_entry_count} 条。")
+
+def close_cache():
+    global _conn
+    if _conn is None: return
+    _conn.close()
+    _conn = None
+    logger.info(f"图片摘要缓存已关闭。统计: {get_stats()}")
+
+def _remember_hot(key: Tuple[str, str], summary: str):
+    _hot_entries[key] = summary
+    _hot_entries.move_to_end(key)
+    while len(_hot_entries) > config.IMAGE_SUMMARY_CACHE_MEMORY_ENTRIES:
+        _hot_entries.popitem(last=False)
+
+def get(digest: str, model: str) -> Optional[str]:
+    key = (digest, model)
+    summary = _hot_entries.get(key)
+    if summary is None and _conn is not None:
+        row = _conn.execute("SELECT summary FROM image_summaries WHERE digest = ? AND model = ?", key).fetchone()
+        if row: summary = row[0]
+    if summary is None:
+        _stats["misses"] += 1
+        return None
+    _stats["hits"] += 1
+    _remember_hot(key, summary)
+    if _conn is not None:
+        try: _conn.execute("UPDATE image_summaries SET last_used = ? WHERE digest = ? AND model = ?", (time.time(), digest, model))
+        except sqlite3.Error as e: logger.warning(f"更新图片摘要缓存使用时间失败: {e}")
+    logger.debug(f"图片摘要缓存命中: {digest[:12]} ({model})")
+    return summary
+
+def put(digest: str, model: str, summary: str):
+    global _disk_entry_count
+    if not summary or summary.startswith(_FAILURE_PREFIXES): return
+    key = (digest, model)
+    _remember_hot(key, summary)
+    _stats["stores"] += 1
+    if _conn is None: return
+    try:
+        is_new = _conn.execute("SELECT 1 FROM image_summaries WHERE digest = ? AND model = ?", key).fetchone() is None
+        _conn.execute(
+            "INSERT INTO image_summaries (digest, model, summary, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (digest, model) DO UPDATE SET summary = excluded.summary, last_used = excluded.last_used",
+            (digest, model, summary, time.time()))
+        if is_new: _disk_entry_count += 1
+        overflow = _disk_entry_count - config.IMAGE_SUMMARY_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            _conn.execute(
+                "DELETE FROM image_summaries WHERE rowid IN (SELECT rowid FROM image_summaries ORDER BY last_used LIMIT ?)",
+                (overflow,))
+            _disk_entry_count -= overflow
+            _stats["evictions"] += overflow
+    except sqlite3.Error as e:
+        logger.error(f"写入图片摘要缓存失败: {e}")
+
+def get_stats() -> Dict[str, int]:
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate_percent": round(_stats["hits"] * 100 / lookups) if lookups else 0,
+        "memory_entries": len(_hot_entries),
+        "disk_entries": _disk_entry_count,
+    }
@@ -1,135 +1,250 @@
 # yimao_plugin/tools.py
 import asyncio
+import datetime
 import httpx
+import json
 import logging
-import requests
-from . import config
-
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+from . import config, http_client
+from .async_cache import SingleFlight, TTLCache
 
 
 logger = logging.getLogger("GeminiPlugin.tools")
 
 
+# --- 【新增】搜索结果缓存与配额统计 ---
+# 规范化后的查询 -> 结果文本
+_search_cache: Optional[TTLCache] = None
+_search_quota: Optional[Dict[str, Any]] = None
+_search_stats: Dict[str, int] = {"cache_hits": 0, "api_calls": 0, "quota_refusals": 0}
+
+def normalize_search_query(query: str) -> str:
+    """全角转半角、小写、合并空白，使仅有大小写或空格差异的同一问题命中同一条缓存。"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+def _get_search_cache() -> TTLCache:
+    global _search_cache
+    if _search_cache is None: _search_cache = TTLCache(config.GOOGLE_SEARCH_CACHE_TTL, config.GOOGLE_SEARCH_CACHE_MAX_ENTRIES)
+    return _search_cache
+
+def _quota_day() -> str:
+    # Custom Search 的每日配额按太平洋时间零点重置
+    return datetime.datetime.now(ZoneInfo("America/Los_Angeles")).strftime("%Y-%m-%d")
+
+def _get_search_quota() -> Dict[str, Any]:
+    global _search_quota
+    if _search_quota is None:
+        _search_quota = {"day": "", "used": 0, "exhausted": False}
+        path = Path(config.GOOGLE_SEARCH_QUOTA_FILE_PATH)
+        if path.exists():
+            try: _search_quota.update(json.loads(path.read_text(encoding="utf-8")))
+            except (OSError, json.JSONDecodeError) as e: logger.warning(f"读取搜索配额记录失败: {e}")
+    today = _quota_day()
+    if _search_quota["day"] != today:
+        _search_quota.update(day=today, used=0, exhausted=False)
+    return _search_quota
+
+def _save_search_quota():
+    path = Path(config.GOOGLE_SEARCH_QUOTA_FILE_PATH)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(_search_quota), encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"保存搜索配额记录失败: {e}")
+
 async def search_web(query: str) -> str:
     """使用 Google Programmable Search Engine 执行通用的网页搜索。"""
+    cache_key = normalize_search_query(query)
+    cached_result = _get_search_cache().get(cache_key)
+    if cached_result is not None:
+        _search_stats["cache_hits"] += 1
+        logger.info(f"网页搜索命中缓存: {query}")
+        return cached_result
+
+    quota = _get_search_quota()
+    if quota["exhausted"] or quota["used"] >= config.GOOGLE_SEARCH_DAILY_QUOTA:
+        _search_stats["quota_refusals"] += 1
+        logger.warning(f"今日 Google 搜索配额已用 {quota['used']}/{config.GOOGLE_SEARCH_DAILY_QUOTA}，不再发出请求。")
+        return "工具错误：今天使用 Google 搜索的次数已经用完啦，请明天再试吧！"
+
     logger.info(f"正在使用 Google API 执行网页搜索: {query}")
     try:
-        def _sync_google_search():
-            # 【全新实现，使用requests，代理支持更好】
-            proxies = {}
-            if config.HTTP_PROXY:
-                # requests库能自动处理 http/https/socks 代理
-                # 关键：SOCKS5代理需要写成 socks5h://
-                proxy_url = f"socks5h://{config.HTTP_PROXY.split('//')[1]}"
-                proxies['http'] = proxy_url
-                proxies['https' ] = proxy_url
-                logger.info(f"已配置代理: {proxies}")
-
-            # Google API的URL
-            api_url = "https://www.googleapis.com/customsearch/v1"
-            
-            params = {
-                'key': config.GOOGLE_API_KEY,
-                'cx': config.GOOGLE_CSE_ID,
-                'q': query,
-                'num': 5
-            }
+        # Google API的URL
+        api_url = "https://www.googleapis.com/customsearch/v1"
+        
+        params = {
+            'key': config.GOOGLE_API_KEY,
+            'cx': config.GOOGLE_CSE_ID,
+            'q': query,
+            'num': 5
+        }
 
-            response = requests.get(api_url, params=params, proxies=proxies, timeout=20)
-            response.raise_for_status() # 如果状态码不是2xx，则抛出异常
-            
-            res = response.json()
+        # 每次真正发出的请求都计入配额 (包括失败的)
+        quota["used"] += 1
+        _search_stats["api_calls"] += 1
+        _save_search_quota()
+        logger.info(f"今日 Google 搜索配额已用 {quota['used']}/{config.GOOGLE_SEARCH_DAILY_QUOTA}，缓存命中 {_search_stats['cache_hits']} 次。")
+        response = await http_client.get_search_client().get(api_url, params=params)
+        response.raise_for_status() # 如果状态码不是2xx，则抛出异常
+        
+        res = response.json()
 
-            if not res.get('items'):
-                return f"通过 Google 搜索“{query}”没有找到相关信息。"
-            
+        if not res.get('items'):
+            result_str = f"通过 Google 搜索“{query}”没有找到相关信息。"
+        else:
             results = res['items']
             formatted_results = "\n".join(
                 [f"- **{r['title']}**: {r.get('snippet', '无摘要')}" for r in results]
             )
-            return f"这是关于“{query}”的Google搜索结果：\n{formatted_results}"
-
-        result_str = await asyncio.to_thread(_sync_google_search)
+            result_str = f"这是关于“{query}”的Google搜索结果：\n{formatted_results}"
+        _get_search_cache().put(cache_key, result_str)
         return result_str
 
-    except requests.exceptions.ProxyError as e:
+    except httpx.ProxyError as e:
         logger.error(f"代理连接失败: {e}", exc_info=True)
         return "工具错误：无法连接到本地代理服务器，请检查代理软件是否开启或端口是否正确。"
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error(f"请求Google API超时")
         return "工具错误：通过代理访问Google API超时，请检查代理节点是否通畅。"
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPStatusError as e:
+        logger.error(f"请求Google API时发生HTTP错误: {e.response.status_code} - {e.response.text}")
+        if e.response.status_code == 429:
+            quota["exhausted"] = True
+            _save_search_quota()
+            return "工具错误：今天使用 Google 搜索的次数已经用完啦，请明天再试吧！"
+        return f"工具错误：Google搜索服务出现网络问题。"
+    except httpx.RequestError as e:
         logger.error(f"请求Google API时发生网络错误: {e}", exc_info=True)
-        if e.response is not None and e.response.status_code == 429:
-             return "工具错误：今天使用 Google 搜索的次数已经用完啦，请明天再试吧！"
         return f"工具错误：Google搜索服务出现网络问题。"
     except Exception as e:
         logger.error(f"Google网页搜索失败: {e}", exc_info=True)
         return f"工具错误：网页搜索功能在执行查询“{query}”时遇到内部错误。"
 
 
+# --- 【新增】天气查询缓存 ---
+# 城市名 -> (地点ID, 完整地名)，地点ID基本不会变，缓存较久；天气数据按地点ID短时间缓存
+_weather_location_cache: Optional[TTLCache] = None
+_weather_data_cache: Optional[TTLCache] = None
+# 同一城市/地点的并发查询合并为一组上游请求
+_weather_flights = SingleFlight()
+
+def _get_weather_caches() -> Tuple[TTLCache, TTLCache]:
+    global _weather_location_cache, _weather_data_cache
+    if _weather_location_cache is None:
+        _weather_location_cache = TTLCache(config.WEATHER_LOCATION_CACHE_TTL, config.WEATHER_CACHE_MAX_ENTRIES)
+        _weather_data_cache = TTLCache(config.WEATHER_DATA_CACHE_TTL, config.WEATHER_CACHE_MAX_ENTRIES)
+    return _weather_location_cache, _weather_data_cache
+
+async def _lookup_weather_location(location: str) -> Optional[Tuple[str, str]]:
+    """返回 (地点ID, 完整地名)，找不到时返回 None。"""
+    location_cache, _ = _get_weather_caches()
+    key = normalize_search_query(location)
+    cached = location_cache.get(key)
+    if cached is not None: return cached
+
+    async def fetch() -> Optional[Tuple[str, str]]:
+        lookup_url = f"https://{config.QWEATHER_API_HOST}/geo/v2/city/lookup"
+        params = {"location": location, "key": config.QWEATHER_API_KEY}
+        resp_lookup = await http_client.get_client().get(lookup_url, params=params, timeout=10.0)
+        resp_lookup.raise_for_status()
+        data_lookup = resp_lookup.json()
+
+        if data_lookup.get("code") != "200" or not data_lookup.get("location"):
+            logger.warning(f"无法找到地点 '{location}' 的ID: {data_lookup}")
+            return None
+        
+        location_info = data_lookup["location"][0]
+        actual_city_name = f"{location_info.get('country', '')} {location_info.get('adm1', '')} {location_info.get('name', '')}".strip()
+        logger.info(f"成功获取地点ID: {location_info['id']} for {actual_city_name}")
+        result = (location_info["id"], actual_city_name)
+        location_cache.put(key, result)
+        return result
+
+    return await _weather_flights.do(("lookup", key), fetch)
+
+async def _get_weather_data(location_id: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """返回 (实时天气, 7日预报) 的原始数据。"""
+    _, data_cache = _get_weather_caches()
+    cached = data_cache.get(location_id)
+    if cached is not None:
+        logger.info(f"天气数据命中缓存: {location_id}")
+        return cached
+
+    async def fetch() -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        client = http_client.get_client()
+
+        async def get_now():
+            url = f"https://{config.QWEATHER_API_HOST}/v7/weather/now"
+            params = {"location": location_id, "key": config.QWEATHER_API_KEY}
+            return await client.get(url, params=params, timeout=10.0)
+
+        async def get_7d_forecast():
+            url = f"https://{config.QWEATHER_API_HOST}/v7/weather/7d"
+            params = {"location": location_id, "key": config.QWEATHER_API_KEY}
+            return await client.get(url, params=params, timeout=10.0)
+
+        responses = await asyncio.gather(get_now(), get_7d_forecast())
+        for resp in responses: resp.raise_for_status()
+        result = (responses[0].json(), responses[1].json())
+        # 只缓存两部分都成功的数据
+        if result[0].get("code") == "200" and result[1].get("code") == "200": data_cache.put(location_id, result)
+        return result
+
+    return await _weather_flights.do(("data", location_id), fetch)
+
 async def search_weather(location: str) -> str:
     """查询指定地点的实时天气和未来7天的天气预报。"""
     logger.info(f"正在为 '{location}' 查询天气(实时+7日预报)...")
-    async with httpx.AsyncClient() as client:
-        try:
-            lookup_url = f"https://{config.QWEATHER_API_HOST}/geo/v2/city/lookup"
-            params = {"location": location, "key": config.QWEATHER_API_KEY}
-            resp_lookup = await client.get(lookup_url, params=params, timeout=10.0)
-            resp_lookup.raise_for_status()
-            data_lookup = resp_lookup.json()
-
-            if data_lookup.get("code") != "200" or not data_lookup.get("location"):
-                logger.warning(f"无法找到地点 '{location}' 的ID: {data_lookup}")
-                return f"找不到地区 '{location}' 的天气信息，请换一个更具体的城市名称试试。"
-            
-            location_info = data_lookup["location"][0]
-            location_id = location_info["id"]
-            actual_city_name = f"{location_info.get('country', '')} {location_info.get('adm1', '')} {location_info.get('name', '')}".strip()
-            logger.info(f"成功获取地点ID: {location_id} for {actual_city_name}")
-
-            async def get_now():
-                url = f"https://{config.QWEATHER_API_HOST}/v7/weather/now"
-                params = {"location": location_id, "key": config.QWEATHER_API_KEY}
-                return await client.get(url, params=params, timeout=10.0)
-
-            async def get_7d_forecast():
-                url = f"https://{config.QWEATHER_API_HOST}/v7/weather/7d"
-                params = {"location": location_id, "key": config.QWEATHER_API_KEY}
-                return await client.get(url, params=params, timeout=10.0)
-
-            responses = await asyncio.gather(get_now(), get_7d_forecast())
-            for resp in responses: resp.raise_for_status()
-            
-            data_now_raw, data_7d_raw = responses[0].json(), responses[1].json()
-            
-            now_result = "实时天气获取失败。"
-            if data_now_raw.get("code") == "200" and data_now_raw.get("now"):
-                now = data_now_raw["now"]
-                now_result = f"天气: {now.get('text', 'N/A')}\n体感温度: {now.get('feelsLike', 'N/A')}°C (实际: {now.get('temp', 'N/A')}°C)\n风: {now.get('windDir', 'N/A')} {now.get('windScale', 'N/A')}级\n湿度: {now.get('humidity', 'N/A')}% | 压强: {now.get('pressure', 'N/A')}hPa"
-
-            forecast_result = "天气预报获取失败。"
-            if data_7d_raw.get("code") == "200" and data_7d_raw.get("daily"):
-                forecasts = [f"  - {day['fxDate']}: {day['textDay']}转{day['textNight']}, 温度 {day['tempMin']}~{day['tempMax']}°C, 紫外线{day['uvIndex']}级" for day in data_7d_raw["daily"]]
-                forecast_result = "【未来7日天气预报】\n" + "\n".join(forecasts)
-            
-            update_time_str = data_now_raw.get("updateTime", "未知").replace("T", " ").replace("+08:00", "")
-            return f"查询地点: {actual_city_name}\n更新时间: {update_time_str}\n--------------------\n【实时天气】\n{now_result}\n--------------------\n{forecast_result}".strip()
-
-        except httpx.HTTPStatusError as e:
-            logger.error(f"天气API请求失败 (HTTP状态码): {e.response.status_code} - {e.response.text}")
-            return f"天气服务出现网络问题 (HTTP {e.response.status_code})。"
-        except Exception as e:
-            logger.error(f"查询天气时发生未知错误: {e}", exc_info=True)
-            return f"查询天气时发生了未知错误: {e}"
+    try:
+        location_result = await _lookup_weather_location(location)
+        if location_result is None:
+            return f"找不到地区 '{location}' 的天气信息，请换一个更具体的城市名称试试。"
+        location_id, actual_city_name = location_result
+
+        data_now_raw, data_7d_raw = await _get_weather_data(location_id)
+        
+        now_result = "实时天气获取失败。"
+        if data_now_raw.get("code") == "200" and data_now_raw.get("now"):
+            now = data_now_raw["now"]
+            now_result = f"天气: {now.get('text', 'N/A')}\n体感温度: {now.get('feelsLike', 'N/A')}°C (实际: {now.get('temp', 'N/A')}°C)\n风: {now.get('windDir', 'N/A')} {now.get('windScale', 'N/A')}级\n湿度: {now.get('humidity', 'N/A')}% | 压强: {now.get('pressure', 'N/A')}hPa"
+
+        forecast_result = "天气预报获取失败。"
+        if data_7d_raw.get("code") == "200" and data_7d_raw.get("daily"):
+            forecasts = [f"  - {day['fxDate']}: {day['textDay']}转{day['textNight']}, 温度 {day['tempMin']}~{day['tempMax']}°C, 紫外线{day['uvIndex']}级" for day in data_7d_raw["daily"]]
+            forecast_result = "【未来7日天气预报】\n" + "\n".join(forecasts)
+        
+        update_time_str = data_now_raw.get("updateTime", "未知").replace("T", " ").replace("+08:00", "")
+        return f"查询地点: {actual_city_name}\n更新时间: {update_time_str}\n--------------------\n【实时天气】\n{now_result}\n--------------------\n{forecast_result}".strip()
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"天气API请求失败 (HTTP状态码): {e.response.status_code} - {e.response.text}")
+        return f"天气服务出现网络问题 (HTTP {e.response.status_code})。"
+    except Exception as e:
+        logger.error(f"查询天气时发生未知错误: {e}", exc_info=True)
+        return f"查询天气时发生了未知错误: {e}"
 
 available_tools = {
     "search_web": search_web,
     "search_weather": search_weather,
 }
 
+async def run_tool_call(tool_call: dict) -> str:
+    """执行模型请求的一次工具调用，超过该工具的超时时间或出错时返回错误说明，而不是让整轮对话失败。"""
+    function_name = tool_call["function"]["name"]
+    timeout = config.TOOL_CALL_TIMEOUTS.get(function_name, config.TOOL_CALL_DEFAULT_TIMEOUT)
+    try:
+        function_args = json.loads(tool_call["function"].get("arguments") or "{}")
+        return await asyncio.wait_for(available_tools[function_name](**function_args), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"工具 {function_name} 执行超时 ({timeout}秒)")
+        return f"工具错误：{function_name} 在 {timeout} 秒内没有返回结果。"
+    except Exception as e:
+        logger.error(f"执行工具 {function_name} 时出错: {e}", exc_info=True)
+        return f"工具错误：{function_name} 执行失败。"
+
 tools_definition_openai = [
     {
         "type": "function",
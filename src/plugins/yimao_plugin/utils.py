@@ -1,7 +1,9 @@
 # yimao_plugin/utils.py
+import json
 import logging
-import datetime
-from . import config, data_store
+import time
+from typing import Any, Dict, List, Optional
+from . import config, data_store, forward_cache, group_history
 from nonebot.adapters.onebot.v11 import Bot, Event, GroupMessageEvent
 
 logger = logging.getLogger("GeminiPlugin.utils")
@@ -38,51 +40,115 @@ def get_help_menu() -> str:
         "描述: 显示此帮助菜单。"
     )
 
+def _build_forward_nodes(bot: Bot, chunks: List[str], bot_name: str) -> List[Dict[str, Any]]:
+    return [
+        {"type": "node", "data": {"uin": bot.self_id, "name": bot_name, "content": chunk}}
+        for chunk in chunks
+    ]
+
+async def _send_forward_nodes(bot: Bot, event: Event, forward_nodes: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if isinstance(event, GroupMessageEvent):
+        return await bot.send_group_forward_msg(group_id=event.group_id, messages=forward_nodes)
+    return await bot.send_private_forward_msg(user_id=event.user_id, messages=forward_nodes)
+
+def _record_forward_sent(bot: Bot, event: Event, content: str, bot_name: str, sent_receipts: List[Optional[Dict[str, Any]]]):
+    """合并转发发送成功后：把机器人的发言写回群历史，并缓存每条转发消息对应的完整内容。"""
+    if isinstance(event, GroupMessageEvent):
+        # 【核心修改】在这里把机器人的发言写回历史记录
+        history = data_store.get_group_history(str(event.group_id))
+        # 记录完整的原始内容
+        history.append(group_history.GroupMessage(bot.self_id, bot_name, content, is_bot=True))
+        logger.debug(f"[回写] 已记录机器人长消息到群({event.group_id})历史。")
+
+    # 【修复】在这里调用缓存函数，将发送成功的长消息内容进行缓存 (私聊同样缓存，以备未来扩展)
+    for sent_receipt in sent_receipts:
+        if sent_receipt and 'message_id' in sent_receipt:
+            forward_cache.put(str(sent_receipt['message_id']), content)
+
 async def send_long_message_as_forward(bot: Bot, event: Event, content: str, bot_name: str):
     """将长文本按指定大小分割后，作为合并转发消息发送，并缓存其内容。"""
     
     chunk_size = config.FORWARD_NODE_CHUNK_SIZE
     content_chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
     
-    forward_nodes = [
-        {"type": "node", "data": {"uin": bot.self_id, "name": bot_name, "content": chunk}}
-        for chunk in content_chunks
-    ]
-    
     try:
-        sent_receipt = None
-        if isinstance(event, GroupMessageEvent):
-            sent_receipt = await bot.send_group_forward_msg(group_id=event.group_id, messages=forward_nodes)
-            
-            # 【核心修改】在这里把机器人的发言写回历史记录
-            history = data_store.get_group_history(str(event.group_id))
-            structured_message = {
-                "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "user_id": bot.self_id,
-                "user_name": bot_name,
-                "content": content, # 记录完整的原始内容
-                "is_bot": True
-            }
-            history.append(structured_message)
-            logger.debug(f"[回写] 已记录机器人长消息到群({event.group_id})历史。")
-
-            # 【修复】在这里调用缓存函数，将发送成功的长消息内容进行缓存
-            if sent_receipt and 'message_id' in sent_receipt:
-                message_id = int(sent_receipt['message_id'])
-                data_store.cache_forward_content(message_id, content)
-
-        else:
-            # 私聊部分暂时不处理主动聊天，所以可以不写回
-            sent_receipt = await bot.send_private_forward_msg(user_id=event.user_id, messages=forward_nodes)
-            
-            # 【修复】同样为私聊添加缓存逻辑，以备未来扩展
-            if sent_receipt and 'message_id' in sent_receipt:
-                message_id = int(sent_receipt['message_id'])
-                data_store.cache_forward_content(message_id, content)
-
+        sent_receipt = await _send_forward_nodes(bot, event, _build_forward_nodes(bot, content_chunks, bot_name))
+        _record_forward_sent(bot, event, content, bot_name, [sent_receipt])
         return sent_receipt # 返回发送回执
         
     except Exception as e:
         logger.error(f"发送合并转发消息失败: {e}", exc_info=True)
         await bot.send(event, message="喵呜~ 我想说的内容太多，被QQ拦截了，没办法发出来...")
-        return None
\ No newline at end of file
+        return None
+
+
+class ProgressiveForwardSender:
+    """
+    配合流式响应使用：每攒够 FORWARD_NODE_CHUNK_SIZE 个字就立刻以一条合并转发发出，
+    不必等整段回复生成完。分块边界与 send_long_message_as_forward 相同。
+    """
+
+    def __init__(self, bot: Bot, event: Event, bot_name: str, started_at: Optional[float] = None):
+        self.bot, self.event, self.bot_name = bot, event, bot_name
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self._buffer: List[str] = []
+        self._buffered_length = 0
+        self._content_parts: List[str] = []
+        self._receipts: List[Optional[Dict[str, Any]]] = []
+        self._failed = False
+
+    @property
+    def started(self) -> bool:
+        """是否已经发出过至少一条 (或尝试发出过)。"""
+        return bool(self._receipts) or self._failed
+
+    async def feed(self, text: str):
+        self._buffer.append(text)
+        self._content_parts.append(text)
+        self._buffered_length += len(text)
+        chunk_size = config.FORWARD_NODE_CHUNK_SIZE
+        while self._buffered_length >= chunk_size:
+            pending = "".join(self._buffer)
+            await self._send_chunk(pending[:chunk_size])
+            rest = pending[chunk_size:]
+            self._buffer, self._buffered_length = ([rest] if rest else []), len(rest)
+
+    async def finish(self) -> Optional[Dict[str, Any]]:
+        """发出剩余内容，完成历史回写和内容缓存，返回第一条转发消息的回执。"""
+        if self._buffered_length:
+            await self._send_chunk("".join(self._buffer))
+            self._buffer, self._buffered_length = [], 0
+        content = "".join(self._content_parts)
+        if self._failed:
+            await self.bot.send(self.event, message="喵呜~ 我想说的内容太多，被QQ拦截了，没办法发出来...")
+        if self._receipts: _record_forward_sent(self.bot, self.event, content, self.bot_name, self._receipts)
+        logger.info(f"[流式] 共发出 {len(self._receipts)} 条合并转发，总耗时 {time.monotonic() - self.started_at:.2f} 秒。")
+        return next((receipt for receipt in self._receipts if receipt), None)
+
+    async def _send_chunk(self, chunk: str):
+        try:
+            receipt = await _send_forward_nodes(self.bot, self.event, _build_forward_nodes(self.bot, [chunk], self.bot_name))
+        except Exception as e:
+            logger.error(f"发送合并转发消息失败: {e}", exc_info=True)
+            self._failed = True
+            return
+        if not self._receipts:
+            logger.info(f"[流式] 首条合并转发已发出，距请求开始 {time.monotonic() - self.started_at:.2f} 秒。")
+        self._receipts.append(receipt)
+
+def extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """
+    从模型输出中取出第一个 JSON 对象：容忍 ```json 代码块、前后的解释文字以及对象后面多余的内容。
+    找不到可解析的对象时返回 None。
+    """
+    if not text: return None
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            obj, _ = decoder.raw_decode(text, start)
+            if isinstance(obj, dict): return obj
+        except json.JSONDecodeError:
+            pass
+        start = text.find("{", start + 1)
+    return None
@@ -0,0 +1,16 @@
+# tests/conftest.py
+"""
+把插件目录注册为独立的 yimao_plugin 包：不执行插件的 __init__.py，因此不会注册 matcher，也不需要初始化 NoneBot。
+config 要求的环境变量在这里填入占位值，测试不会访问任何外部服务。
+"""
+import os
+import sys
+import types
+from pathlib import Path
+
+for _name in ("NEWAPI_URL", "NEWAPI_TOKEN", "QWEATHER_API_KEY", "GOOGLE_API_KEY", "GOOGLE_CSE_ID", "ACTIVE_CHAT_GROUP_IDS"):
+    os.environ.setdefault(_name, "http://127.0.0.1:9" if _name == "NEWAPI_URL" else "test")
+
+_package = types.ModuleType("yimao_plugin")
+_package.__path__ = [str(Path(__file__).resolve().parents[1] / "src" / "plugins" / "yimao_plugin")]
+sys.modules.setdefault("yimao_plugin", _package)
@@ -0,0 +1,91 @@
+import pytest
+
+from yimao_plugin import active_chat_filter
+from yimao_plugin.active_chat_filter import ActiveChatPrefilter, ReplyRateTracker
+
+def make_prefilter(weights: dict, threshold: float = 0.5, keywords=("一猫",), prior: float = 0.0) -> ActiveChatPrefilter:
+    return ActiveChatPrefilter(weights, threshold, keywords, ReplyRateTracker(prior=prior, alpha=0.5))
+
+# --- 评分项 ---
+
+@pytest.mark.parametrize("text, expected", [("叫一下一猫", 1.0), ("YIMAO 在吗", 1.0), ("今天下雨", 0.0)])
+def test_score_mention_is_case_insensitive(text, expected):
+    assert active_chat_filter.score_mention(["旧消息", text], ["一猫", "yimao"]) == expected
+
+def test_score_mention_ignores_empty_keywords():
+    assert active_chat_filter.score_mention(["随便说说"], [""]) == 0.0
+
+@pytest.mark.parametrize("text, expected", [("晚饭吃啥？", 1.0), ("who?", 1.0), ("这个怎么弄", 0.5), ("好的", 0.0)])
+def test_score_question(text, expected):
+    assert active_chat_filter.score_question([text], []) == expected
+
+def test_score_topic_shift_measures_unseen_bigrams():
+    texts = ["我们在聊猫粮牌子", "猫粮牌子哪个好"]
+    assert active_chat_filter.score_topic_shift(["明天要下大雨", "周末去爬山吧大家"], []) == 1.0
+    assert active_chat_filter.score_topic_shift(["猫粮牌子哪个好", "猫粮牌子哪个好"], []) == 0.0
+    assert 0.0 < active_chat_filter.score_topic_shift(texts, []) < 1.0
+
+def test_score_topic_shift_skips_short_or_first_messages():
+    assert active_chat_filter.score_topic_shift(["之前的话题", "嗯嗯"], []) == 0.0
+    assert active_chat_filter.score_topic_shift(["一句很长的全新消息"], []) == 0.0
+
+def test_reply_rate_tracker_is_exponential_moving_average():
+    tracker = ReplyRateTracker(prior=0.2, alpha=0.5)
+    assert tracker.get("1") == 0.2
+    tracker.record("1", True)
+    assert tracker.get("1") == pytest.approx(0.6)
+    tracker.record("1", False)
+    assert tracker.get("1") == pytest.approx(0.3)
+    assert tracker.get("2") == 0.2
+
+# --- 加权与批量打分 ---
+
+def test_score_is_weighted_sum_of_enabled_scorers():
+    prefilter = make_prefilter({"mention": 0.6, "question": 0.3, "topic_shift": 0, "reply_rate": 0.1}, prior=0.5)
+    total, parts = prefilter.score("1", ["一猫你好吗？"])
+    assert set(parts) == {"mention", "question", "reply_rate"}
+    assert total == pytest.approx(0.6 + 0.3 + 0.05)
+
+def test_batch_score_takes_best_new_message():
+    prefilter = make_prefilter({"mention": 1.0})
+    texts = ["旧消息提到一猫", "一猫在吗", "哈哈", "好"]
+    # 只看最后一条时错过了中间的提及
+    assert prefilter.score("1", texts, new_count=1)[0] == 0.0
+    assert prefilter.score("1", texts, new_count=3)[0] == 1.0
+    # 早于本批的旧消息不参与打分
+    assert prefilter.score("1", texts[:1] + texts[2:], new_count=2)[0] == 0.0
+
+def test_new_count_larger_than_texts_is_clamped():
+    prefilter = make_prefilter({"question": 1.0})
+    assert prefilter.score("1", ["吃了吗？", "嗯"], new_count=10)[0] == 1.0
+
+def test_extra_keywords_count_as_mentions():
+    prefilter = make_prefilter({"mention": 1.0}, keywords=())
+    assert prefilter.score("1", ["小明来了"], extra_keywords=["小明", ""])[0] == 1.0
+
+def test_should_call_llm_applies_threshold_and_counts():
+    prefilter = make_prefilter({"mention": 1.0}, threshold=0.5)
+    assert prefilter.should_call_llm("1", ["一猫！"])[0]
+    assert not prefilter.should_call_llm("1", ["路过"])[0]
+    assert prefilter.should_call_llm("1", []) == (False, 0.0, {})
+    assert prefilter.get_stats() == {"evaluated": 3, "skipped": 2, "passed": 1, "decisions": 0, "replies": 0, "avoided_percent": 67}
+
+def test_record_decision_feeds_reply_rate():
+    prefilter = make_prefilter({"reply_rate": 1.0}, prior=0.0)
+    prefilter.record_decision("1", True)
+    assert prefilter.score("1", ["随便"])[0] == pytest.approx(0.5)
+    assert prefilter.stats["decisions"] == 1 and prefilter.stats["replies"] == 1
+
+# --- 决策记录 ---
+
+def test_decision_log_round_trip(tmp_path):
+    path = tmp_path / "logs" / "decisions.jsonl"
+    active_chat_filter.append_decision_log(str(path), "1", ["a", "b"], ["一猫", ""], 0.7, True, new_count=2)
+    active_chat_filter.append_decision_log(str(path), "1", ["c"], [], None, False)
+    entries = active_chat_filter.load_decision_log(str(path))
+    assert [(e["texts"], e["keywords"], e["new_count"], e["should_reply"]) for e in entries] == [
+        (["a", "b"], ["一猫"], 2, True), (["c"], [], 1, False)]
+
+def test_decision_log_disabled_without_path(tmp_path):
+    active_chat_filter.append_decision_log("", "1", ["a"], [], 0.1, False)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from yimao_plugin import async_cache
+from yimao_plugin.async_cache import SingleFlight, TTLCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(async_cache.time, "monotonic", lambda: now[0])
+    return now
+
+# --- TTLCache ---
+
+def test_get_returns_value_until_expiry(clock):
+    cache = TTLCache(ttl=10, max_entries=4)
+    cache.put("k", "v")
+    clock[0] += 10
+    assert cache.get("k") == "v"
+    clock[0] += 0.01
+    assert cache.get("k") is None
+    assert len(cache) == 0
+
+def test_put_refreshes_expiry(clock):
+    cache = TTLCache(ttl=10, max_entries=4)
+    cache.put("k", "old")
+    clock[0] += 8
+    cache.put("k", "new")
+    clock[0] += 8
+    assert cache.get("k") == "new"
+
+def test_evicts_least_recently_used(clock):
+    cache = TTLCache(ttl=10, max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert len(cache) == 2
+
+def test_missing_key_returns_none():
+    assert TTLCache(ttl=10, max_entries=2).get("missing") is None
+
+# --- SingleFlight ---
+
+def test_concurrent_calls_share_one_factory_run():
+    async def scenario():
+        flights = SingleFlight()
+        runs = []
+
+        async def factory():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+        results = await asyncio.gather(*(flights.do("k", factory) for _ in range(5)))
+        assert results == ["result"] * 5
+        assert len(runs) == 1
+        assert flights.stats == {"calls": 1, "shared": 4}
+        assert not flights.is_running("k")
+    asyncio.run(scenario())
+
+def test_different_keys_do_not_coalesce():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def factory(value):
+            await asyncio.sleep(0)
+            return value
+        assert await asyncio.gather(flights.do("a", lambda: factory(1)), flights.do("b", lambda: factory(2))) == [1, 2]
+        assert flights.stats == {"calls": 2, "shared": 0}
+    asyncio.run(scenario())
+
+def test_exception_is_shared_and_not_cached():
+    async def scenario():
+        flights = SingleFlight()
+        runs = []
+
+        async def failing():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream")
+        results = await asyncio.gather(flights.do("k", failing), flights.do("k", failing), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(runs) == 1
+        # 失败的结果不会被记住，下一次调用重新执行
+        with pytest.raises(ValueError): await flights.do("k", failing)
+        assert len(runs) == 2
+    asyncio.run(scenario())
+
+def test_cancelling_one_waiter_keeps_shared_call_running():
+    async def scenario():
+        flights = SingleFlight()
+        started = asyncio.Event()
+
+        async def factory():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "result"
+        first = asyncio.create_task(flights.do("k", factory))
+        second = asyncio.create_task(flights.do("k", factory))
+        await started.wait()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError): await first
+        assert await second == "result"
+    asyncio.run(scenario())
+
+def test_cancelling_last_waiter_cancels_underlying_call():
+    async def scenario():
+        flights = SingleFlight()
+        started, finished = asyncio.Event(), []
+
+        async def factory():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                finished.append("cancelled")
+                raise
+        first = asyncio.create_task(flights.do("k", factory))
+        second = asyncio.create_task(flights.do("k", factory))
+        await started.wait()
+        for task in (first, second):
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError): await task
+        await asyncio.sleep(0)
+        assert finished == ["cancelled"]
+        assert not flights.is_running("k")
+    asyncio.run(scenario())
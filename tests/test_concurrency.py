@@ -0,0 +1,212 @@
+import asyncio
+
+import pytest
+
+from yimao_plugin import concurrency, config
+from yimao_plugin.concurrency import LimiterBusyError, PriorityLimiter
+
+# --- PriorityLimiter ---
+
+def test_acquires_immediately_below_capacity():
+    async def scenario():
+        limiter = PriorityLimiter(2)
+        await limiter.acquire(concurrency.PRIORITY_SUMMARY)
+        await limiter.acquire(concurrency.PRIORITY_SUMMARY)
+        assert limiter._active == 2 and limiter.waiting == 0
+        assert limiter.stats == {"granted": 2, "queued": 0, "gave_up": 0}
+    asyncio.run(scenario())
+
+def test_release_hands_slot_to_highest_priority_then_fifo():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(concurrency.PRIORITY_DIRECT)
+        order = []
+
+        async def worker(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+        priorities = [("summary", concurrency.PRIORITY_SUMMARY), ("active", concurrency.PRIORITY_ACTIVE_CHAT),
+                      ("direct-1", concurrency.PRIORITY_DIRECT), ("challenge", concurrency.PRIORITY_CHALLENGE),
+                      ("direct-2", concurrency.PRIORITY_DIRECT)]
+        tasks = []
+        for name, priority in priorities:
+            tasks.append(asyncio.create_task(worker(name, priority)))
+            await asyncio.sleep(0)
+        assert limiter.waiting == 5
+        for _ in priorities:
+            limiter.release()
+            await asyncio.sleep(0)
+            # 名额是直接转交的，占用数始终不超过容量
+            assert limiter._active == 1
+        await asyncio.gather(*tasks)
+        assert order == ["direct-1", "direct-2", "challenge", "active", "summary"]
+        limiter.release()
+        assert limiter._active == 0
+    asyncio.run(scenario())
+
+def test_new_arrival_does_not_jump_the_queue():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(concurrency.PRIORITY_DIRECT)
+        waiter = asyncio.create_task(limiter.acquire(concurrency.PRIORITY_SUMMARY))
+        await asyncio.sleep(0)
+        limiter.release()
+        # 名额已经转交给排队的请求，新来的请求即使优先级更高也要排队
+        late = asyncio.create_task(limiter.acquire(concurrency.PRIORITY_DIRECT))
+        await asyncio.sleep(0)
+        assert waiter.done() and not late.done()
+        limiter.release()
+        await late
+        assert limiter._active == 1
+    asyncio.run(scenario())
+
+def test_timeout_raises_busy_error_without_leaking():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(concurrency.PRIORITY_DIRECT)
+        with pytest.raises(LimiterBusyError):
+            await limiter.acquire(concurrency.PRIORITY_SUMMARY, timeout=0.01)
+        assert limiter.waiting == 0
+        assert limiter.stats == {"granted": 1, "queued": 1, "gave_up": 1}
+        limiter.release()
+        assert limiter._active == 0
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_is_skipped_on_release():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(concurrency.PRIORITY_DIRECT)
+        cancelled = asyncio.create_task(limiter.acquire(concurrency.PRIORITY_DIRECT))
+        queued = asyncio.create_task(limiter.acquire(concurrency.PRIORITY_SUMMARY))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError): await cancelled
+        limiter.release()
+        await queued
+        assert limiter._active == 1 and limiter.waiting == 0
+        limiter.release()
+        assert limiter._active == 0
+    asyncio.run(scenario())
+
+def test_cancel_after_hand_off_returns_the_slot():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(concurrency.PRIORITY_DIRECT)
+
+        async def use_slot():
+            await limiter.acquire(concurrency.PRIORITY_DIRECT)
+            try:
+                await asyncio.sleep(10)
+            finally:
+                limiter.release()
+        task = asyncio.create_task(use_slot())
+        await asyncio.sleep(0)
+        # 名额转交后、等待方恢复运行之前被取消
+        limiter.release()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+        assert limiter._active == 0 and limiter.waiting == 0
+    asyncio.run(scenario())
+
+def test_llm_slot_applies_per_priority_wait(monkeypatch):
+    monkeypatch.setattr(concurrency, "_llm_limiter", PriorityLimiter(1))
+    monkeypatch.setattr(config, "LLM_PRIORITY_MAX_WAIT", {concurrency.PRIORITY_SUMMARY: 0.01})
+
+    async def scenario():
+        async with concurrency.llm_slot(concurrency.PRIORITY_DIRECT):
+            with pytest.raises(LimiterBusyError):
+                async with concurrency.llm_slot(concurrency.PRIORITY_SUMMARY): pass
+        assert concurrency.get_stats()["active"] == 0
+    asyncio.run(scenario())
+
+# --- KeyedDebouncer ---
+
+def recorder(calls, name, duration=0.0):
+    async def callback():
+        calls.append(name)
+        await asyncio.sleep(duration)
+    return callback
+
+def test_burst_runs_latest_callback_once():
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.05, max_delay=1.0)
+        calls = []
+        for i in range(5):
+            debouncer.trigger("group", recorder(calls, i))
+            await asyncio.sleep(0.01)
+        assert calls == []
+        await asyncio.sleep(0.1)
+        assert calls == [4]
+        assert debouncer.stats == {"triggers": 5, "runs": 1, "cancelled": 0}
+        assert debouncer.pending() == 0
+    asyncio.run(scenario())
+
+def test_keys_are_debounced_independently():
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.03, max_delay=1.0)
+        calls = []
+        debouncer.trigger("a", recorder(calls, "a"))
+        debouncer.trigger("b", recorder(calls, "b"))
+        assert debouncer.pending() == 2
+        await asyncio.sleep(0.08)
+        assert sorted(calls) == ["a", "b"]
+    asyncio.run(scenario())
+
+def test_max_delay_prevents_starvation():
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.05, max_delay=0.12)
+        calls = []
+        for i in range(20):
+            debouncer.trigger("group", recorder(calls, i))
+            await asyncio.sleep(0.02)
+        # 消息从未停过 quiet_seconds，但每批最多等 max_delay 秒
+        assert len(calls) >= 2
+        await asyncio.sleep(0.1)
+        assert calls[-1] == 19
+    asyncio.run(scenario())
+
+def test_trigger_during_run_cancels_stale_run():
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.02, max_delay=1.0)
+        calls = []
+        debouncer.trigger("group", recorder(calls, "stale", duration=0.2))
+        await asyncio.sleep(0.05)
+        assert calls == ["stale"]
+        debouncer.trigger("group", recorder(calls, "fresh"))
+        await asyncio.sleep(0.05)
+        assert calls == ["stale", "fresh"]
+        assert debouncer.stats["cancelled"] == 1
+        assert debouncer.pending() == 0
+    asyncio.run(scenario())
+
+def test_trigger_after_max_delay_reruns_instead_of_cancelling():
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.01, max_delay=0.03)
+        calls, finished = [], []
+
+        async def slow():
+            calls.append("slow")
+            await asyncio.sleep(0.1)
+            finished.append("slow")
+        debouncer.trigger("group", slow)
+        await asyncio.sleep(0.06)
+        debouncer.trigger("group", recorder(calls, "next"))
+        await asyncio.sleep(0.15)
+        # 已经等满 max_delay 的执行不会被打断，结束后再补跑一次
+        assert finished == ["slow"]
+        assert calls == ["slow", "next"]
+        assert debouncer.stats["cancelled"] == 0
+        assert debouncer.pending() == 0
+    asyncio.run(scenario())
+
+def test_callback_error_is_logged_and_state_cleared(caplog):
+    async def scenario():
+        debouncer = concurrency.KeyedDebouncer(quiet_seconds=0.01, max_delay=1.0)
+
+        async def boom():
+            raise RuntimeError("boom")
+        debouncer.trigger("group", boom)
+        await asyncio.sleep(0.05)
+        assert debouncer.pending() == 0
+    asyncio.run(scenario())
+    assert "去抖任务 group 执行出错" in caplog.text
@@ -0,0 +1,128 @@
+import asyncio
+from collections import deque
+
+import pytest
+
+from yimao_plugin import config, context_window, llm_client
+from yimao_plugin.data_store import MemorySlot
+
+MODEL = "test-model"
+# 95 个汉字：95 + 1 + 每条记录的固定开销 4 = 100 tokens
+LONG_TEXT = "喵" * 95
+
+def make_history(pairs: int) -> deque:
+    history = deque()
+    for i in range(pairs):
+        history.append({"role": "user", "message_id": 2 * i, "content": [{"type": "text", "text": f"{LONG_TEXT[:-2]}{i:02d}"}]})
+        history.append({"role": "assistant", "message_id": 2 * i + 1, "content": LONG_TEXT})
+    return history
+
+class FakeSummaryRoute:
+    def __init__(self, response: dict):
+        self.response = response
+        self.prompts = []
+
+    async def __call__(self, route, messages, system_prompt_content, use_tools, priority=None, response_format=None) -> dict:
+        assert route == "summary"
+        self.prompts.append(messages[0]["content"])
+        return self.response
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(config, "CONTEXT_TOKEN_BUDGETS", {MODEL: 500})
+    monkeypatch.setattr(config, "CONTEXT_FOLD_TARGET_RATIO", 0.6)
+    monkeypatch.setattr(config, "CONTEXT_MIN_RECENT_RECORDS", 4)
+
+def use_summary_route(monkeypatch, response: dict) -> FakeSummaryRoute:
+    route = FakeSummaryRoute(response)
+    monkeypatch.setattr(llm_client, "call_model_route", route)
+    return route
+
+def summary_response(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+def prepare(history, cache, slot) -> int:
+    return asyncio.run(context_window.prepare_window(history, cache, slot, MODEL, ""))
+
+def test_estimate_text_tokens_counts_cjk_per_character():
+    assert context_window.estimate_text_tokens("") == 0
+    assert context_window.estimate_text_tokens("喵喵喵") == 4
+    assert context_window.estimate_text_tokens("abcdefgh") == 3
+
+def test_within_budget_sends_everything(monkeypatch):
+    route = use_summary_route(monkeypatch, summary_response("不应调用"))
+    history, cache, slot = make_history(2), deque(), MemorySlot()
+    assert prepare(history, cache, slot) == 0
+    assert route.prompts == [] and slot.context_summary == ""
+
+def test_over_budget_folds_oldest_records_at_a_user_message(monkeypatch):
+    route = use_summary_route(monkeypatch, summary_response("早先聊了猫。"))
+    history, cache, slot = make_history(5), deque(), MemorySlot()
+    start = prepare(history, cache, slot)
+    # 目标 300 tokens 只够保留最后一轮，但至少要保留 4 条记录，所以从下标 6 的用户消息开始
+    assert start == 6
+    assert history[start]["role"] == "user"
+    assert slot.context_summary == "早先聊了猫。"
+    assert slot.context_marker == context_window.record_fingerprint(history[start])
+    assert len(route.prompts) == 1
+    # 只有前三轮 (下标 0~5) 被折叠
+    assert "02" in route.prompts[0] and "03" not in route.prompts[0]
+
+def test_marker_bounds_later_rounds_without_refolding(monkeypatch):
+    route = use_summary_route(monkeypatch, summary_response("早先聊了猫。"))
+    history, cache, slot = make_history(5), deque(), MemorySlot()
+    assert prepare(history, cache, slot) == 6
+    history.append({"role": "user", "message_id": 100, "content": "好"})
+    assert prepare(history, cache, slot) == 6
+    assert len(route.prompts) == 1
+    assert len(cache) == len(history)
+
+def test_previous_summary_is_passed_into_next_fold(monkeypatch):
+    route = use_summary_route(monkeypatch, summary_response("新的摘要"))
+    history, cache = make_history(5), deque()
+    slot = MemorySlot(context_summary="旧的摘要")
+    prepare(history, cache, slot)
+    assert "旧的摘要" in route.prompts[0]
+    assert slot.context_summary == "新的摘要"
+
+@pytest.mark.parametrize("response", [{"error": {"message": "网关超时"}}, summary_response("   ")])
+def test_failed_fold_keeps_summary_and_marker(monkeypatch, response):
+    use_summary_route(monkeypatch, response)
+    history, cache = make_history(5), deque()
+    slot = MemorySlot(context_summary="旧的摘要", context_marker="")
+    start = prepare(history, cache, slot)
+    # 本轮仍然只发送预算内的部分，但摘要和折叠标记保持不变，下一轮重试
+    assert start == 6
+    assert slot.context_summary == "旧的摘要" and slot.context_marker == ""
+
+def test_no_user_message_to_split_at_sends_from_boundary(monkeypatch):
+    route = use_summary_route(monkeypatch, summary_response("不应调用"))
+    history = deque({"role": "assistant", "message_id": i, "content": LONG_TEXT} for i in range(10))
+    assert prepare(history, deque(), MemorySlot()) == 0
+    assert route.prompts == []
+
+def test_fingerprint_ignores_content_when_ids_exist():
+    record = {"role": "user", "message_id": 42, "content": [{"type": "text", "text": "看图"}, {"type": "image_url", "image_url": {"url": "x"}}]}
+    fingerprint = context_window.record_fingerprint(record)
+    context_window.rewrite_message_text(record, lambda text: f"[12:00] {text}")
+    record["content"][1]["summary"] = "一只猫"
+    assert context_window.record_fingerprint(record) == fingerprint
+    assert context_window.record_fingerprint({**record, "message_id": 43}) != fingerprint
+
+def test_fingerprint_without_ids_ignores_late_image_summary():
+    record = {"role": "user", "content": [{"type": "text", "text": "看图"}, {"type": "image_url", "image_url": {"url": "x"}}]}
+    fingerprint = context_window.record_fingerprint(record)
+    record["content"][1]["summary"] = "一只猫"
+    assert context_window.record_fingerprint(record) == fingerprint
+
+def test_rewrite_message_text_does_not_mutate_shared_content():
+    shared = [{"type": "text", "text": "你好"}, {"type": "image_url", "image_url": {"url": "x"}}]
+    message = {"role": "user", "content": shared}
+    context_window.rewrite_message_text(message, lambda text: text + "!")
+    assert message["content"][0]["text"] == "你好!"
+    assert shared[0]["text"] == "你好"
+
+def test_prefix_first_message_inserts_text_part_when_missing():
+    messages = [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "x"}}]}]
+    context_window.prefix_first_message(messages, "[摘要]")
+    assert messages[0]["content"][0] == {"type": "text", "text": "[摘要]"}
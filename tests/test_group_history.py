@@ -0,0 +1,42 @@
+from yimao_plugin import group_history
+from yimao_plugin.group_history import GroupMessage
+
+TIMESTAMP = 1_700_000_000
+
+def test_text_only_list_is_compacted_to_string():
+    message = GroupMessage(1, "小明", [{"type": "text", "text": "你好"}, {"type": "text", "text": "呀"}], timestamp=TIMESTAMP)
+    assert message.content == "你好 呀"
+    assert message.plain_text == "你好 呀"
+
+def test_line_is_rendered_once_and_cached():
+    message = GroupMessage(1, "小明", "  你好  ", timestamp=TIMESTAMP)
+    expected = f"[{group_history.format_timestamp(TIMESTAMP)}] [用户ID:1 (昵称:小明)]: 你好"
+    assert message._line == expected
+    # 缓存后即使内容被改动也不会重新渲染
+    message.content = "改过了"
+    assert message.render() == expected
+
+def test_pending_image_is_not_cached_until_summary_lands():
+    image = {"type": "image", "pending": True}
+    message = GroupMessage(1, "小明", [{"type": "text", "text": "看"}, image], timestamp=TIMESTAMP)
+    assert message._line is None
+    assert message.render().endswith("看 [图片(描述生成中)]")
+    # 后台队列原地补上摘要后，下一次渲染得到最终结果并缓存
+    image.pop("pending")
+    image["summary"] = "一只猫"
+    assert message.render().endswith("看 [图片: 一只猫]")
+    assert message._line is not None
+
+def test_plain_text_skips_images():
+    message = GroupMessage(1, "小明", [{"type": "text", "text": "看"}, {"type": "image", "summary": "猫"}], timestamp=TIMESTAMP)
+    assert message.plain_text == "看"
+
+def test_user_fields_are_interned():
+    first = GroupMessage(10001, "".join(["小", "明"]), "a", timestamp=TIMESTAMP)
+    second = GroupMessage("10001", "".join(["小", "明"]), "b", timestamp=TIMESTAMP)
+    assert first.user_id is second.user_id
+    assert first.user_name is second.user_name
+
+def test_render_history_keeps_order():
+    messages = [GroupMessage(1, "a", "一", timestamp=TIMESTAMP), GroupMessage(2, "b", "二", timestamp=TIMESTAMP)]
+    assert [line.rsplit(": ", 1)[1] for line in group_history.render_history(messages)] == ["一", "二"]
@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from yimao_plugin import concurrency, config, http_client, llm_client, retry_policy
+
+MODEL = "test-model"
+
+def sse(*chunks) -> bytes:
+    lines = [f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n" for chunk in chunks]
+    return ("".join(lines) + "data: [DONE]\n\n").encode("utf-8")
+
+def content_delta(text: str) -> dict:
+    return {"choices": [{"index": 0, "delta": {"content": text}}]}
+
+def tool_delta(**tool_call) -> dict:
+    return {"choices": [{"index": 0, "delta": {"tool_calls": [tool_call]}}]}
+
+class FakeGateway:
+    """按请求是否为流式分别返回预设的响应，并记录收到的请求。"""
+
+    def __init__(self):
+        self.stream_response = lambda request: httpx.Response(200, content=sse())
+        self.plain_response = lambda request: httpx.Response(200, json={"choices": [{"message": {"role": "assistant", "content": "非流式"}}]})
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        self.requests.append(payload)
+        return self.stream_response(request) if payload["stream"] else self.plain_response(request)
+
+@pytest.fixture
+def gateway(monkeypatch):
+    fake = FakeGateway()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+    monkeypatch.setattr(http_client, "get_gateway_client", lambda: client)
+    monkeypatch.setattr(concurrency, "_llm_limiter", concurrency.PriorityLimiter(4))
+    monkeypatch.setattr(retry_policy, "_breakers", {})
+    monkeypatch.setattr(config, "LLM_RETRY_MAX_ATTEMPTS", 1)
+    return fake
+
+def stream(on_content=None, use_tools=False) -> dict:
+    return asyncio.run(llm_client.stream_gemini_api([{"role": "user", "content": "你好"}], "", MODEL, use_tools, on_content=on_content))
+
+def test_text_deltas_are_delivered_in_order(gateway):
+    gateway.stream_response = lambda request: httpx.Response(200, content=sse(content_delta("喵"), content_delta("~"), {"choices": []}))
+    received = []
+
+    async def on_content(text):
+        received.append(text)
+    response = stream(on_content)
+    assert received == ["喵", "~"]
+    assert response == {"choices": [{"message": {"role": "assistant", "content": "喵~"}}]}
+    assert retry_policy.get_breaker(MODEL).state == "closed"
+
+def test_tool_call_fragments_are_joined_by_index(gateway):
+    gateway.stream_response = lambda request: httpx.Response(200, content=sse(
+        tool_delta(index=0, id="call_a", type="function", function={"name": "get_", "arguments": ""}),
+        tool_delta(index=1, id="call_b", function={"name": "google_search", "arguments": '{"query"'}),
+        tool_delta(index=0, function={"name": "weather", "arguments": '{"city": '}),
+        tool_delta(index=1, function={"arguments": ': "猫"}'}),
+        tool_delta(index=0, function={"arguments": '"上海"}'}),
+    ))
+    message = stream(use_tools=True)["choices"][0]["message"]
+    assert message["content"] is None
+    assert message["tool_calls"] == [
+        {"id": "call_a", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "上海"}'}},
+        {"id": "call_b", "type": "function", "function": {"name": "google_search", "arguments": '{"query": "猫"}'}},
+    ]
+    assert json.loads(message["tool_calls"][0]["function"]["arguments"]) == {"city": "上海"}
+
+def test_tool_calls_without_index_are_separate_calls(gateway):
+    gateway.stream_response = lambda request: httpx.Response(200, content=sse(
+        tool_delta(id="call_a", function={"name": "a", "arguments": "{}"}),
+        tool_delta(id="call_b", function={"name": "b", "arguments": "{}"}),
+    ))
+    message = stream(use_tools=True)["choices"][0]["message"]
+    assert [call["function"]["name"] for call in message["tool_calls"]] == ["a", "b"]
+
+def test_text_and_tool_calls_together_keep_content(gateway):
+    gateway.stream_response = lambda request: httpx.Response(200, content=sse(
+        content_delta("我查一下"), tool_delta(index=0, id="call_a", function={"name": "a", "arguments": "{}"})))
+    message = stream(use_tools=True)["choices"][0]["message"]
+    assert message["content"] == "我查一下" and len(message["tool_calls"]) == 1
+
+def test_error_before_any_text_falls_back_to_non_streaming(gateway):
+    gateway.stream_response = lambda request: httpx.Response(503, text="busy")
+    response = stream()
+    assert response["choices"][0]["message"]["content"] == "非流式"
+    assert [payload["stream"] for payload in gateway.requests] == [True, False]
+
+def test_error_after_text_was_delivered_reports_interruption(gateway):
+    async def broken_body():
+        yield sse(content_delta("说到一半"))[:-len("data: [DONE]\n\n")]
+        raise httpx.ReadError("connection reset")
+    gateway.stream_response = lambda request: httpx.Response(200, content=broken_body())
+    received = []
+
+    async def on_content(text):
+        received.append(text)
+    response = stream(on_content)
+    assert received == ["说到一半"]
+    assert response == {"error": {"message": "回复生成到一半中断了"}}
+    # 不会再用非流式请求重复一遍已经发出去的内容
+    assert [payload["stream"] for payload in gateway.requests] == [True]
+    assert retry_policy.get_breaker(MODEL)._failures == 1
+
+def test_open_breaker_skips_the_request(gateway):
+    breaker = retry_policy.get_breaker(MODEL)
+    for _ in range(breaker.failure_threshold): breaker.record_failure()
+    assert "熔断" in stream()["error"]["message"]
+    assert gateway.requests == []
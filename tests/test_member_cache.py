@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from yimao_plugin import config, member_cache
+
+class FakeBot:
+    self_id = "10000"
+
+    def __init__(self, members=None, member_info=None, fail_lookup=False):
+        self.members = members or []
+        self.member_info = member_info or {}
+        self.fail_lookup = fail_lookup
+        self.calls = []
+
+    async def get_group_member_list(self, group_id: int):
+        self.calls.append(("list", group_id))
+        return self.members
+
+    async def get_group_member_info(self, group_id: int, user_id: int):
+        self.calls.append(("info", group_id, user_id))
+        if self.fail_lookup: raise RuntimeError("不在群里")
+        return self.member_info
+
+    async def get_login_info(self):
+        self.calls.append(("login",))
+        return {"nickname": "一猫本猫"}
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(member_cache, "_member_names", {})
+    monkeypatch.setattr(member_cache, "_prefilled_at", {})
+    monkeypatch.setattr(member_cache, "_prefill_in_progress", set())
+    monkeypatch.setattr(member_cache, "_bot_nicknames", {})
+    monkeypatch.setattr(member_cache, "_stats", {"hits": 0, "misses": 0, "api_lookups": 0, "prefills": 0})
+    monkeypatch.setattr(config, "MEMBER_NAME_CACHE_TTL", 60)
+
+def lookup(bot, user_id="1", sender=None) -> str:
+    async def scenario():
+        name = await member_cache.get_member_name(bot, "500", user_id, sender=sender)
+        await asyncio.sleep(0)  # 让后台预加载任务跑完
+        return name
+    return asyncio.run(scenario())
+
+def test_sender_info_avoids_api_lookup():
+    bot = FakeBot()
+    assert lookup(bot, sender={"card": "", "nickname": "小明"}) == "小明"
+    assert ("info", 500, 1) not in bot.calls
+    assert member_cache.get_stats()["hits"] == 1
+
+def test_group_card_takes_precedence_over_nickname():
+    assert lookup(FakeBot(), sender={"card": "群名片", "nickname": "小明"}) == "群名片"
+
+def test_prefill_populates_whole_group_once():
+    bot = FakeBot(members=[{"user_id": 1, "card": "", "nickname": "甲"}, {"user_id": 2, "card": "乙乙", "nickname": "乙"}])
+    lookup(bot, user_id="3", sender={"nickname": "丙"})
+    assert member_cache.get_cached("500", "2") == "乙乙"
+    assert lookup(bot, user_id="1") == "甲"
+    assert [call for call in bot.calls if call[0] == "list"] == [("list", 500)]
+
+def test_falls_back_to_api_then_user_id():
+    assert lookup(FakeBot(member_info={"card": "", "nickname": "查到的"}), user_id="7") == "查到的"
+    assert member_cache.get_cached("500", "7") == "查到的"
+    assert lookup(FakeBot(fail_lookup=True), user_id="8") == "8"
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(member_cache.time, "monotonic", lambda: now[0])
+    member_cache.remember("500", "1", "小明")
+    now[0] += 60
+    assert member_cache.get_cached("500", "1") == "小明"
+    now[0] += 1
+    assert member_cache.get_cached("500", "1") is None
+
+def test_forget_and_empty_names():
+    member_cache.remember("500", "1", "小明")
+    member_cache.forget("500", "1")
+    member_cache.remember("500", "2", "")
+    assert member_cache.get_cached("500", "1") is None and member_cache.get_cached("500", "2") is None
+
+def test_bot_nickname_is_cached():
+    bot = FakeBot()
+
+    async def scenario():
+        return [await member_cache.get_bot_nickname(bot) for _ in range(3)]
+    assert asyncio.run(scenario()) == ["一猫本猫"] * 3
+    assert bot.calls == [("login",)]
+    assert member_cache.peek_bot_nickname(bot) == "一猫本猫"
@@ -0,0 +1,112 @@
+import asyncio
+
+import httpx
+import pytest
+
+from yimao_plugin import config, llm_client
+
+ROUTE = "test"
+
+def ok(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+class FakeModels:
+    """按模型名返回预设的 (延迟, 结果或异常)，并记录调用和取消。"""
+
+    def __init__(self, behaviours: dict):
+        self.behaviours = behaviours
+        self.called, self.cancelled = [], []
+
+    async def __call__(self, messages, system_prompt_content, model, use_tools, priority=None, response_format=None) -> dict:
+        self.called.append(model)
+        delay, result = self.behaviours[model]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        if isinstance(result, Exception): raise result
+        return result
+
+@pytest.fixture(autouse=True)
+def route_config(monkeypatch):
+    monkeypatch.setattr(config, "MODEL_ROUTES", {ROUTE: {"models": ["a", "b", "c"], "hedge": False}})
+    monkeypatch.setattr(config, "HEDGE_DEFAULT_DELAY", 0.05)
+    monkeypatch.setattr(llm_client, "_latency_samples", {})
+
+def use_models(monkeypatch, behaviours: dict, hedge: bool = False) -> FakeModels:
+    fake = FakeModels(behaviours)
+    monkeypatch.setattr(llm_client, "call_gemini_api", fake)
+    config.MODEL_ROUTES[ROUTE]["hedge"] = hedge
+    return fake
+
+def call_route() -> dict:
+    return asyncio.run(llm_client.call_model_route(ROUTE, [{"role": "user", "content": "你好"}], "", False))
+
+# --- 对冲等待时间 ---
+
+def test_hedge_delay_uses_default_until_enough_samples(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_MIN_SAMPLES", 5)
+    for _ in range(4): llm_client._record_latency("a", 10.0)
+    assert llm_client.get_hedge_delay("a") == 0.05
+
+def test_hedge_delay_is_clamped_percentile(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_MIN_SAMPLES", 5)
+    monkeypatch.setattr(config, "HEDGE_MIN_DELAY", 3.0)
+    monkeypatch.setattr(config, "HEDGE_MAX_DELAY", 60.0)
+    for seconds in range(1, 21): llm_client._record_latency("a", float(seconds))
+    assert llm_client.get_hedge_delay("a") == 20.0
+    for _ in range(200): llm_client._record_latency("fast", 0.5)
+    assert llm_client.get_hedge_delay("fast") == 3.0
+    for _ in range(200): llm_client._record_latency("slow", 120.0)
+    assert llm_client.get_hedge_delay("slow") == 60.0
+
+# --- 顺序回退 ---
+
+def test_falls_back_to_next_model_on_error(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (0, {"error": {"message": "坏了"}}), "b": (0, ok("来自 b")), "c": (0, ok("来自 c"))})
+    assert call_route() == ok("来自 b")
+    assert fake.called == ["a", "b"]
+    # 只有成功的请求计入延迟样本
+    assert list(llm_client._latency_samples) == ["b"]
+
+def test_returns_last_error_when_every_model_fails(monkeypatch):
+    error = httpx.HTTPStatusError("bad", request=httpx.Request("POST", "http://gw"), response=httpx.Response(400))
+    use_models(monkeypatch, {"a": (0, {"error": {"message": "坏了"}}), "b": (0, {"error": {"message": "也坏了"}}), "c": (0, error)})
+    # 异常转换成带 status_code 的错误响应，调用方据此判断而不是解析文本
+    assert call_route() == {"error": {"message": "HTTP 400", "status_code": 400}}
+
+# --- 对冲 ---
+
+def test_fast_primary_never_hedges(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (0, ok("来自 a")), "b": (0, ok("来自 b")), "c": (0, ok("来自 c"))}, hedge=True)
+    assert call_route() == ok("来自 a")
+    assert fake.called == ["a"]
+
+def test_slow_primary_is_hedged_and_loser_cancelled(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (5, ok("来自 a")), "b": (0, ok("来自 b")), "c": (0, ok("来自 c"))}, hedge=True)
+    assert call_route() == ok("来自 b")
+    assert fake.called == ["a", "b"]
+    assert fake.cancelled == ["a"]
+
+def test_primary_can_still_win_after_hedging(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (0.1, ok("来自 a")), "b": (5, ok("来自 b")), "c": (0, ok("来自 c"))}, hedge=True)
+    assert call_route() == ok("来自 a")
+    assert fake.cancelled == ["b"]
+
+def test_hedged_pair_failing_moves_past_both(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (0.1, {"error": {"message": "a 坏了"}}), "b": (0, {"error": {"message": "b 坏了"}}), "c": (0, ok("来自 c"))}, hedge=True)
+    assert call_route() == ok("来自 c")
+    assert fake.called == ["a", "b", "c"]
+
+def test_cancelling_caller_cancels_both_hedged_requests(monkeypatch):
+    fake = use_models(monkeypatch, {"a": (5, ok("来自 a")), "b": (5, ok("来自 b")), "c": (0, ok("来自 c"))}, hedge=True)
+
+    async def scenario():
+        task = asyncio.create_task(llm_client.call_model_route(ROUTE, [{"role": "user", "content": "你好"}], "", False))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+        await asyncio.sleep(0)
+    asyncio.run(scenario())
+    assert sorted(fake.cancelled) == ["a", "b"]
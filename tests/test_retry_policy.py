@@ -0,0 +1,226 @@
+import asyncio
+import email.utils
+import time
+
+import httpx
+import pytest
+
+from yimao_plugin import config, retry_policy
+from yimao_plugin.retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+REQUEST = httpx.Request("POST", "http://gateway.test/v1/chat/completions")
+
+def make_response(status_code: int, headers: dict = None) -> httpx.Response:
+    return httpx.Response(status_code, headers=headers, request=REQUEST)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 只给熔断器用的假时钟；异步测试不使用它，以免影响事件循环的计时
+    fake = FakeClock()
+    monkeypatch.setattr(retry_policy.time, "monotonic", fake)
+    return fake
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(retry_policy, "_breakers", {})
+    monkeypatch.setattr(config, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5)
+    monkeypatch.setattr(config, "CIRCUIT_BREAKER_RESET_TIMEOUT", 0.05)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """记录 send_with_retry 的退避时间而不真的等待。"""
+    recorded = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        recorded.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(retry_policy.asyncio, "sleep", fake_sleep)
+    return recorded
+
+def scripted_send(*status_codes, headers: dict = None):
+    calls = []
+
+    async def send(timeout: float) -> httpx.Response:
+        calls.append(timeout)
+        return make_response(status_codes[min(len(calls), len(status_codes)) - 1], headers)
+    return send, calls
+
+# --- 退避与 Retry-After ---
+
+def test_backoff_delay_is_capped_full_jitter(monkeypatch):
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: (low, high))
+    policy = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=3.0, deadline=60)
+    assert [policy.backoff_delay(attempt) for attempt in range(4)] == [(0, 0.5), (0, 1.0), (0, 2.0), (0, 3.0)]
+
+@pytest.mark.parametrize("value, expected", [("3", 3.0), ("0.5", 0.5), ("-2", 0.0), ("soon", None)])
+def test_parse_retry_after_seconds(value, expected):
+    assert retry_policy.parse_retry_after(make_response(429, {"Retry-After": value})) == expected
+
+def test_parse_retry_after_http_date():
+    retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= retry_policy.parse_retry_after(make_response(503, {"Retry-After": retry_at})) <= 30
+
+def test_parse_retry_after_missing():
+    assert retry_policy.parse_retry_after(make_response(503)) is None
+
+# --- 熔断器状态机 ---
+
+def test_breaker_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker("m", failure_threshold=3, reset_timeout=10)
+    for _ in range(2): breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+def test_breaker_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("m", failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+def test_half_open_allows_exactly_one_probe(clock):
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+def test_probe_success_closes_breaker(clock):
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+def test_probe_failure_reopens_for_a_full_timeout(clock):
+    breaker = CircuitBreaker("m", failure_threshold=3, reset_timeout=10)
+    for _ in range(3): breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+def test_released_probe_lets_next_request_probe(clock):
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+
+# --- send_with_retry ---
+
+def test_retries_retryable_status_until_success(sleeps):
+    send, calls = scripted_send(503, 502, 200)
+    policy = RetryPolicy(max_attempts=5, base_delay=0.01, max_delay=0.1, deadline=30)
+    response = asyncio.run(retry_policy.send_with_retry(send, policy, "retry-ok", request_timeout=10))
+    assert response.status_code == 200
+    assert len(calls) == 3 and len(sleeps) == 2
+    assert retry_policy.get_breaker("retry-ok").state == "closed"
+
+def test_retry_after_header_overrides_backoff(sleeps):
+    send, _ = scripted_send(429, 200, headers={"Retry-After": "1.5"})
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.1, deadline=30)
+    asyncio.run(retry_policy.send_with_retry(send, policy, "retry-after", request_timeout=10))
+    assert sleeps == [1.5]
+
+def test_non_retryable_status_raises_without_retry(sleeps):
+    send, calls = scripted_send(400)
+    policy = RetryPolicy(max_attempts=5, base_delay=0.01, max_delay=0.1, deadline=30)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(retry_policy.send_with_retry(send, policy, "bad-request", request_timeout=10))
+    assert len(calls) == 1 and sleeps == []
+    # 客户端错误不代表网关有问题，不计入失败
+    assert retry_policy.get_breaker("bad-request")._failures == 0
+
+def test_gives_up_after_max_attempts_with_last_error(sleeps):
+    send, calls = scripted_send(503)
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.1, deadline=30)
+    with pytest.raises(httpx.HTTPStatusError) as exc_info:
+        asyncio.run(retry_policy.send_with_retry(send, policy, "always-503", request_timeout=10))
+    assert exc_info.value.response.status_code == 503
+    assert len(calls) == 3
+
+def test_stops_when_retry_would_pass_deadline(sleeps):
+    send, calls = scripted_send(429, headers={"Retry-After": "60"})
+    policy = RetryPolicy(max_attempts=5, base_delay=0.01, max_delay=0.1, deadline=30)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(retry_policy.send_with_retry(send, policy, "deadline", request_timeout=10))
+    assert len(calls) == 1 and sleeps == []
+
+def test_transport_errors_are_retried(sleeps):
+    attempts = []
+
+    async def send(timeout: float) -> httpx.Response:
+        attempts.append(timeout)
+        if len(attempts) == 1: raise httpx.ConnectError("refused", request=REQUEST)
+        return make_response(200)
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.1, deadline=30)
+    assert asyncio.run(retry_policy.send_with_retry(send, policy, "transport", request_timeout=10)).status_code == 200
+    assert len(attempts) == 2
+
+def test_attempt_timeout_never_exceeds_request_timeout(sleeps):
+    send, calls = scripted_send(200)
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.1, deadline=30)
+    asyncio.run(retry_policy.send_with_retry(send, policy, "timeout", request_timeout=5))
+    assert calls == [5]
+
+def test_open_breaker_fails_fast_without_sending(sleeps, monkeypatch):
+    monkeypatch.setattr(config, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 2)
+    send, calls = scripted_send(503)
+    policy = RetryPolicy(max_attempts=5, base_delay=0.01, max_delay=0.1, deadline=30)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(retry_policy.send_with_retry(send, policy, "flaky", request_timeout=10))
+    # 阈值为 2：第二次失败后熔断，第三次尝试不再发出
+    assert len(calls) == 2
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(retry_policy.send_with_retry(send, policy, "flaky", request_timeout=10))
+    assert len(calls) == 2
+
+def test_cancelled_probe_releases_half_open_breaker():
+    breaker = retry_policy.get_breaker("cancelled-probe")
+    for _ in range(5): breaker.record_failure()
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.1, deadline=30)
+
+    async def hang(timeout: float) -> httpx.Response:
+        await asyncio.sleep(10)
+
+    async def scenario():
+        await asyncio.sleep(0.06)
+        assert breaker.state == "half-open"
+        task = asyncio.create_task(retry_policy.send_with_retry(hang, policy, "cancelled-probe", request_timeout=10))
+        await asyncio.sleep(0.01)
+        assert breaker._probe_in_flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+    asyncio.run(scenario())
+    assert not breaker._probe_in_flight
+    assert breaker.allow()
+
+def test_record_attempt_error_only_releases_probe_it_holds():
+    breaker = CircuitBreaker("m", failure_threshold=5, reset_timeout=10)
+    breaker._probe_in_flight = True
+    retry_policy.record_attempt_error(breaker, ValueError("client side"), probing=False)
+    assert breaker._probe_in_flight
+    retry_policy.record_attempt_error(breaker, asyncio.CancelledError(), probing=True)
+    assert not breaker._probe_in_flight
+    retry_policy.record_attempt_error(breaker, httpx.ReadTimeout("slow", request=REQUEST), probing=False)
+    assert breaker._failures == 1
@@ -0,0 +1,22 @@
+import pytest
+
+from yimao_plugin.utils import extract_json_object
+
+@pytest.mark.parametrize("text", [
+    '{"should_reply": true, "reason": "有人提问"}',
+    '```json\n{"should_reply": true, "reason": "有人提问"}\n```',
+    '判断如下：{"should_reply": true, "reason": "有人提问"} 以上。',
+    '{"should_reply": true, "reason": "有人提问"}\n{"should_reply": false}',
+])
+def test_extracts_first_object(text):
+    assert extract_json_object(text) == {"should_reply": True, "reason": "有人提问"}
+
+def test_skips_braces_that_do_not_start_an_object():
+    assert extract_json_object('用 {大括号} 包起来：{"ok": 1}') == {"ok": 1}
+
+def test_nested_braces_inside_strings_and_objects():
+    assert extract_json_object('{"a": {"b": "}{"}, "c": [1, 2]}') == {"a": {"b": "}{"}, "c": [1, 2]}
+
+@pytest.mark.parametrize("text", ["", "没有 JSON", '["不是对象"]', '{"unterminated": '])
+def test_returns_none_without_object(text):
+    assert extract_json_object(text) is None